@@ -10,7 +10,9 @@ except:
 
 from adorym.util import *
 import adorym.wrappers as w
+import adorym.global_settings as global_settings
 import adorym.conventional as c
+from adorym.rotation import rotate_fft_shear
 
 comm = MPI.COMM_WORLD
 n_ranks = comm.Get_size()
@@ -41,7 +43,8 @@ class LargeArray(object):
             self.f = h5py.File(os.path.join(self.output_folder, fname), fmode)
         try:
             # If dataset doesn't exist, create it.
-            self.dset = self.f.create_dataset('obj', shape=self.full_size, dtype='float64')
+            self.dset = self.f.create_dataset('obj', shape=self.full_size,
+                                              dtype=global_settings.get_dtype('storage', 'float64'))
         except:
             # If dataset exists, create a pointer to it.
             self.dset = self.f['obj']
@@ -51,7 +54,7 @@ class LargeArray(object):
         obj = get_rotated_subblocks(dset, this_pos_batch, probe_size,
                                     self.full_size, monochannel=self.monochannel, unknown_type=unknown_type)
         self.arr_0 = np.copy(obj)
-        obj = w.create_variable(obj, device=device)
+        obj = w.create_variable(obj, dtype=global_settings.compute_dtype, device=device)
         return obj
 
     def read_chunks_from_distributed_object(self, probe_pos, this_ind_batch_allranks, minibatch_size,
@@ -59,10 +62,28 @@ class LargeArray(object):
         a = self.arr if not apply_to_arr_rot else self.arr_rot
         obj = get_subblocks_from_distributed_object_mpi(a, self.slice_catalog, probe_pos, this_ind_batch_allranks, minibatch_size,
                                                     probe_size, self.full_size, unknown_type, output_folder=self.output_folder, dtype=dtype)
-        obj = w.create_variable(obj, device=device)
+        obj = w.create_variable(obj, dtype=global_settings.compute_dtype, device=device)
         return obj
 
-    def rotate_data_in_file(self, coords, interpolation='bilinear', dset_2=None, precalculate_rotation_coords=True):
+    def rotate_data_in_file(self, coords, interpolation='bilinear', dset_2=None, precalculate_rotation_coords=True,
+                            rotation_method='bilinear', adjoint=False, matrix_t=None):
+        """
+        :param rotation_method: if 'fft_shear', coords is the angle.
+        :param adjoint: if True, apply the exact transpose of the rotation by coords (see apply_rotation_adjoint),
+                        e.g. to rotate gradients back.
+        :param matrix_t: optional transposed interpolation matrix of coords, used if adjoint is True.
+        """
+        if rotation_method == 'fft_shear':
+            dset_2 = self.dset if dset_2 is None else dset_2
+            for i_slice in range(rank, self.dset.shape[0], n_ranks):
+                dset_2[i_slice] = rotate_fft_shear(self.dset[i_slice:i_slice + 1], coords, adjoint=adjoint,
+                                                   override_backend='autograd')[0]
+            return
+        if adjoint:
+            revert_rotation_to_hdf5(self.dset, coords, rank, n_ranks, interpolation=interpolation,
+                                    monochannel=self.monochannel, dset_2=dset_2,
+                                    precalculate_rotation_coords=precalculate_rotation_coords, matrix_t=matrix_t)
+            return
         apply_rotation_to_hdf5(self.dset, coords, rank, n_ranks, interpolation=interpolation,
                                monochannel=self.monochannel, dset_2=dset_2, precalculate_rotation_coords=precalculate_rotation_coords)
 
@@ -71,7 +92,14 @@ class LargeArray(object):
                                 monochannel=self.monochannel, precalculate_rotation_coords=precalculate_rotation_coords)
 
     def rotate_array(self, coords, interpolation='bilinear', precalculate_rotation_coords=True, apply_to_arr_rot=False,
-                     overwrite_arr=False, override_backend=None, dtype=None, override_device=None):
+                     overwrite_arr=False, override_backend=None, dtype=None, override_device=None,
+                     rotation_method='bilinear', adjoint=False, matrix_t=None):
+        """
+        :param rotation_method: if 'fft_shear', coords is the angle.
+        :param adjoint: if True, apply the exact transpose of the rotation by coords (see apply_rotation_adjoint),
+                        e.g. to rotate gradients back.
+        :param matrix_t: optional transposed interpolation matrix of coords, used if adjoint is True.
+        """
         if self.arr is None:
             return
         a = self.arr if not apply_to_arr_rot else self.arr_rot
@@ -82,7 +110,20 @@ class LargeArray(object):
                 d = override_device
         else:
             d = self.device
-        if precalculate_rotation_coords:
+        if rotation_method == 'fft_shear':
+            arr_rot = rotate_fft_shear(a, coords, adjoint=adjoint, device=d, override_backend=override_backend)
+            if overwrite_arr:
+                self.arr = arr_rot
+            else:
+                self.arr_rot = arr_rot
+        elif precalculate_rotation_coords and adjoint:
+            arr_rot = apply_rotation_adjoint(a, coords, interpolation=interpolation, override_backend=override_backend,
+                                             matrix_t=matrix_t)
+            if overwrite_arr:
+                self.arr = arr_rot
+            else:
+                self.arr_rot = arr_rot
+        elif precalculate_rotation_coords:
             if overwrite_arr:
                 self.arr = apply_rotation(a, coords, interpolation=interpolation, device=d, override_backend=override_backend)
             else:
@@ -145,7 +186,8 @@ class ObjectFunction(LargeArray):
             self.f_rot = h5py.File(os.path.join(self.output_folder, 'intermediate_obj_rot.h5'), 'w', driver='mpio', comm=comm)
         except:
             self.f_rot = h5py.File(os.path.join(self.output_folder, 'intermediate_obj_rot.h5'), 'w')
-        self.dset_rot = self.f_rot.create_dataset('obj', shape=self.full_size, dtype='float64')
+        self.dset_rot = self.f_rot.create_dataset('obj', shape=self.full_size,
+                                                  dtype=global_settings.get_dtype('storage', 'float64'))
 
     def initialize_array(self, save_stdout=None, timestr=None, not_first_level=False, initial_guess=None, device=None,
                          random_guess_means_sigmas=(8.7e-7, 5.1e-8, 1e-7, 1e-8), unknown_type='delta_beta', non_negativity=False):
@@ -155,13 +197,17 @@ class ObjectFunction(LargeArray):
                               save_stdout=save_stdout, timestr=timestr,
                               not_first_level=not_first_level,
                               random_guess_means_sigmas=random_guess_means_sigmas, unknown_type=unknown_type, non_negativity=non_negativity)
-        self.arr = w.create_variable(np.stack([temp_delta, temp_beta], -1), device=device, requires_grad=True)
+        self.arr = w.create_variable(np.stack([temp_delta, temp_beta], -1), dtype=global_settings.compute_dtype,
+                                     device=device, requires_grad=True)
         del temp_delta
         del temp_beta
         gc.collect()
 
-    def initialize_array_with_values(self, obj_delta, obj_beta, device=None):
-        self.arr = w.create_variable(np.stack([obj_delta, obj_beta], -1), device=device, requires_grad=True)
+    def initialize_array_with_values(self, obj_delta, obj_beta, device=None, dtype=None):
+        args = {}
+        if dtype is not None:
+            args['dtype'] = dtype
+        self.arr = w.create_variable(np.stack([obj_delta, obj_beta], -1), device=device, requires_grad=True, **args)
 
     def initialize_distributed_array(self, save_stdout=None, timestr=None, not_first_level=False, initial_guess=None,
                          random_guess_means_sigmas=(8.7e-7, 5.1e-8, 1e-7, 1e-8), unknown_type='delta_beta', dtype='float32', non_negativity=False):
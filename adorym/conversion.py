@@ -0,0 +1,188 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import warnings
+import numpy as np
+import h5py
+try:
+    from mpi4py import MPI
+except:
+    from adorym.pseudo import MPI
+
+from adorym.util import print_flush
+from adorym.data_loader import get_compression_kwargs
+
+comm = MPI.COMM_WORLD
+n_ranks = comm.Get_size()
+rank = comm.Get_rank()
+
+
+def stream_copy(src, dest, transform=None, chunk_size=256, n_workers=4, dest_key_func=None, verbose=True):
+    """
+    Copy diffraction data from src to dest in a read -> transform -> write pipeline. Chunks of chunk_size patterns
+    are read and written in the calling thread and transformed by a pool of worker threads, with at most
+    2 * n_workers chunks in memory at a time.
+    :param src: array-like of shape [..., n_patterns, len_y, len_x], e.g. an HDF5 dataset.
+    :param dest: array-like to write to.
+    :param transform: function applied to each chunk of shape [n, len_y, len_x]. It should return the chunk to be
+                      written to dest.
+    :param dest_key_func: function mapping the index of a chunk in src to its index in dest. Defaults to the same
+                          index.
+    :return: throughput in MB/s, counting data read.
+    """
+    shape = src.shape
+    key_ls = [(*i_lead, slice(i_st, min(i_st + chunk_size, shape[-3])))
+              for i_lead in np.ndindex(*shape[:-3]) for i_st in range(0, shape[-3], chunk_size)]
+    if dest_key_func is None:
+        dest_key_func = lambda key: key
+    t0 = time.time()
+    nbytes = 0
+    pool = ThreadPoolExecutor(n_workers) if transform is not None else None
+    pending = deque()
+
+    def write_earliest():
+        key, chunk = pending.popleft()
+        dest[dest_key_func(key)] = chunk.result() if pool is not None else chunk
+
+    for i_chunk, key in enumerate(key_ls):
+        chunk = np.asarray(src[key])
+        nbytes += chunk.nbytes
+        pending.append((key, pool.submit(transform, chunk) if pool is not None else chunk))
+        if len(pending) >= 2 * n_workers:
+            write_earliest()
+        if verbose and i_chunk % 100 == 0:
+            print_flush('  Chunk {}/{}, {:.1f} MB/s.'.format(i_chunk, len(key_ls), get_throughput(nbytes, t0)),
+                        save_stdout=False)
+    while len(pending) > 0:
+        write_earliest()
+    if pool is not None:
+        pool.shutdown()
+    throughput = get_throughput(nbytes, t0)
+    if verbose:
+        print_flush('Copied {:.1f} MB in {:.1f} s ({:.1f} MB/s).'.format(nbytes / 1e6, time.time() - t0, throughput),
+                    save_stdout=False)
+    return throughput
+
+
+def get_throughput(nbytes, t0):
+    """
+    Get the throughput in MB/s of nbytes processed since t0, or 0 if no time has elapsed yet.
+    """
+    dt = time.time() - t0
+    return nbytes / 1e6 / dt if dt > 0 else 0.
+
+
+def copy_groups_except(f_src, f_dest, exclude=('exchange',)):
+    """
+    Copy all top-level groups and datasets of an HDF5 file to another except those in exclude.
+    """
+    for key in f_src.keys():
+        if key not in exclude:
+            f_src.copy(key, f_dest)
+
+
+def convert_to_photon_counts(src_fname, dest_fname, raw_data_type='magnitude', dtype='uint16', count_scale=1.,
+                             compression='gzip', chunk_size=256, n_workers=4):
+    """
+    Stream exchange/data of an HDF5 file into a new file as integer photon counts with compression. Other groups
+    (metadata, etc.) are copied as is.
+    :param raw_data_type: 'magnitude' or 'intensity'; type of data in the source file.
+    :param dtype: 'uint16' or 'uint32'. Counts beyond the range of dtype are clipped.
+    :param count_scale: intensities are multiplied by this factor before being rounded to counts.
+    :param compression: see get_compression_kwargs.
+    :param chunk_size: number of diffraction patterns in each read.
+    :param n_workers: number of threads converting chunks.
+    """
+    f_src = h5py.File(src_fname, 'r')
+    f_dest = h5py.File(dest_fname, 'w')
+    copy_groups_except(f_src, f_dest)
+    dset_src = f_src['exchange/data']
+    shape = dset_src.shape
+    dset_dest = f_dest.create_group('exchange').create_dataset('data', shape=shape, dtype=dtype,
+                                                               chunks=(1, 1, *shape[2:]),
+                                                               **get_compression_kwargs(compression))
+    count_max = np.iinfo(dtype).max
+    n_clipped_ls = []
+
+    def to_counts(chunk):
+        intensity = np.abs(chunk)
+        if raw_data_type == 'magnitude':
+            intensity = intensity ** 2
+        counts = np.round(intensity * count_scale)
+        n_clipped_ls.append(np.count_nonzero(counts > count_max))
+        return np.clip(counts, 0, count_max).astype(dtype)
+
+    stream_copy(dset_src, dset_dest, transform=to_counts, chunk_size=chunk_size, n_workers=n_workers)
+    if sum(n_clipped_ls) > 0:
+        warnings.warn('{} pixels exceeded the range of {} and were clipped.'.format(sum(n_clipped_ls), dtype))
+    f_src.close()
+    f_dest.close()
+
+
+def add_poisson_noise(src_fname, dest_fname, n_ph, raw_data_type='intensity', normalize_per_pattern=False,
+                      chunk_size=256, n_workers=4):
+    """
+    Stream exchange/data of an HDF5 file into a new file with Poisson noise added to each diffraction pattern.
+    Noisy data are scaled back to the level of the source and stored in the same type (magnitude or intensity)
+    and dtype. Other groups are copied as is.
+    :param n_ph: if normalize_per_pattern is False, intensities are multiplied by n_ph to get the expected photon
+                 counts. Otherwise, each pattern is scaled so that its expected total count is n_ph.
+    :param raw_data_type: 'magnitude' or 'intensity'; type of data in the source file.
+    :param chunk_size: number of diffraction patterns in each read.
+    :param n_workers: number of threads adding noise to chunks.
+    :return: average SNR of patterns, i.e. variance of the noise-free intensity over variance of the noise.
+    """
+    f_src = h5py.File(src_fname, 'r')
+    f_dest = h5py.File(dest_fname, 'w')
+    copy_groups_except(f_src, f_dest)
+    dset_src = f_src['exchange/data']
+    dset_dest = f_dest.create_group('exchange').create_dataset('data', shape=dset_src.shape, dtype=dset_src.dtype)
+    snr_ls = []
+
+    def add_noise(chunk):
+        intensity = np.abs(chunk)
+        if raw_data_type == 'magnitude':
+            intensity = intensity ** 2
+        if normalize_per_pattern:
+            multiplier = n_ph / np.sum(intensity, axis=(-2, -1), keepdims=True)
+        else:
+            multiplier = n_ph
+        # Each chunk gets its own generator, as worker threads would otherwise share the global random state.
+        intensity_noisy = np.random.default_rng().poisson(intensity * multiplier) / multiplier
+        noise = intensity_noisy - intensity
+        snr_ls.extend(np.var(intensity, axis=(-2, -1)).ravel() / np.var(noise, axis=(-2, -1)).ravel())
+        return np.sqrt(intensity_noisy) if raw_data_type == 'magnitude' else intensity_noisy
+
+    stream_copy(dset_src, dset_dest, transform=add_noise, chunk_size=chunk_size, n_workers=n_workers)
+    f_src.close()
+    f_dest.close()
+    return np.mean(snr_ls)
+
+
+def rechunk_data(src_fname, dest_fname, minibatch_size, compression=None, max_cache_nbytes=1024 ** 3):
+    """
+    Stream exchange/data of an HDF5 file into a new file with chunks of shape (1, minibatch_size, len_y, len_x),
+    which suits reading a minibatch of spots of one angle at a time. Other groups are copied as is. The chunk
+    cache size recommended for reading the new file is saved in attributes of the dataset; see
+    get_recommended_chunk_cache.
+    :param compression: see get_compression_kwargs.
+    :param max_cache_nbytes: upper limit of the recommended chunk cache size.
+    """
+    f_src = h5py.File(src_fname, 'r')
+    f_dest = h5py.File(dest_fname, 'w')
+    copy_groups_except(f_src, f_dest)
+    dset_src = f_src['exchange/data']
+    shape = dset_src.shape
+    chunks = (1, min(minibatch_size, shape[1]), *shape[2:])
+    dset_dest = f_dest.create_group('exchange').create_dataset('data', shape=shape, dtype=dset_src.dtype,
+                                                               chunks=chunks, **get_compression_kwargs(compression))
+    stream_copy(dset_src, dset_dest, chunk_size=chunks[1])
+    # Cache all chunks of an angle, as spots of a minibatch are drawn randomly from one angle.
+    chunk_nbytes = int(np.prod(chunks)) * dset_src.dtype.itemsize
+    n_chunks_per_angle = int(np.ceil(shape[1] / chunks[1]))
+    dset_dest.attrs['rdcc_nbytes'] = int(min(chunk_nbytes * n_chunks_per_angle + chunk_nbytes, max_cache_nbytes))
+    dset_dest.attrs['rdcc_nslots'] = int(max(521, n_chunks_per_angle * 100 + 1))
+    f_src.close()
+    f_dest.close()
+
+
@@ -0,0 +1,626 @@
+import threading
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import os
+import hashlib
+import glob
+import json
+import warnings
+import numpy as np
+import h5py
+try:
+    from mpi4py import MPI
+except:
+    from adorym.pseudo import MPI
+try:
+    import zarr
+except:
+    zarr = None
+try:
+    # Registers extra HDF5 filters (e.g. bitshuffle) so that data compressed with them can be read.
+    import hdf5plugin
+except:
+    hdf5plugin = None
+
+import adorym.wrappers as w
+import adorym.global_settings as global_settings
+from adorym.util import print_flush
+
+comm = MPI.COMM_WORLD
+n_ranks = comm.Get_size()
+rank = comm.Get_rank()
+
+
+class DataPrefetcher(object):
+    """
+    Reads diffraction patterns of upcoming minibatches in a background thread, so that file I/O overlaps with
+    the computation of the current minibatch. Batches are read in the order of a schedule given to start(),
+    downsampled, converted to the quantity used by the loss function, cast to the compute dtype and kept in
+    (pinned, if available) host memory. At most n_prefetch batches are staged at a time.
+    """
+    def __init__(self, prj, theta_downsample=1, ds_level=1, n_prefetch=2, device=None, n_read_threads=1,
+                 raw_data_type='magnitude', quantity=None):
+        """
+        :param prj: HDF5 dataset (or any array-like supporting prj[i_theta, ind_array]) of raw data.
+        :param raw_data_type: 'magnitude' or 'intensity'; type of data in prj.
+        :param quantity: 'magnitude' or 'intensity'; type of data returned by get(). If None, data are returned as
+                         raw_data_type.
+        :param n_prefetch: number of batches staged ahead of the one in use.
+        :param device: device object of the variables returned by get().
+        :param n_read_threads: number of threads reading parts of a batch concurrently. Only useful for data
+                               stores that support parallel reads.
+        """
+        self.prj = prj
+        self.theta_downsample = theta_downsample if theta_downsample is not None else 1
+        self.ds_level = ds_level
+        self.n_prefetch = max(int(n_prefetch), 1)
+        self.device = device
+        self.n_read_threads = n_read_threads
+        self.raw_data_type = raw_data_type
+        self.quantity = quantity
+        self.read_pool = ThreadPoolExecutor(n_read_threads) if n_read_threads > 1 else None
+        self.queue = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.current = None
+        self.n_misses = 0
+
+    def read_batch(self, this_i_theta, this_ind_batch):
+        """
+        Read and preprocess one batch of data. Returns a Numpy array.
+        """
+        i_theta = this_i_theta * self.theta_downsample
+        if self.read_pool is not None and len(this_ind_batch) > 1:
+            part_ls = np.array_split(this_ind_batch, min(self.n_read_threads, len(this_ind_batch)))
+            this_prj_batch = np.concatenate(list(self.read_pool.map(lambda ind: self.prj[i_theta, ind], part_ls)))
+        else:
+            this_prj_batch = self.prj[i_theta, this_ind_batch]
+        this_prj_batch = np.abs(this_prj_batch)
+        if self.ds_level > 1:
+            this_prj_batch = this_prj_batch[:, ::self.ds_level, ::self.ds_level]
+        this_prj_batch = np.ascontiguousarray(this_prj_batch, dtype=global_settings.compute_dtype)
+        if self.quantity is not None and self.quantity != self.raw_data_type:
+            this_prj_batch = np.sqrt(this_prj_batch) if self.quantity == 'magnitude' else this_prj_batch ** 2
+        return this_prj_batch
+
+    def start(self, schedule):
+        """
+        Start staging batches in the background.
+        :param schedule: list of (this_i_theta, this_ind_batch) in the order in which they will be requested.
+                         this_ind_batch must be sorted.
+        """
+        self.stop()
+        self.stop_event.clear()
+        self.queue = queue.Queue(maxsize=self.n_prefetch)
+        self.current = None
+        self.thread = threading.Thread(target=self._run, args=(list(schedule), self.queue, self.stop_event))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, schedule, q, stop_event):
+        for this_i_theta, this_ind_batch in schedule:
+            this_ind_batch = np.array(this_ind_batch, dtype=int)
+            try:
+                data = w.pin_memory(self.read_batch(this_i_theta, this_ind_batch))
+            except Exception as e:
+                print_flush('Prefetcher failed to read batch ({}). Falling back to synchronous reading.'.format(e),
+                            save_stdout=False)
+                break
+            if not self._put(q, (int(this_i_theta), this_ind_batch, data), stop_event):
+                return
+        # None marks the end of the schedule.
+        self._put(q, None, stop_event)
+
+    @staticmethod
+    def _put(q, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stop(self):
+        """
+        Stop the background thread and discard staged batches.
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.queue = None
+        self.current = None
+
+    def _find_rows(self, this_i_theta, this_ind_batch):
+        if self.current is None or self.current[0] != int(this_i_theta):
+            return None
+        staged_ind = self.current[1]
+        rows = np.clip(np.searchsorted(staged_ind, this_ind_batch), 0, len(staged_ind) - 1)
+        if not np.array_equal(staged_ind[rows], this_ind_batch):
+            return None
+        return rows
+
+    def get(self, this_i_theta, this_ind_batch):
+        """
+        Get data of a batch as a constant variable on device. The batch (or a sub-batch of it) should be in the
+        schedule, or be the one last returned. Staged batches scheduled before the requested one are discarded,
+        so a skipped batch does not put the prefetcher out of step. Batches not found in the rest of the schedule
+        are read synchronously.
+        """
+        this_ind_batch = np.array(this_ind_batch, dtype=int)
+        rows = self._find_rows(this_i_theta, this_ind_batch)
+        while rows is None and self.queue is not None:
+            item = self.queue.get()
+            if item is None:
+                self.queue = None
+            else:
+                self.current = item
+                rows = self._find_rows(this_i_theta, this_ind_batch)
+        if rows is None:
+            self.n_misses += 1
+            data = self.read_batch(this_i_theta, this_ind_batch)
+            return w.create_variable(data, dtype=global_settings.compute_dtype, requires_grad=False,
+                                     device=self.device)
+        data = self.current[2]
+        if len(rows) < len(self.current[1]):
+            data = data[rows]
+        return w.pinned_to_variable(data, device=self.device)
+
+
+def get_preprocessed_data_cache(prj, src_fname, cache_folder, ds_level=1, theta_downsample=1,
+                                raw_data_type='magnitude', quantity='magnitude', fft_order=False, chunk_size=256,
+                                dtype='float32'):
+    """
+    Get a memory-mapped cache of measured data that are ready to be compared with predictions, creating it if it
+    does not exist yet. Compared to the raw data, the cache only contains every theta_downsample-th angle, is
+    downsampled by ds_level, and contains magnitudes or intensities regardless of the raw data type, so that
+    cache[this_i_theta, this_ind_batch] can be used as is in the loss function. Caches are named by a hash of the
+    source file and the preprocessing parameters, so they are reused by later runs and multiscale levels with the
+    same settings.
+    :param prj: HDF5 dataset of raw data.
+    :param src_fname: path (or list of paths) of the source. Path, size and modification time identify the source.
+    :param raw_data_type: 'magnitude' or 'intensity'; type of data in prj.
+    :param quantity: 'magnitude' or 'intensity'; type of data in the cache.
+    :param fft_order: bool; if True, data are ifftshifted, so that they can be compared with far-field predictions
+                      that are not fftshifted.
+    :return: read-only Numpy memmap of shape [n_theta, n_spots, len_y, len_x].
+    """
+    theta_downsample = theta_downsample if theta_downsample is not None else 1
+    src_fname_ls = src_fname if isinstance(src_fname, (list, tuple)) else [src_fname]
+    key = {'src': [(os.path.abspath(fname), os.stat(fname).st_size, os.stat(fname).st_mtime)
+                   for fname in src_fname_ls],
+           'shape': list(prj.shape), 'ds_level': ds_level, 'theta_downsample': theta_downsample,
+           'raw_data_type': raw_data_type, 'quantity': quantity, 'fft_order': fft_order, 'dtype': dtype}
+    key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    cache_fname = os.path.join(cache_folder, 'prj_cache_{}.npy'.format(key_hash))
+
+    if rank == 0 and not os.path.exists(cache_fname):
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        i_theta_ls = range(0, prj.shape[0], theta_downsample)
+        shape = (len(i_theta_ls), prj.shape[1], len(range(0, prj.shape[2], ds_level)),
+                 len(range(0, prj.shape[3], ds_level)))
+        print_flush('Creating preprocessed data cache {}...'.format(cache_fname), save_stdout=False)
+        temp_fname = cache_fname + '.tmp'
+        cache = np.lib.format.open_memmap(temp_fname, mode='w+', dtype=dtype, shape=shape)
+        for i, i_theta in enumerate(i_theta_ls):
+            for i_st in range(0, prj.shape[1], chunk_size):
+                i_end = min(i_st + chunk_size, prj.shape[1])
+                this_prj_batch = np.abs(prj[i_theta, i_st:i_end])
+                if ds_level > 1:
+                    this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
+                if quantity != raw_data_type:
+                    this_prj_batch = np.sqrt(this_prj_batch) if quantity == 'magnitude' else this_prj_batch ** 2
+                if fft_order:
+                    this_prj_batch = np.fft.ifftshift(this_prj_batch, axes=(-2, -1))
+                cache[i, i_st:i_end] = this_prj_batch
+        cache.flush()
+        del cache
+        # Rename after writing is complete, so that an interrupted run does not leave a partial cache.
+        os.rename(temp_fname, cache_fname)
+    comm.Barrier()
+    return np.load(cache_fname, mmap_mode='r')
+
+
+def get_rank_shards(n_pos_ls, theta_ind_ls, n_ranks):
+    """
+    Assign each rank a fixed, contiguous range of (angle, spot) pairs in the order they are stored in the data
+    file, so that the data of a rank can be read sequentially.
+    :param n_pos_ls: list of the number of spots of each angle.
+    :param theta_ind_ls: indices of angles to be processed.
+    :return: list of dicts, one for each rank, mapping angle indices to sorted arrays of spot indices.
+    """
+    pairs = np.concatenate([np.stack([np.full(n_pos_ls[i_theta], i_theta), np.arange(n_pos_ls[i_theta])], axis=1)
+                            for i_theta in sorted(theta_ind_ls)])
+    if len(pairs) < n_ranks:
+        raise ValueError('Cannot shard {} diffraction patterns over {} ranks.'.format(len(pairs), n_ranks))
+    shard_ls = []
+    for rank_pairs in np.array_split(pairs, n_ranks):
+        shard = {}
+        for i_theta in np.unique(rank_pairs[:, 0]):
+            shard[int(i_theta)] = rank_pairs[rank_pairs[:, 0] == i_theta, 1]
+        shard_ls.append(shard)
+    return shard_ls
+
+
+def get_sharded_task_list(shard_ls, minibatch_size, randomize_probe_pos=False):
+    """
+    Make the task list of an epoch in which every rank only processes spots of its own shard. The order of angles
+    (and spots, if randomize_probe_pos is True) is shuffled within each shard. Angles whose number of spots is not a
+    multiple of minibatch_size are padded with randomly chosen spots, and ranks with fewer minibatches repeat
+    their first ones, so that all ranks run the same number of batches. The random state must be the same on
+    all ranks.
+    :return: list of arrays of shape [minibatch_size * n_ranks, 2], in the format of ind_list_rand.
+    """
+    rank_batch_ls = []
+    for shard in shard_ls:
+        batch_ls = []
+        theta_ind_ls = np.array(sorted(shard.keys()))
+        np.random.shuffle(theta_ind_ls)
+        for i_theta in theta_ind_ls:
+            spots_ls = shard[i_theta]
+            if randomize_probe_pos:
+                spots_ls = np.random.permutation(spots_ls)
+            if len(spots_ls) % minibatch_size != 0:
+                n_supp = minibatch_size - len(spots_ls) % minibatch_size
+                spots_ls = np.append(spots_ls, np.random.choice(spots_ls, n_supp, replace=n_supp > len(spots_ls)))
+            for i_st in range(0, len(spots_ls), minibatch_size):
+                batch_ls.append(np.stack([np.full(minibatch_size, i_theta),
+                                          spots_ls[i_st:i_st + minibatch_size]], axis=1))
+        rank_batch_ls.append(batch_ls)
+    n_batch = max([len(batch_ls) for batch_ls in rank_batch_ls])
+    for batch_ls in rank_batch_ls:
+        n_own = len(batch_ls)
+        for i in range(n_batch - n_own):
+            batch_ls.append(batch_ls[i % n_own])
+    return [np.concatenate([batch_ls[i_batch] for batch_ls in rank_batch_ls]) for i_batch in range(n_batch)]
+
+
+class ShardedData(object):
+    """
+    Diffraction patterns of the spots in the shard of this rank, preloaded into memory with one contiguous read per
+    angle. Indexed in the same way as the source, i.e. data[i_theta * theta_downsample, ind_array], for spots
+    within the shard.
+    """
+    def __init__(self, src, shard, theta_downsample=1):
+        """
+        :param src: HDF5 dataset, or memmap of preprocessed data (then theta_downsample should be 1).
+        :param shard: dict mapping angle indices to sorted spot indices, as returned by get_rank_shards.
+        """
+        theta_downsample = theta_downsample if theta_downsample is not None else 1
+        self.shape = src.shape
+        self.block_dict = {}
+        for i_theta, spots_ls in shard.items():
+            i_st, i_end = int(np.min(spots_ls)), int(np.max(spots_ls)) + 1
+            self.block_dict[i_theta * theta_downsample] = (i_st, np.array(src[i_theta * theta_downsample, i_st:i_end]))
+
+    def __getitem__(self, item):
+        i_theta, ind = item
+        i_st, block = self.block_dict[int(i_theta)]
+        return block[np.array(ind, dtype=int) - i_st]
+
+
+def get_compression_kwargs(compression=None):
+    """
+    Get keyword arguments of h5py's create_dataset for a compression filter.
+    :param compression: None, 'gzip', 'lzf' or 'bitshuffle'. 'bitshuffle' requires hdf5plugin, and falls back to
+                        'gzip' if it is not installed.
+    """
+    if compression is None:
+        return {}
+    if compression == 'bitshuffle':
+        if hdf5plugin is not None:
+            return dict(hdf5plugin.Bitshuffle())
+        warnings.warn('hdf5plugin is not available. Using gzip instead of bitshuffle.')
+        compression = 'gzip'
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+    elif compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    else:
+        raise ValueError('Unknown compression filter "{}".'.format(compression))
+
+
+def is_photon_count_data(dset):
+    """
+    Whether a dataset stores integer photon counts (i.e. intensities).
+    """
+    return np.issubdtype(dset.dtype, np.integer)
+
+
+def get_recommended_chunk_cache(fname, swmr=False):
+    """
+    Get the chunk cache size saved by rechunk_data, as keyword arguments of h5py.File. Returns an empty dict
+    if the file has no recommendation.
+    :param swmr: open the file in SWMR mode, for files that are still being written.
+    """
+    with h5py.File(fname, 'r', swmr=swmr) as f:
+        attrs = f['exchange/data'].attrs
+        if 'rdcc_nbytes' not in attrs:
+            return {}
+        return {'rdcc_nbytes': int(attrs['rdcc_nbytes']), 'rdcc_nslots': int(attrs['rdcc_nslots'])}
+
+
+def benchmark_data_reads(fname, minibatch_size, n_batches=20, **file_kwargs):
+    """
+    Measure the time of reading random minibatches of spots of one angle, as done in reconstruction.
+    :param file_kwargs: keyword arguments of h5py.File, e.g. rdcc_nbytes.
+    :return: average time in seconds per minibatch.
+    """
+    f = h5py.File(fname, 'r', **file_kwargs)
+    dset = f['exchange/data']
+    n_theta, n_spots = dset.shape[:2]
+    minibatch_size = min(minibatch_size, n_spots)
+    t0 = time.time()
+    for i in range(n_batches):
+        this_ind_batch = np.sort(np.random.choice(n_spots, minibatch_size, replace=False))
+        dset[np.random.randint(n_theta), this_ind_batch]
+    t = (time.time() - t0) / n_batches
+    f.close()
+    return t
+
+
+class DataStore(object):
+    """
+    Base class of raw data stores. A store exposes diffraction data as an array-like attribute `data` of shape
+    [n_theta, n_spots, len_y, len_x], which supports data[i_theta, ind_array] and data[i_theta, slice], and
+    metadata (e.g. 'theta', 'probe_pos_px', 'energy_ev') through get_metadata.
+    """
+    # Whether data can be read by several threads at a time without being serialized.
+    parallel_reads = False
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def get_metadata(self, name):
+        """
+        Get a metadata entry as a Numpy array. Raises KeyError if it does not exist.
+        """
+        raise NotImplementedError
+
+    def get_acquired_counts(self, n_theta):
+        """
+        Get the number of diffraction patterns acquired so far for each of n_theta angles, for data that are still
+        being written. Patterns of an angle are assumed to be acquired in the order of their indices.
+        """
+        return np.array([self.data.shape[1]] * n_theta)
+
+    def close(self):
+        pass
+
+
+class HDF5DataStore(DataStore):
+    """
+    Data in exchange/data and metadata in group metadata of an HDF5 file. For files being written in SWMR mode,
+    open the store with swmr=True; the writer should then keep the number of patterns written for each angle in
+    exchange/n_acquired, or otherwise grow exchange/data along the angle axis.
+    """
+    def __init__(self, path, **file_kwargs):
+        """
+        :param file_kwargs: keyword arguments of h5py.File, e.g. swmr or rdcc_nbytes. The chunk cache size
+                            recommended by rechunk_data is used if the file has one, unless given here.
+        """
+        super(HDF5DataStore, self).__init__(path)
+        kwargs = get_recommended_chunk_cache(path, swmr=file_kwargs.get('swmr', False))
+        kwargs.update(file_kwargs)
+        self.f = h5py.File(path, 'r', **kwargs)
+        self.data = self.f['exchange/data']
+
+    def get_metadata(self, name):
+        return self.f['metadata/{}'.format(name)][...]
+
+    def get_acquired_counts(self, n_theta):
+        if not self.f.swmr_mode:
+            return super(HDF5DataStore, self).get_acquired_counts(n_theta)
+        self.data.refresh()
+        if 'exchange/n_acquired' in self.f:
+            dset = self.f['exchange/n_acquired']
+            dset.refresh()
+            counts = np.zeros(n_theta, dtype=int)
+            counts[:min(n_theta, dset.shape[0])] = dset[:n_theta]
+            return counts
+        n_theta_acquired = min(self.data.shape[0], n_theta)
+        return np.array([self.data.shape[1]] * n_theta_acquired + [0] * (n_theta - n_theta_acquired))
+
+    def close(self):
+        self.f.close()
+
+
+class NpyDirectoryArray(object):
+    """
+    Read-only array view of a directory of per-angle .npy files, each memory-mapped.
+    """
+    def __init__(self, fname_ls):
+        self.arr_ls = [np.load(fname, mmap_mode='r') for fname in fname_ls]
+        self.shape = (len(self.arr_ls), *self.arr_ls[0].shape)
+        self.dtype = self.arr_ls[0].dtype
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        return np.array(self.arr_ls[int(item[0])][item[1:]])
+
+
+class NpyDirectoryDataStore(DataStore):
+    """
+    Data in files data_00000.npy, data_00001.npy, ... (one per angle, each of shape [n_spots, len_y, len_x]) and
+    metadata in metadata/<name>.npy under a directory.
+    """
+    parallel_reads = True
+
+    def __init__(self, path):
+        super(NpyDirectoryDataStore, self).__init__(path)
+        fname_ls = sorted(glob.glob(os.path.join(path, 'data_*.npy')))
+        if len(fname_ls) == 0:
+            raise ValueError('No data_*.npy files found in {}.'.format(path))
+        self.data = NpyDirectoryArray(fname_ls)
+
+    def get_metadata(self, name):
+        fname = os.path.join(self.path, 'metadata', '{}.npy'.format(name))
+        if not os.path.exists(fname):
+            raise KeyError(name)
+        return np.load(fname)
+
+
+class ZarrArray(object):
+    """
+    Wrapper of a Zarr array that supports indexing with integer arrays in the same way as h5py.
+    """
+    def __init__(self, arr):
+        self.arr = arr
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+
+    def __getitem__(self, item):
+        return self.arr.oindex[item]
+
+
+class ZarrDataStore(DataStore):
+    """
+    Data in exchange/data and metadata in group metadata of a Zarr store, laid out as in the HDF5 format.
+    """
+    parallel_reads = True
+
+    def __init__(self, path):
+        super(ZarrDataStore, self).__init__(path)
+        if zarr is None:
+            raise ImportError('Zarr is required to read {}.'.format(path))
+        self.root = zarr.open(path, mode='r')
+        self.data = ZarrArray(self.root['exchange/data'])
+
+    def get_metadata(self, name):
+        return self.root['metadata/{}'.format(name)][...]
+
+
+def open_data_store(path, live=False, **kwargs):
+    """
+    Open raw data at path with the store matching its format: a list of per-angle HDF5 files (given as a list or
+    a glob pattern), a Zarr store (directory with a .zgroup file or name ending with .zarr), a directory of .npy
+    files, or otherwise an HDF5 file.
+    :param live: if True, data are assumed to be still being written. A single HDF5 file is then opened in SWMR
+                 mode.
+    :param kwargs: passed to the store, e.g. h5py.File arguments for HDF5DataStore.
+    """
+    if isinstance(path, (list, tuple)):
+        return MultiFileDataStore(list(path), **kwargs)
+    if glob.has_magic(path):
+        fname_ls = sorted(glob.glob(path))
+        if len(fname_ls) == 0:
+            raise ValueError('No files match {}.'.format(path))
+        return MultiFileDataStore(fname_ls, pattern=path, **kwargs)
+    if os.path.isdir(path):
+        if path.rstrip('/').endswith('.zarr') or os.path.exists(os.path.join(path, '.zgroup')):
+            return ZarrDataStore(path)
+        return NpyDirectoryDataStore(path)
+    if live:
+        kwargs['swmr'] = True
+    return HDF5DataStore(path, **kwargs)
+
+
+class MultiFileArray(object):
+    """
+    Read-only array view of exchange/data in a list of per-angle HDF5 files. Each file holds data of one angle,
+    in shape [n_spots, len_y, len_x] or [1, n_spots, len_y, len_x]. Files are opened on first access, and at most
+    max_open_files of them are kept open.
+    """
+    def __init__(self, fname_ls, max_open_files=64, **file_kwargs):
+        self.fname_ls = list(fname_ls)
+        self.max_open_files = max_open_files
+        self.file_kwargs = file_kwargs
+        self.file_dict = {}
+        self.lock = threading.Lock()
+        dset = self.get_dataset(0)
+        self.shape = (len(fname_ls), *dset.shape[-3:])
+        self.dtype = dset.dtype
+
+    def get_file(self, i_theta):
+        with self.lock:
+            if i_theta not in self.file_dict:
+                if len(self.file_dict) >= self.max_open_files:
+                    # Close the earliest opened file.
+                    self.file_dict.pop(next(iter(self.file_dict))).close()
+                self.file_dict[i_theta] = h5py.File(self.fname_ls[i_theta], 'r', **self.file_kwargs)
+            return self.file_dict[i_theta]
+
+    def get_dataset(self, i_theta):
+        return self.get_file(i_theta)['exchange/data']
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        dset = self.get_dataset(int(item[0]))
+        if len(dset.shape) == 4:
+            return dset[(0, *item[1:])]
+        return dset[item[1:]]
+
+    def close(self):
+        for f in self.file_dict.values():
+            f.close()
+        self.file_dict = {}
+
+
+class MultiFileDataStore(DataStore):
+    """
+    Data and metadata spread over one HDF5 file per angle, read in place without being concatenated. Angle i
+    comes from the i-th file. 'theta' is gathered from metadata/theta of each file, 'probe_pos_px_<i>' is
+    metadata/probe_pos_px of the i-th file, and other metadata are taken from the first file. If the store is
+    opened with a glob pattern, files that appear later are appended in sorted order when get_acquired_counts is
+    called.
+    """
+    def __init__(self, fname_ls, pattern=None, **file_kwargs):
+        super(MultiFileDataStore, self).__init__(fname_ls)
+        self.pattern = pattern
+        self.data = MultiFileArray(fname_ls, **file_kwargs)
+        self.n_spots_ls = []
+
+    def get_acquired_counts(self, n_theta):
+        if self.pattern is not None:
+            known_fname_ls = set(self.data.fname_ls)
+            self.data.fname_ls += [fname for fname in sorted(glob.glob(self.pattern)) if fname not in known_fname_ls]
+            self.data.shape = (len(self.data.fname_ls), *self.data.shape[1:])
+            self.path = self.data.fname_ls
+        for i_theta in range(len(self.n_spots_ls), len(self.data.fname_ls)):
+            self.n_spots_ls.append(self.data.get_dataset(i_theta).shape[-3])
+        counts = np.zeros(n_theta, dtype=int)
+        n_theta_acquired = min(len(self.n_spots_ls), n_theta)
+        counts[:n_theta_acquired] = self.n_spots_ls[:n_theta_acquired]
+        return counts
+
+    def get_metadata(self, name):
+        if name == 'theta':
+            return np.array([float(np.ravel(self.data.get_file(i)['metadata/theta'][...])[0])
+                             for i in range(len(self.data.fname_ls))])
+        if name.startswith('probe_pos_px_'):
+            i_theta = int(name[len('probe_pos_px_'):])
+            return self.data.get_file(i_theta)['metadata/probe_pos_px'][...]
+        return self.data.get_file(0)['metadata/{}'.format(name)][...]
+
+    def close(self):
+        self.data.close()
+
+
+def get_live_spots(n_acquired, n_acquired_prev, n_pos, minibatch_size, new_data_weight=1.):
+    """
+    Get indices of spots of an angle to be processed in an epoch of live reconstruction. Spots acquired since the
+    previous epoch are all included, and earlier ones are included with a probability of 1 / new_data_weight.
+    Once the angle is complete, all its spots are included, so that epochs after the end of acquisition use the
+    full data. No spot is returned if the angle is incomplete and has fewer than minibatch_size spots so far.
+    :param n_acquired: number of spots acquired for the angle so far.
+    :param n_acquired_prev: number of spots acquired for the angle by the previous epoch.
+    :param n_pos: total number of spots of the angle.
+    """
+    if n_acquired < min(minibatch_size, n_pos):
+        return np.array([], dtype=int)
+    spots_ls = np.arange(n_acquired)
+    if new_data_weight > 1 and n_acquired < n_pos:
+        keep = np.random.rand(n_acquired) < 1. / new_data_weight
+        keep[n_acquired_prev:] = True
+        spots_ls = spots_ls[keep]
+        n_fill = min(minibatch_size, n_acquired) - len(spots_ls)
+        if n_fill > 0:
+            # Fill up with earlier spots, so that the angle still makes a full minibatch.
+            spots_ls = np.sort(np.append(spots_ls, np.random.choice(np.nonzero(~keep)[0], n_fill, replace=False)))
+    return spots_ls
@@ -1,6 +1,11 @@
 import numpy as np
 
 import adorym.wrappers as w
+import adorym.global_settings as global_settings
+from adorym.constants import PI
+from adorym.propagate import get_kernel, gen_freq_mesh
+from adorym.util import extract_patches, scatter_add_patches
+from adorym.forward_model import PtychographyModel
 
 class Differentiator(object):
 
@@ -15,3 +20,279 @@ class Differentiator(object):
     def get_gradients(self, **kwargs):
         gradients = w.get_gradients(self.loss_object, opt_args_ls=self.opt_args_ls, **kwargs)
         return gradients
+
+    def get_gradients_by_subbatch(self, forward_model, n_dp_batch, split_obj=False, **kwargs):
+        """
+        Get the gradients of a minibatch as the sum of separate forward and backward passes over sub-batches of at
+        most n_dp_batch spots, so that the graph of only one sub-batch is kept at a time. The mismatch loss of each
+        sub-batch is weighted by its share of the minibatch and regularizers are added once, so the result is the
+        same as that of get_gradients.
+        :param split_obj: bool; if True, obj contains one chunk per spot (distributed modes) and is split along with
+                          the spots. Its gradient is then concatenated instead of summed.
+        """
+        n_spots = len(kwargs['this_ind_batch'])
+        i_obj = self.opt_args_ls.index(forward_model.get_argument_index('obj')) if split_obj else None
+        grads = None
+        obj_grads_ls = []
+        total_loss = 0
+        for i_st in range(0, n_spots, n_dp_batch):
+            i_end = min(i_st + n_dp_batch, n_spots)
+            sub_kwargs = dict(kwargs)
+            sub_kwargs['this_pos_batch'] = kwargs['this_pos_batch'][i_st:i_end]
+            sub_kwargs['this_ind_batch'] = kwargs['this_ind_batch'][i_st:i_end]
+            if split_obj:
+                sub_kwargs['obj'] = kwargs['obj'][i_st:i_end]
+            forward_model.loss_weight = (i_end - i_st) / n_spots
+            forward_model.add_regularization = (i_st == 0)
+            sub_grads = list(self.get_gradients(**sub_kwargs))
+            total_loss += forward_model.current_loss
+            if split_obj:
+                obj_grads_ls.append(sub_grads[i_obj])
+            if grads is None:
+                grads = sub_grads
+            else:
+                for i, g in enumerate(sub_grads):
+                    if i != i_obj:
+                        grads[i] = grads[i] + g
+            del sub_grads
+        if split_obj:
+            grads[i_obj] = w.concatenate(obj_grads_ls, 0)
+        forward_model.loss_weight = 1.
+        forward_model.add_regularization = True
+        forward_model.current_loss = total_loss
+        return grads
+
+
+class AdjointDifferentiator(Differentiator):
+    """
+    Differentiator for multislice ptychography that runs a forward pass and an explicit backward (adjoint) pass
+    with NumPy instead of tape-based AD. Supports lsq and poisson losses and gradients with regards to the object,
+    the probe and probe positions. Gradients of regularizers are still obtained with Autograd.
+    """
+
+    supported_args = ('obj', 'probe_real', 'probe_imag', 'probe_pos_correction')
+    unsupported_options = ('pure_projection', 'optimize_probe_defocusing', 'optimize_probe_pos_offset', 'optimize_tilt')
+
+    def __init__(self, forward_model):
+        super(AdjointDifferentiator, self).__init__()
+        self.forward_model = forward_model
+        self.reg_grad_func = None
+        self.reg_value = 0
+
+    def create_loss_node(self, loss, opt_args_ls=None):
+        """
+        Check that the forward model and the variables to optimize are supported. loss is not used.
+        """
+        fm = self.forward_model
+        if not isinstance(fm, PtychographyModel):
+            raise NotImplementedError('The adjoint engine does not support {}.'.format(type(fm).__name__))
+        if fm.loss_function_type not in ['lsq', 'poisson']:
+            raise NotImplementedError('The adjoint engine supports only lsq and poisson losses.')
+        for opt in self.unsupported_options:
+            if fm.common_vars[opt]:
+                raise NotImplementedError('{} is not supported by the adjoint engine.'.format(opt))
+        if fm.common_vars['beamstop'] is not None:
+            raise NotImplementedError('Beamstop is not supported by the adjoint engine.')
+        for i in opt_args_ls:
+            if fm.argument_ls[i] not in self.supported_args:
+                raise NotImplementedError('Gradient with regards to {} is not supported by the adjoint engine.'.format(fm.argument_ls[i]))
+        self.opt_args_ls = opt_args_ls
+
+    def get_regularization_gradient(self, obj):
+        fm = self.forward_model
+        if len(fm.regularizer_dict) == 0:
+            self.reg_value = 0
+            return None
+        if self.reg_grad_func is None:
+            def calculate_reg(obj):
+                reg = fm.get_regularization_value(obj)
+                self.reg_value = float(w.to_numpy(reg))
+                return reg
+            self.reg_grad_func = w.prepare_loss_node(calculate_reg, [0])
+        return self.reg_grad_func(obj)[0]
+
+    def rotate_object(self, obj, this_i_theta, reverse=False):
+        """
+        Rotate the object to this_i_theta in the same way as the forward model. With reverse=True, the object
+        gradient is rotated back by the inverse rotation.
+        """
+        fm = self.forward_model
+        if fm.two_d_mode or fm.distribution_mode or fm.rotate_out_of_loop:
+            return obj
+        return fm.rotate_object(obj, this_i_theta, reverse=reverse)
+
+    def free_propagate(self, wave, adjoint=False):
+        """
+        Propagate exit waves to the detector, or apply the adjoint of that propagation.
+        """
+        fm = self.forward_model
+        free_prop_cm = fm.free_prop_cm
+        if free_prop_cm in [0, None]:
+            return wave
+        if isinstance(free_prop_cm, str) and free_prop_cm == 'inf':
+            norm = 'ortho' if fm.normalize_fft else None
+            n = wave.shape[-2] * wave.shape[-1]
+            if not adjoint:
+                if fm.sign_convention == 1:
+                    wave = np.fft.fft2(wave, norm=norm)
+                else:
+                    wave = np.fft.ifft2(wave, norm=norm)
+                return np.fft.fftshift(wave, axes=(-2, -1))
+            wave = np.fft.ifftshift(wave, axes=(-2, -1))
+            if fm.sign_convention == 1:
+                return np.fft.ifft2(wave, norm=norm) * (1 if fm.normalize_fft else n)
+            else:
+                return np.fft.fft2(wave, norm=norm) / (1 if fm.normalize_fft else n)
+        h_free = self.get_free_kernel(free_prop_cm, wave.shape[-2:])
+        if adjoint:
+            h_free = np.conj(h_free)
+        return np.fft.ifft2(np.fft.fft2(wave) * h_free)
+
+    def get_free_kernel(self, free_prop_cm, grid_shape):
+        fm = self.forward_model
+        return get_kernel(free_prop_cm * 1e7, fm.lmbda_nm, fm.voxel_nm, grid_shape, sign_convention=fm.sign_convention)
+
+    def get_mismatch_loss_and_gradient(self, this_pred_batch, this_prj_batch, n_el):
+        """
+        Get the summed mismatch loss of a subbatch divided by n_el, and its gradient with regards to the
+        predicted magnitude. Must match ForwardModel.get_mismatch_loss.
+        """
+        fm = self.forward_model
+        data_type = fm.get_measured_data_type()
+        if fm.loss_function_type == 'lsq':
+            y = this_prj_batch if data_type == 'magnitude' else np.sqrt(this_prj_batch)
+            r = this_pred_batch - y
+            return np.sum(r ** 2) / n_el, 2 * r / n_el
+        else:
+            m = fm.poisson_multiplier
+            y2 = this_prj_batch ** 2 if data_type == 'magnitude' else this_prj_batch
+            loss = np.sum(this_pred_batch ** 2 * m - y2 * m * np.log(this_pred_batch ** 2 * m)) / n_el
+            return loss, (2 * m * this_pred_batch - 2 * m * y2 / this_pred_batch) / n_el
+
+    def get_gradients(self, **kwargs):
+        fm = self.forward_model
+        obj = kwargs['obj']
+        probe_real = kwargs['probe_real']
+        probe_imag = kwargs['probe_imag']
+        this_i_theta = kwargs['this_i_theta']
+        prj = kwargs['prj']
+        probe_pos_correction = kwargs['probe_pos_correction']
+        this_ind_batch = kwargs['this_ind_batch']
+        this_pos_batch = np.round(kwargs['this_pos_batch']).astype(int)
+
+        minibatch_size = len(this_pos_batch)
+        n_dp_batch = fm.n_dp_batch
+        probe_size = fm.probe_size
+        unknown_type = fm.unknown_type
+        s = fm.sign_convention
+        delta_nm = fm.voxel_nm[-1]
+        k1 = 2. * PI * delta_nm / fm.lmbda_nm if fm.scale_ri_by_k else 1.
+        complex_dtype = 'complex128' if global_settings.compute_dtype == 'float64' else 'complex64'
+        h = fm.h.astype(complex_dtype)
+        h_conj = np.conj(h)
+
+        this_prj_batch = w.to_numpy(fm.get_measured_batch(prj, this_i_theta, this_ind_batch))
+        n_el = this_prj_batch.size
+
+        obj_rot = w.to_numpy(self.rotate_object(obj, this_i_theta))
+        probe = (w.to_numpy(probe_real) + 1j * w.to_numpy(probe_imag)).astype(complex_dtype)
+        flag_shift_probe = fm.is_probe_shift_needed(probe_pos_correction)
+        if flag_shift_probe:
+            probe_pos_correction = w.to_numpy(probe_pos_correction)
+            probe_f = np.fft.fft2(probe)
+            freq_y, freq_x = gen_freq_mesh([1., 1.], probe_size)
+            n_px = probe_size[0] * probe_size[1]
+
+        g_obj_ls = []
+        g_obj = np.zeros_like(obj_rot) if fm.distribution_mode is None else None
+        g_probe = np.zeros_like(probe)
+        g_pos = np.zeros_like(probe_pos_correction) if flag_shift_probe else None
+        loss = 0
+
+        for i_st in range(0, minibatch_size, n_dp_batch):
+            i_end = min(i_st + n_dp_batch, minibatch_size)
+            pos_batch = this_pos_batch[i_st:i_end]
+            ind_batch = this_ind_batch[i_st:i_end]
+
+            if fm.distribution_mode is None:
+                subobj = extract_patches(obj_rot, pos_batch, probe_size,
+                                         indices=fm.get_patch_indices(this_i_theta, ind_batch))
+            else:
+                subobj = obj_rot[i_st:i_end]
+            # Slice transmission functions in [n, 1, y, x, n_slices], broadcast against probe modes.
+            if unknown_type == 'delta_beta':
+                c = np.exp(-k1 * subobj[:, None, ..., 1] - 1j * s * k1 * subobj[:, None, ..., 0])
+            else:
+                c = subobj[:, None, ..., 0] + 1j * subobj[:, None, ..., 1]
+            c = c.astype(complex_dtype)
+
+            # Wavefields in [n, n_probe_modes, y, x].
+            if flag_shift_probe:
+                this_shift = probe_pos_correction[this_i_theta, ind_batch]
+                ramp = np.exp(-2j * PI * (freq_y * this_shift[:, 0, None, None] + freq_x * this_shift[:, 1, None, None]))
+                ramp = ramp[:, None].astype(complex_dtype)
+                wave = np.fft.ifft2(probe_f * ramp)
+            else:
+                wave = np.tile(probe[None], [len(pos_batch), 1, 1, 1])
+
+            # Forward pass. The wavefield entering each slice is kept for the backward pass.
+            n_slices = c.shape[-1]
+            wave_ls = []
+            for i in range(n_slices):
+                wave_ls.append(wave)
+                wave = wave * c[..., i]
+                if i < n_slices - 1:
+                    wave = np.fft.ifft2(np.fft.fft2(wave) * h)
+            wave = self.free_propagate(wave)
+            this_pred_batch = np.sqrt(np.sum(wave.real ** 2 + wave.imag ** 2, axis=1))
+            this_loss, g_pred = self.get_mismatch_loss_and_gradient(this_pred_batch, this_prj_batch[i_st:i_end], n_el)
+            loss += this_loss
+
+            # Backward pass. Gradients of real-valued loss with regards to complex arrays are carried as
+            # dL/d(real) + i * dL/d(imag).
+            g_wave = (g_pred / np.maximum(this_pred_batch, 1e-30))[:, None] * wave
+            g_wave = self.free_propagate(g_wave, adjoint=True)
+            g_c = np.zeros_like(c)
+            for i in range(n_slices - 1, -1, -1):
+                if i < n_slices - 1:
+                    g_wave = np.fft.ifft2(np.fft.fft2(g_wave) * h_conj)
+                g_c[..., i] = np.sum(g_wave * np.conj(wave_ls[i]), axis=1, keepdims=True)
+                g_wave = g_wave * np.conj(c[..., i])
+            del wave_ls
+
+            if unknown_type == 'delta_beta':
+                q = np.conj(g_c[:, 0]) * c[:, 0]
+                g_subobj = np.stack([s * k1 * q.imag, -k1 * q.real], axis=-1)
+            else:
+                g_subobj = np.stack([g_c[:, 0].real, g_c[:, 0].imag], axis=-1)
+            if fm.distribution_mode is None:
+                g_obj += scatter_add_patches(g_subobj, pos_batch, obj_rot.shape)
+            else:
+                g_obj_ls.append(g_subobj)
+
+            if flag_shift_probe:
+                g_wave_f = np.fft.fft2(g_wave)
+                g_probe += np.fft.ifft2(np.sum(g_wave_f * np.conj(ramp), axis=0))
+                # d(wave)/d(shift) = ifft2(probe_f * ramp * (-2 * pi * i * freq)).
+                q = np.sum(np.conj(g_wave_f) * probe_f * ramp, axis=1) * (-2j * PI) / n_px
+                g_this_pos = np.stack([np.sum(q * freq_y, axis=(-2, -1)).real, np.sum(q * freq_x, axis=(-2, -1)).real], -1)
+                np.add.at(g_pos, (this_i_theta, np.array(ind_batch)), g_this_pos)
+            else:
+                g_probe += np.sum(g_wave, axis=0)
+
+        if fm.distribution_mode is None:
+            g_obj = self.rotate_object(g_obj, this_i_theta, reverse=True)
+        else:
+            g_obj = np.concatenate(g_obj_ls, 0)
+        g_obj = g_obj.astype(w.get_dtype(obj))
+        g_reg = self.get_regularization_gradient(obj)
+        if g_reg is not None:
+            g_obj = g_obj + g_reg
+        fm.current_loss = float(loss) + self.reg_value
+        fm.i_call += 1
+
+        grad_dict = {'obj': g_obj,
+                     'probe_real': g_probe.real.astype(w.get_dtype(probe_real)),
+                     'probe_imag': g_probe.imag.astype(w.get_dtype(probe_imag)),
+                     'probe_pos_correction': g_pos}
+        return [grad_dict[fm.argument_ls[i]] for i in self.opt_args_ls]
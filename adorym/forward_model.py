@@ -5,8 +5,10 @@ import gc
 import time
 
 import adorym.wrappers as w
+import adorym.global_settings as global_settings
 from adorym.util import *
-from adorym.propagate import multislice_propagate_batch, get_kernel
+from adorym.propagate import multislice_propagate_batch, get_kernel, kernel_to_variable, get_freq_grid_variable
+from adorym.rotation import rotate_fft_shear
 
 class ForwardModel(object):
 
@@ -30,6 +32,185 @@ class ForwardModel(object):
         self.stdout_options = common_vars_dict['stdout_options']
         self.poisson_multiplier = common_vars_dict['poisson_multiplier']
         self.common_probe_pos = common_vars_dict['common_probe_pos']
+        self.use_native_complex = common_vars_dict['use_native_complex']
+        self.checkpoint_slices = common_vars_dict['checkpoint_slices']
+        self.flag_probe_pos_correction_nonzero = None
+        self.shifted_probe_bank = {}
+        self.patch_index_table = {}
+        # DataPrefetcher from which measured data are taken; data are read from prj directly if None.
+        self.prefetcher = None
+        # Memory-mapped array of preprocessed data from get_preprocessed_data_cache, used in place of prj if given.
+        # prj_cache_quantity should then be set to the quantity stored in the cache. raw_data_type is kept, as
+        # predictions depend on it.
+        self.prj_cache = None
+        self.prj_cache_quantity = None
+        # If True, data in prj_cache are in FFT order, and far-field predictions are not fftshifted to match.
+        # Only supported by PtychographyModel and its subclasses.
+        self.prj_cache_fft_order = False
+        # ShardedData preloaded from prj, used in place of prj if given.
+        self.prj_shard = None
+        # When gradients are accumulated over sub-batches, the mismatch loss of each sub-batch is weighted by its
+        # share of the minibatch, and regularizers are added to one sub-batch only.
+        self.loss_weight = 1.
+        self.add_regularization = True
+
+    # Entries of common_vars that setup() resolves into attributes of the same names.
+    setup_keys = ['device_obj', 'lmbda_nm', 'voxel_nm', 'energy_ev', 'psize_cm', 'ds_level', 'h', 'fresnel_approx',
+                  'probe_size', 'subprobe_size', 'this_obj_size', 'minibatch_size', 'n_dp_batch', 'n_probe_modes',
+                  'two_d_mode', 'pure_projection', 'free_prop_cm', 'n_theta', 'theta_ls', 'theta_downsample',
+                  'precalculate_rotation_coords', 'pin_rotation_coords', 'rotation_coord_store', 'rotation_method',
+                  'beamstop', 'debug', 'output_folder',
+                  'u', 'v', 'u_free', 'v_free', 'fourier_disparity', 'cache_shifted_probes',
+                  'optimize_probe', 'optimize_probe_defocusing', 'optimize_probe_pos_offset', 'optimize_all_probe_pos',
+                  'optimize_tilt', 'optimize_prj_affine', 'optimize_free_prop', 'optimize_ctf_lg_kappa',
+                  'probe_pos_int', 'probe_pos_int_ls']
+
+    def setup(self, common_vars_dict=None):
+        """
+        Resolve configuration from common_vars and precompute arrays that stay constant within a multiscale level,
+        so that predict only does the math. Must be called once after all entries in common_vars are created and
+        before the first call of predict.
+        :param common_vars_dict: if given, replaces the common_vars passed to the constructor.
+        """
+        if common_vars_dict is not None:
+            self.common_vars = common_vars_dict
+        for key in self.setup_keys:
+            setattr(self, key, self.common_vars.get(key))
+        self.patch_index_table = {}
+        self.shifted_probe_bank = {}
+        self.flag_probe_pos_correction_nonzero = None
+        if self.h is not None and not self.pure_projection:
+            kernel_to_variable(self.h, device=self.device_obj)
+        get_freq_grid_variable(self.probe_size, device=self.device_obj)
+        if self.distribution_mode is None and self.common_probe_pos and self.probe_pos_int is not None:
+            self.get_patch_index_table(0)
+
+    def get_rotation_coords(self, this_i_theta):
+        """
+        Get precalculated rotation coordinates of an angle from the rotation coordinate store. If
+        pin_rotation_coords is True, decoded coordinates are kept in memory after first use.
+        """
+        return self.rotation_coord_store.get_coords(this_i_theta, keep_in_memory=self.pin_rotation_coords)
+
+    def get_rotation_matrix(self, this_i_theta, transpose=False, interpolation='bilinear', as_tensor=False,
+                            dtype=None):
+        """
+        Get the interpolation matrix of an angle from the rotation coordinate store, or its transpose used to rotate
+        back. Like coordinates, matrices are kept in memory if pin_rotation_coords is True.
+        :param as_tensor: if True, get a PyTorch sparse tensor on device_obj in dtype (compute_dtype if None)
+                          instead of a scipy.sparse matrix.
+        """
+        store = self.rotation_coord_store
+        if as_tensor:
+            dtype = dtype if dtype is not None else global_settings.compute_dtype
+            return store.get_sparse_tensor(this_i_theta, interpolation=interpolation, transpose=transpose,
+                                           device=self.device_obj, dtype=dtype, keep_in_memory=self.pin_rotation_coords)
+        return store.get_interpolation_matrix(this_i_theta, interpolation=interpolation, transpose=transpose,
+                                              keep_in_memory=self.pin_rotation_coords)
+
+    def rotate_object(self, obj, this_i_theta, reverse=False, roi=None):
+        """
+        Rotate obj to an angle using rotation_method, or rotate it back if reverse is True. Except without
+        precalculated coordinates, rotating back applies the exact transpose of the forward rotation, as needed
+        for gradients. For 'bilinear' with precalculated coordinates, the normalized sampling grid (PyTorch) or
+        the interpolation matrix is taken from the store as well.
+        :param roi: optional [y_start, y_end, x_start, x_end] of the rotated object to be returned, e.g. from
+                    get_rotation_roi. Rows outside are not rotated at all, and with precalculated coordinates, only
+                    voxels of the rotated object within [x_start, x_end) are interpolated. Forward rotation only.
+        """
+        theta = self.theta_ls[this_i_theta]
+        if roi is not None:
+            assert not reverse, 'Rotation of a region of interest is only done in the forward direction.'
+            y_st, y_end, x_st, x_end = roi
+            # Rows are rotated independently about axis 0, so the other rows are not needed.
+            obj = obj[y_st:y_end]
+        if self.rotation_method == 'fft_shear':
+            obj_rot = rotate_fft_shear(obj, theta, adjoint=reverse, device=self.device_obj)
+            return obj_rot if roi is None else obj_rot[:, x_st:x_end]
+        if not self.precalculate_rotation_coords:
+            obj_rot = rotate_no_grad(obj, -theta if reverse else theta, axis=0, device=self.device_obj)
+            return obj_rot if roi is None else obj_rot[:, x_st:x_end]
+        coord_ls = self.get_rotation_coords(this_i_theta)
+        store = self.rotation_coord_store
+        if reverse:
+            as_tensor = global_settings.backend == 'pytorch' and not isinstance(obj, np.ndarray)
+            matrix_t = self.get_rotation_matrix(this_i_theta, transpose=True, as_tensor=as_tensor,
+                                                dtype=w.get_dtype(obj) if as_tensor else None)
+            return apply_rotation_adjoint(obj, coord_ls, matrix_t=matrix_t)
+        if global_settings.backend == 'autograd':
+            matrix = self.get_rotation_matrix(this_i_theta)
+            if roi is not None:
+                # Rows of the matrix are voxels of the rotated slice in [x, z] order.
+                n_z = self.this_obj_size[2]
+                matrix = matrix[x_st * n_z:x_end * n_z]
+            return apply_rotation(obj, coord_ls, device=self.device_obj, matrix=matrix)
+        grid = store.get_grid(this_i_theta, device=self.device_obj,
+                              dtype=global_settings.compute_dtype, keep_in_memory=self.pin_rotation_coords)
+        if roi is not None:
+            grid = grid[:, x_st:x_end]
+        return apply_rotation(obj, coord_ls, device=self.device_obj, grid=grid)
+
+    def get_rotation_roi(self, this_i_theta, this_ind_batch):
+        """
+        Get the bounding box [y_start, y_end, x_start, x_end] of all object patches of a batch of spots, i.e. the
+        part of the rotated object that the batch actually needs, or None if it is the whole object. The box covers
+        the clamped patch indices, so indices from get_patch_indices stay within it after subtracting the start.
+        """
+        pos = self.probe_pos_int if self.common_probe_pos else self.probe_pos_int_ls[this_i_theta]
+        pos = np.round(np.asarray(pos)[np.array(this_ind_batch, dtype=int)]).astype(int)
+        roi = []
+        for i_dim in range(2):
+            s = self.this_obj_size[i_dim]
+            st = int(np.clip(pos[:, i_dim].min(), 0, s - 1))
+            end = int(np.clip(pos[:, i_dim].max() + self.probe_size[i_dim], st + 1, s))
+            roi += [st, end]
+        if roi == [0, self.this_obj_size[0], 0, self.this_obj_size[1]]:
+            return None
+        return roi
+
+    def get_patch_index_table(self, this_i_theta):
+        """
+        Get object patch indices of all spots of an angle, built once per angle (or once in total if probe
+        positions are common).
+        """
+        key = 0 if self.common_probe_pos else int(this_i_theta)
+        if key not in self.patch_index_table:
+            pos = self.probe_pos_int if self.common_probe_pos else self.probe_pos_int_ls[this_i_theta]
+            self.patch_index_table[key] = get_patch_index_variables(pos, self.probe_size, self.this_obj_size[:2],
+                                                                    device=self.device_obj)
+        return self.patch_index_table[key]
+
+    def get_patch_indices(self, this_i_theta, this_ind_batch):
+        """
+        Get object patch indices of a batch of spots from the index table, to be passed to extract_patches.
+        """
+        iy, ix, mask = self.get_patch_index_table(this_i_theta)
+        this_ind_batch = np.array(this_ind_batch, dtype=int)
+        if mask is not None:
+            mask = mask[this_ind_batch]
+        return iy[this_ind_batch], ix[this_ind_batch], mask
+
+    def get_measured_batch(self, prj, this_i_theta, this_ind_batch):
+        """
+        Get measured magnitudes or intensities of a batch as a constant variable, downsampled by ds_level. Data are
+        taken from the prefetcher if one is attached, or read from the preprocessed data cache or prj otherwise.
+        """
+        if self.prefetcher is not None:
+            return self.prefetcher.get(this_i_theta, this_ind_batch)
+        if self.prj_cache is not None:
+            return w.create_variable(self.prj_cache[this_i_theta, this_ind_batch], dtype=global_settings.compute_dtype,
+                                     requires_grad=False, device=self.device)
+        if self.prj_shard is not None:
+            prj = self.prj_shard
+        theta_downsample = self.theta_downsample
+        if theta_downsample is None: theta_downsample = 1
+        this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch]
+        # Integer photon counts are cast on the host, as not all backends accept unsigned integer arrays.
+        this_prj_batch = w.create_variable(np.abs(this_prj_batch).astype(global_settings.compute_dtype),
+                                           dtype=global_settings.compute_dtype, requires_grad=False, device=self.device)
+        if self.ds_level > 1:
+            this_prj_batch = this_prj_batch[:, ::self.ds_level, ::self.ds_level]
+        return this_prj_batch
 
     def add_regularizer(self, name, reg_dict):
         self.regularizer_dict[name] = reg_dict
@@ -54,6 +235,8 @@ class ForwardModel(object):
 
     def get_regularization_value(self, obj):
         reg = w.create_variable(0., device=self.device)
+        if not self.add_regularization:
+            return reg
         for name in list(self.regularizer_dict):
             if name == 'l1_norm':
                 reg = reg + l1_norm_term(obj,
@@ -75,28 +258,83 @@ class ForwardModel(object):
         print_flush('  Reg term = {}.'.format(w.to_numpy(reg)), 0, rank, **self.stdout_options)
         return reg
 
+    def is_probe_shift_needed(self, probe_pos_correction):
+        """
+        Check if probes need to be shifted by sub-pixel position corrections. If positions are not optimized,
+        the corrections are constant and the check is done only once.
+        """
+        if self.optimize_all_probe_pos:
+            return True
+        if self.flag_probe_pos_correction_nonzero is None:
+            self.flag_probe_pos_correction_nonzero = len(w.nonzero(probe_pos_correction > 1e-3)) > 0
+        return self.flag_probe_pos_correction_nonzero
+
+    def get_shifted_probes(self, probe_real, probe_imag, probe_pos_correction, this_i_theta, this_ind_batch):
+        """
+        Get probes shifted by the position corrections of a batch of spots in [n_spots, n_probe_modes, y, x].
+        If neither the probe nor the positions are optimized, shifted probes are kept in a bank and reused.
+        """
+        device_obj = self.device_obj
+        flag_use_bank = self.cache_shifted_probes and not (
+            self.optimize_all_probe_pos or self.optimize_probe or
+            self.optimize_probe_defocusing or self.optimize_probe_pos_offset)
+        if not flag_use_bank:
+            this_shift = probe_pos_correction[this_i_theta, this_ind_batch]
+            return shift_images_fourier_batch(probe_real, probe_imag, this_shift, device=device_obj)
+
+        if self.common_probe_pos:
+            key_ls = [int(i) for i in this_ind_batch]
+        else:
+            key_ls = [(int(this_i_theta), int(i)) for i in this_ind_batch]
+        missing_ind = [i for i, key in zip(this_ind_batch, key_ls) if key not in self.shifted_probe_bank]
+        if len(missing_ind) > 0:
+            with w.no_grad():
+                this_shift = probe_pos_correction[this_i_theta, np.array(missing_ind)]
+                shifted_real, shifted_imag = shift_images_fourier_batch(probe_real, probe_imag, this_shift,
+                                                                        device=device_obj)
+            for j, i in enumerate(missing_ind):
+                key = int(i) if self.common_probe_pos else (int(this_i_theta), int(i))
+                self.shifted_probe_bank[key] = (shifted_real[j], shifted_imag[j])
+        probe_real_ls = w.stack([self.shifted_probe_bank[key][0] for key in key_ls])
+        probe_imag_ls = w.stack([self.shifted_probe_bank[key][1] for key in key_ls])
+        return probe_real_ls, probe_imag_ls
+
     def get_argument_index(self, arg):
         for i, a in enumerate(self.argument_ls):
             if a == arg:
                 return i
         raise ValueError('{} is not in the argument list.'.format(arg))
 
+    def get_measured_data_type(self):
+        """
+        Get the type of data returned by get_measured_batch, i.e. the quantity returned by the prefetcher or stored
+        in prj_cache if either is used, or raw_data_type otherwise.
+        """
+        if self.prefetcher is not None and self.prefetcher.quantity is not None:
+            return self.prefetcher.quantity
+        if self.prj_cache is not None and self.prj_cache_quantity is not None:
+            return self.prj_cache_quantity
+        return self.raw_data_type
+
     def get_mismatch_loss(self, this_pred_batch, this_prj_batch):
 
+        data_type = self.get_measured_data_type()
         if self.loss_function_type == 'lsq':
-            if self.raw_data_type == 'magnitude':
+            if data_type == 'magnitude':
                 loss = w.mean((this_pred_batch - w.abs(this_prj_batch)) ** 2)
-            elif self.raw_data_type == 'intensity':
+            elif data_type == 'intensity':
                 loss = w.mean((this_pred_batch - w.sqrt(w.abs(this_prj_batch))) ** 2)
         elif self.loss_function_type == 'poisson':
-            if self.raw_data_type == 'magnitude':
+            if data_type == 'magnitude':
                 loss = w.mean(this_pred_batch ** 2 * self.poisson_multiplier -
                               w.abs(this_prj_batch) ** 2 * self.poisson_multiplier * w.log(
                     this_pred_batch ** 2 * self.poisson_multiplier))
-            elif self.raw_data_type == 'intensity':
+            elif data_type == 'intensity':
                 loss = w.mean(this_pred_batch ** 2 * self.poisson_multiplier -
                               w.abs(this_prj_batch) * self.poisson_multiplier * w.log(
                     this_pred_batch ** 2 * self.poisson_multiplier))
+        if self.loss_weight != 1:
+            loss = loss * self.loss_weight
         return loss
 
 
@@ -115,36 +353,31 @@ class PtychographyModel(ForwardModel):
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, tilt_ls):
 
-        device_obj = self.common_vars['device_obj']
-        lmbda_nm = self.common_vars['lmbda_nm']
-        voxel_nm = self.common_vars['voxel_nm']
-        probe_size = self.common_vars['probe_size']
-        fresnel_approx = self.common_vars['fresnel_approx']
-        two_d_mode = self.common_vars['two_d_mode']
-        minibatch_size = self.common_vars['minibatch_size']
-        ds_level = self.common_vars['ds_level']
-        this_obj_size = self.common_vars['this_obj_size']
-        energy_ev = self.common_vars['energy_ev']
-        psize_cm = self.common_vars['psize_cm']
-        h = self.common_vars['h']
-        pure_projection = self.common_vars['pure_projection']
-        n_dp_batch = self.common_vars['n_dp_batch']
-        free_prop_cm = self.common_vars['free_prop_cm']
-        optimize_probe_defocusing = self.common_vars['optimize_probe_defocusing']
-        optimize_probe_pos_offset = self.common_vars['optimize_probe_pos_offset']
-        optimize_all_probe_pos = self.common_vars['optimize_all_probe_pos']
-        optimize_tilt = self.common_vars['optimize_tilt']
-        debug = self.common_vars['debug']
-        output_folder = self.common_vars['output_folder']
-        unknown_type = self.common_vars['unknown_type']
-        n_probe_modes = self.common_vars['n_probe_modes']
-        n_theta = self.common_vars['n_theta']
-        precalculate_rotation_coords = self.common_vars['precalculate_rotation_coords']
-        theta_ls = self.common_vars['theta_ls']
-
-        if precalculate_rotation_coords:
-            coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                          theta_ls[this_i_theta], reverse=False)
+        device_obj = self.device_obj
+        lmbda_nm = self.lmbda_nm
+        voxel_nm = self.voxel_nm
+        probe_size = self.probe_size
+        fresnel_approx = self.fresnel_approx
+        two_d_mode = self.two_d_mode
+        # Spots are counted from the batch, which may be a sub-batch of the minibatch.
+        minibatch_size = len(this_pos_batch)
+        ds_level = self.ds_level
+        this_obj_size = self.this_obj_size
+        energy_ev = self.energy_ev
+        psize_cm = self.psize_cm
+        h = self.h
+        pure_projection = self.pure_projection
+        n_dp_batch = self.n_dp_batch
+        free_prop_cm = self.free_prop_cm
+        optimize_probe_defocusing = self.optimize_probe_defocusing
+        optimize_probe_pos_offset = self.optimize_probe_pos_offset
+        optimize_all_probe_pos = self.optimize_all_probe_pos
+        optimize_tilt = self.optimize_tilt
+        debug = self.debug
+        output_folder = self.output_folder
+        unknown_type = self.unknown_type
+        n_probe_modes = self.n_probe_modes
+        n_theta = self.n_theta
 
         flag_pp_sqrt = True
         if self.raw_data_type == 'magnitude':
@@ -168,13 +401,13 @@ class PtychographyModel(ForwardModel):
             this_offset = probe_pos_offset[this_i_theta]
             probe_real, probe_imag = realign_image_fourier(probe_real, probe_imag, this_offset, axes=(1, 2), device=device_obj)
 
+        roi = None
         if not two_d_mode and not self.distribution_mode:
             if not optimize_tilt:
                 if not self.rotate_out_of_loop:
-                    if precalculate_rotation_coords:
-                        obj_rot = apply_rotation(obj, coord_ls, device=device_obj)
-                    else:
-                        obj_rot = rotate_no_grad(obj, theta_ls[this_i_theta], axis=0)
+                    # Only the part of the object illuminated by the minibatch is rotated.
+                    roi = self.get_rotation_roi(this_i_theta, this_ind_batch)
+                    obj_rot = self.rotate_object(obj, this_i_theta, roi=roi)
                 else:
                     obj_rot = obj
             else:
@@ -191,9 +424,7 @@ class PtychographyModel(ForwardModel):
         #ex_imag_ls = []
         ex_mag_ls = []
 
-        # Pad if needed
-        if self.distribution_mode is None:
-            obj_rot, pad_arr = pad_object(obj_rot, this_obj_size, this_pos_batch, probe_size, unknown_type=unknown_type)
+        flag_shift_probe = self.is_probe_shift_needed(probe_pos_correction)
 
         pos_ind = 0
         for k, pos_batch in enumerate(probe_pos_batch_ls):
@@ -201,19 +432,13 @@ class PtychographyModel(ForwardModel):
             probe_real_ls = []
             probe_imag_ls = []
 
+            this_ind_subbatch = this_ind_batch[k * n_dp_batch:k * n_dp_batch + len(pos_batch)]
+
             # Get shifted probe list.
-            for j in range(len(pos_batch)):
-                if optimize_all_probe_pos or len(w.nonzero(probe_pos_correction > 1e-3)) > 0:
-                    this_shift = probe_pos_correction[this_i_theta, this_ind_batch[k * n_dp_batch + j]]
-                    probe_real_shifted, probe_imag_shifted = realign_image_fourier(probe_real, probe_imag,
-                                                                                   this_shift, axes=(1, 2),
-                                                                                   device=device_obj)
-                    probe_real_ls.append(probe_real_shifted)
-                    probe_imag_ls.append(probe_imag_shifted)
-            if optimize_all_probe_pos or len(w.nonzero(probe_pos_correction > 1e-3)) > 0:
+            if flag_shift_probe:
                 # Shape of probe_xxx_ls.shape is [n_dp_batch, n_probe_modes, y, x].
-                probe_real_ls = w.stack(probe_real_ls)
-                probe_imag_ls = w.stack(probe_imag_ls)
+                probe_real_ls, probe_imag_ls = self.get_shifted_probes(probe_real, probe_imag, probe_pos_correction,
+                                                                       this_i_theta, this_ind_subbatch)
             else:
                 # Shape of probe_xxx_ls.shape is [n_probe_modes, y, x].
                 probe_real_ls = probe_real
@@ -221,77 +446,47 @@ class PtychographyModel(ForwardModel):
 
             # Get object list.
             if self.distribution_mode is None:
-                if len(pos_batch) == 1:
-                    pos = pos_batch[0]
-                    pos_y = pos[0] + pad_arr[0, 0]
-                    pos_x = pos[1] + pad_arr[1, 0]
-                    if pos_y == 0 and pos_x == 0 and probe_size[0] == this_obj_size[0] and probe_size[1] == this_obj_size[1]:
-                        subobj = obj_rot
-                    else:
-                        subobj = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
-                    subobj_ls = w.reshape(subobj, [1, *subobj.shape])
+                # Patches extending beyond the object are filled with 0 in the gather, so the object is not padded.
+                pos = pos_batch[0]
+                if len(pos_batch) == 1 and pos[0] == 0 and pos[1] == 0 and probe_size[0] == this_obj_size[0] and probe_size[1] == this_obj_size[1]:
+                    subobj_ls = w.reshape(obj_rot, [1, *obj_rot.shape])
                 else:
-                    for j in range(len(pos_batch)):
-                        pos = pos_batch[j]
-                        pos_y = pos[0] + pad_arr[0, 0]
-                        pos_x = pos[1] + pad_arr[1, 0]
-                        subobj = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
-                        subobj_ls.append(subobj)
-                    subobj_ls = w.stack(subobj_ls)
+                    indices = self.get_patch_indices(this_i_theta, this_ind_subbatch)
+                    if roi is not None:
+                        indices = (indices[0] - roi[0], indices[1] - roi[2], indices[2])
+                    subobj_ls = extract_patches(obj_rot, pos_batch, probe_size, device=device_obj, indices=indices)
             else:
                 subobj_ls = obj_rot[pos_ind:pos_ind + len(pos_batch), :, :, :, :]
                 pos_ind += len(pos_batch)
 
             gc.collect()
-            if n_probe_modes == 1:
-                if len(probe_real_ls.shape) == 3:
-                    this_probe_real_ls = probe_real_ls[0, :, :]
-                    this_probe_imag_ls = probe_imag_ls[0, :, :]
-                else:
-                    this_probe_real_ls = probe_real_ls[:, 0, :, :]
-                    this_probe_imag_ls = probe_imag_ls[:, 0, :, :]
-                ex_real, ex_imag = multislice_propagate_batch(
+            # All probe modes are propagated together, with the mode axis right before the spatial axes.
+            # Shape of ex_int is [len(pos_batch), y, x].
+            if self.use_native_complex:
+                ex = multislice_propagate_batch(
                                 subobj_ls,
-                                this_probe_real_ls, this_probe_imag_ls,
+                                probe_real_ls, probe_imag_ls,
                                 energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=free_prop_cm,
                                 obj_batch_shape=[len(pos_batch), *probe_size, this_obj_size[-1]],
                                 fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
                                 type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
                                 scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
-                                pure_projection_return_sqrt=flag_pp_sqrt)
-                ex_mag_ls = w.norm([ex_real, ex_imag])
-                #ex_real = w.reshape(ex_real, [len(pos_batch), 1, *probe_size])
-                #ex_imag = w.reshape(ex_imag, [len(pos_batch), 1, *probe_size])
+                                pure_projection_return_sqrt=flag_pp_sqrt, batched_modes=True, return_complex=True,
+                                checkpoint_slices=self.checkpoint_slices, shift_far_field=not self.prj_cache_fft_order)
+                ex_int = w.sum(w.abs2_complex(ex), axis=1)
             else:
-                #ex_real = []
-                #ex_imag = []
-                for i_mode in range(n_probe_modes):
-                    if len(probe_real_ls.shape) == 3:
-                        this_probe_real_ls = probe_real_ls[i_mode, :, :]
-                        this_probe_imag_ls = probe_imag_ls[i_mode, :, :]
-                    else:
-                        this_probe_real_ls = probe_real_ls[:, i_mode, :, :]
-                        this_probe_imag_ls = probe_imag_ls[:, i_mode, :, :]
-                    temp_real, temp_imag = multislice_propagate_batch(
+                ex_real, ex_imag = multislice_propagate_batch(
                                 subobj_ls,
-                                this_probe_real_ls, this_probe_imag_ls,
+                                probe_real_ls, probe_imag_ls,
                                 energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=free_prop_cm,
                                 obj_batch_shape=[len(pos_batch), *probe_size, this_obj_size[-1]],
                                 fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
                                 type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
                                 scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
-                                pure_projection_return_sqrt=flag_pp_sqrt)
-                    if i_mode == 0:
-                        ex_int = temp_real ** 2 + temp_imag ** 2
-                    else:
-                        ex_int = ex_int + temp_real ** 2 + temp_imag ** 2
-                ex_mag_ls.append(w.sqrt(ex_int))
-                    #ex_real.append(temp_real)
-                    #ex_imag.append(temp_imag)
-                #ex_real = w.swap_axes(w.stack(ex_real), [0, 1])
-                #ex_imag = w.swap_axes(w.stack(ex_imag), [0, 1])
-            #ex_real_ls.append(ex_real)
-            #ex_imag_ls.append(ex_imag)       
+                                pure_projection_return_sqrt=flag_pp_sqrt, batched_modes=True,
+                                checkpoint_slices=self.checkpoint_slices, shift_far_field=not self.prj_cache_fft_order)
+                ex_int = w.sum(ex_real ** 2 + ex_imag ** 2, axis=1)
+            ex_mag_ls.append(w.sqrt(ex_int))
         del subobj_ls, probe_real_ls, probe_imag_ls
 
         # # Output shape is [minibatch_size, n_probe_modes, y, x].
@@ -314,6 +509,8 @@ class PtychographyModel(ForwardModel):
             # dxchange.write_tiff(np.sqrt(ex_real_val ** 2 + ex_imag_val ** 2), os.path.join(output_folder, 'intermediate', 'detected_mag'), dtype='float32', overwrite=True)
             # dxchange.write_tiff(np.arctan2(ex_real_val, ex_imag_val), os.path.join(output_folder, 'intermediate', 'detected_phase'), dtype='float32', overwrite=True)
             ex_mag_val = w.to_numpy(ex_mag_ls)
+            if self.prj_cache_fft_order:
+                ex_mag_val = np.fft.fftshift(ex_mag_val, axes=(-2, -1))
             dxchange.write_tiff(ex_mag_val, os.path.join(output_folder, 'intermediate', 'detected_mag'), dtype='float32', overwrite=True)
         self.i_call += 1
         return ex_mag_ls
@@ -326,20 +523,15 @@ class PtychographyModel(ForwardModel):
                            probe_pos_offset, this_i_theta, this_pos_batch, prj,
                            probe_pos_correction, this_ind_batch, tilt_ls)
             #this_pred_batch = w.norm(ex_real_ls, ex_imag_ls)
-            #if self.common_vars['n_probe_modes'] == 1:
+            #if self.n_probe_modes == 1:
             #    this_pred_batch = this_pred_batch[:, 0, :, :]
             #else:
             #    this_pred_batch = w.sqrt(w.sum(this_pred_batch ** 2, axis=1))
 
-            beamstop = self.common_vars['beamstop']
-            ds_level = self.common_vars['ds_level']
-            theta_downsample = self.common_vars['theta_downsample']
-            if theta_downsample is None: theta_downsample = 1
+            beamstop = self.beamstop
+            ds_level = self.ds_level
 
-            this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch]
-            this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
-            if ds_level > 1:
-                this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
+            this_prj_batch = self.get_measured_batch(prj, this_i_theta, this_ind_batch)
 
             if beamstop is not None:
                 beamstop_mask, beamstop_value = beamstop
@@ -373,25 +565,19 @@ class SingleBatchFullfieldModel(PtychographyModel):
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, tilt_ls):
 
-        device_obj = self.common_vars['device_obj']
-        probe_size = self.common_vars['probe_size']
-        fresnel_approx = self.common_vars['fresnel_approx']
-        two_d_mode = self.common_vars['two_d_mode']
-        ds_level = self.common_vars['ds_level']
-        this_obj_size = self.common_vars['this_obj_size']
-        energy_ev = self.common_vars['energy_ev']
-        psize_cm = self.common_vars['psize_cm']
-        h = self.common_vars['h']
-        pure_projection = self.common_vars['pure_projection']
-        free_prop_cm = self.common_vars['free_prop_cm']
-        unknown_type = self.common_vars['unknown_type']
-        n_theta = self.common_vars['n_theta']
-        precalculate_rotation_coords = self.common_vars['precalculate_rotation_coords']
-        theta_ls = self.common_vars['theta_ls']
-
-        if precalculate_rotation_coords:
-            coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                          theta_ls[this_i_theta], reverse=False)
+        device_obj = self.device_obj
+        probe_size = self.probe_size
+        fresnel_approx = self.fresnel_approx
+        two_d_mode = self.two_d_mode
+        ds_level = self.ds_level
+        this_obj_size = self.this_obj_size
+        energy_ev = self.energy_ev
+        psize_cm = self.psize_cm
+        h = self.h
+        pure_projection = self.pure_projection
+        free_prop_cm = self.free_prop_cm
+        unknown_type = self.unknown_type
+        n_theta = self.n_theta
 
         flag_pp_sqrt = True
         if self.raw_data_type == 'magnitude':
@@ -399,10 +585,7 @@ class SingleBatchFullfieldModel(PtychographyModel):
 
         if not two_d_mode and not self.distribution_mode:
             if not self.rotate_out_of_loop:
-                if precalculate_rotation_coords:
-                    obj_rot = apply_rotation(obj, coord_ls, device=device_obj)
-                else:
-                    obj_rot = rotate_no_grad(obj, theta_ls[this_i_theta], axis=0, device=device_obj)
+                obj_rot = self.rotate_object(obj, this_i_theta)
             else:
                 obj_rot = obj
         else:
@@ -419,7 +602,8 @@ class SingleBatchFullfieldModel(PtychographyModel):
             fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
             type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
             scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
-            pure_projection_return_sqrt=flag_pp_sqrt)
+            pure_projection_return_sqrt=flag_pp_sqrt, checkpoint_slices=self.checkpoint_slices,
+            shift_far_field=not self.prj_cache_fft_order)
 
         return ex_real, ex_imag
 
@@ -432,14 +616,9 @@ class SingleBatchFullfieldModel(PtychographyModel):
                                                   probe_pos_correction, this_ind_batch, tilt_ls)
             this_pred_batch = w.norm(ex_real_ls, ex_imag_ls)
 
-            ds_level = self.common_vars['ds_level']
-            theta_downsample = self.common_vars['theta_downsample']
-            if theta_downsample is None: theta_downsample = 1
+            ds_level = self.ds_level
 
-            this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch]
-            this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
-            if ds_level > 1:
-                this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
+            this_prj_batch = self.get_measured_batch(prj, this_i_theta, this_ind_batch)
 
             loss = self.get_mismatch_loss(this_pred_batch, this_prj_batch)
             loss = loss + self.get_regularization_value(obj)
@@ -461,25 +640,19 @@ class SingleBatchPtychographyModel(PtychographyModel):
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, tilt_ls):
 
-        device_obj = self.common_vars['device_obj']
-        probe_size = self.common_vars['probe_size']
-        fresnel_approx = self.common_vars['fresnel_approx']
-        two_d_mode = self.common_vars['two_d_mode']
-        ds_level = self.common_vars['ds_level']
-        this_obj_size = self.common_vars['this_obj_size']
-        energy_ev = self.common_vars['energy_ev']
-        psize_cm = self.common_vars['psize_cm']
-        h = self.common_vars['h']
-        pure_projection = self.common_vars['pure_projection']
-        free_prop_cm = self.common_vars['free_prop_cm']
-        unknown_type = self.common_vars['unknown_type']
-        n_theta = self.common_vars['n_theta']
-        precalculate_rotation_coords = self.common_vars['precalculate_rotation_coords']
-        theta_ls = self.common_vars['theta_ls']
-
-        if precalculate_rotation_coords:
-            coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                          theta_ls[this_i_theta], reverse=False)
+        device_obj = self.device_obj
+        probe_size = self.probe_size
+        fresnel_approx = self.fresnel_approx
+        two_d_mode = self.two_d_mode
+        ds_level = self.ds_level
+        this_obj_size = self.this_obj_size
+        energy_ev = self.energy_ev
+        psize_cm = self.psize_cm
+        h = self.h
+        pure_projection = self.pure_projection
+        free_prop_cm = self.free_prop_cm
+        unknown_type = self.unknown_type
+        n_theta = self.n_theta
 
         flag_pp_sqrt = True
         if self.raw_data_type == 'magnitude':
@@ -487,26 +660,14 @@ class SingleBatchPtychographyModel(PtychographyModel):
 
         if not two_d_mode and not self.distribution_mode:
             if not self.rotate_out_of_loop:
-                if precalculate_rotation_coords:
-                    obj_rot = apply_rotation(obj, coord_ls, device=device_obj)
-                else:
-                    obj_rot = rotate_no_grad(obj, theta_ls[this_i_theta], axis=0, device=device_obj)
+                obj_rot = self.rotate_object(obj, this_i_theta)
             else:
                 obj_rot = obj
         else:
             obj_rot = obj
 
         if self.distribution_mode is None:
-            obj_rot, pad_arr = pad_object(obj_rot, this_obj_size, this_pos_batch, probe_size, unknown_type=unknown_type)
-        else:
-            pad_arr = np.array([[0, 0], [0, 0]])
-
-        if self.distribution_mode is None:
-            pos = this_pos_batch[0]
-            pos_y = pos[0] + pad_arr[0, 0]
-            pos_x = pos[1] + pad_arr[1, 0]
-            obj_rot = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
-            obj_rot = w.reshape(obj_rot, [1, *obj_rot.shape])
+            obj_rot = extract_patches(obj_rot, this_pos_batch[0:1], probe_size, device=device_obj)
 
         ex_real, ex_imag = multislice_propagate_batch(
             obj_rot,
@@ -516,7 +677,8 @@ class SingleBatchPtychographyModel(PtychographyModel):
             fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
             type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
             scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
-            pure_projection_return_sqrt=flag_pp_sqrt)
+            pure_projection_return_sqrt=flag_pp_sqrt, checkpoint_slices=self.checkpoint_slices,
+            shift_far_field=not self.prj_cache_fft_order)
 
         return ex_real, ex_imag
 
@@ -531,14 +693,9 @@ class SingleBatchPtychographyModel(PtychographyModel):
             if len(this_pred_batch) == 3:
                 this_pred_batch = this_pred_batch[0]
 
-            ds_level = self.common_vars['ds_level']
-            theta_downsample = self.common_vars['theta_downsample']
-            if theta_downsample is None: theta_downsample = 1
+            ds_level = self.ds_level
 
-            this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch]
-            this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
-            if ds_level > 1:
-                this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
+            this_prj_batch = self.get_measured_batch(prj, this_i_theta, this_ind_batch)
 
             loss = self.get_mismatch_loss(this_pred_batch, this_prj_batch)
             loss = loss + self.get_regularization_value(obj)
@@ -563,37 +720,32 @@ class SparseMultisliceModel(ForwardModel):
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, slice_pos_cm_ls):
 
-        device_obj = self.common_vars['device_obj']
-        lmbda_nm = self.common_vars['lmbda_nm']
-        voxel_nm = self.common_vars['voxel_nm']
-        probe_size = self.common_vars['probe_size']
-        fresnel_approx = self.common_vars['fresnel_approx']
-        two_d_mode = self.common_vars['two_d_mode']
-        minibatch_size = self.common_vars['minibatch_size']
-        ds_level = self.common_vars['ds_level']
-        this_obj_size = self.common_vars['this_obj_size']
-        energy_ev = self.common_vars['energy_ev']
-        psize_cm = self.common_vars['psize_cm']
-        h = self.common_vars['h']
-        pure_projection = self.common_vars['pure_projection']
-        n_dp_batch = self.common_vars['n_dp_batch']
-        free_prop_cm = self.common_vars['free_prop_cm']
-        optimize_probe_defocusing = self.common_vars['optimize_probe_defocusing']
-        optimize_probe_pos_offset = self.common_vars['optimize_probe_pos_offset']
-        optimize_all_probe_pos = self.common_vars['optimize_all_probe_pos']
-        debug = self.common_vars['debug']
-        output_folder = self.common_vars['output_folder']
-        unknown_type = self.common_vars['unknown_type']
-        n_probe_modes = self.common_vars['n_probe_modes']
-        n_theta = self.common_vars['n_theta']
-        precalculate_rotation_coords = self.common_vars['precalculate_rotation_coords']
-        theta_ls = self.common_vars['theta_ls']
-        u = self.common_vars['u']
-        v = self.common_vars['v']
-
-        if precalculate_rotation_coords:
-            coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                          theta_ls[this_i_theta], reverse=False)
+        device_obj = self.device_obj
+        lmbda_nm = self.lmbda_nm
+        voxel_nm = self.voxel_nm
+        probe_size = self.probe_size
+        fresnel_approx = self.fresnel_approx
+        two_d_mode = self.two_d_mode
+        # Spots are counted from the batch, which may be a sub-batch of the minibatch.
+        minibatch_size = len(this_pos_batch)
+        ds_level = self.ds_level
+        this_obj_size = self.this_obj_size
+        energy_ev = self.energy_ev
+        psize_cm = self.psize_cm
+        h = self.h
+        pure_projection = self.pure_projection
+        n_dp_batch = self.n_dp_batch
+        free_prop_cm = self.free_prop_cm
+        optimize_probe_defocusing = self.optimize_probe_defocusing
+        optimize_probe_pos_offset = self.optimize_probe_pos_offset
+        optimize_all_probe_pos = self.optimize_all_probe_pos
+        debug = self.debug
+        output_folder = self.output_folder
+        unknown_type = self.unknown_type
+        n_probe_modes = self.n_probe_modes
+        n_theta = self.n_theta
+        u = self.u
+        v = self.v
 
         # Allocate subbatches.
         probe_pos_batch_ls = []
@@ -615,10 +767,7 @@ class SparseMultisliceModel(ForwardModel):
 
         if not two_d_mode and not self.distribution_mode:
             if not self.rotate_out_of_loop:
-                if precalculate_rotation_coords:
-                    obj_rot = apply_rotation(obj, coord_ls, device=device_obj)
-                else:
-                    obj_rot = rotate_no_grad(obj, theta_ls[this_i_theta], device=device_obj)
+                obj_rot = self.rotate_object(obj, this_i_theta)
             else:
                 obj_rot = obj
         else:
@@ -626,9 +775,7 @@ class SparseMultisliceModel(ForwardModel):
         ex_real_ls = []
         ex_imag_ls = []
 
-        # Pad if needed
-        if not self.distribution_mode:
-            obj_rot, pad_arr = pad_object(obj_rot, this_obj_size, this_pos_batch, probe_size, unknown_type=unknown_type)
+        flag_shift_probe = self.is_probe_shift_needed(probe_pos_correction)
 
         pos_ind = 0
         for k, pos_batch in enumerate(probe_pos_batch_ls):
@@ -636,19 +783,13 @@ class SparseMultisliceModel(ForwardModel):
             probe_real_ls = []
             probe_imag_ls = []
 
+            this_ind_subbatch = this_ind_batch[k * n_dp_batch:k * n_dp_batch + len(pos_batch)]
+
             # Get shifted probe list.
-            for j in range(len(pos_batch)):
-                if optimize_all_probe_pos or len(w.nonzero(probe_pos_correction > 1e-3)) > 0:
-                    this_shift = probe_pos_correction[this_i_theta, this_ind_batch[k * n_dp_batch + j]]
-                    probe_real_shifted, probe_imag_shifted = realign_image_fourier(probe_real, probe_imag,
-                                                                                   this_shift, axes=(1, 2),
-                                                                                   device=device_obj)
-                    probe_real_ls.append(probe_real_shifted)
-                    probe_imag_ls.append(probe_imag_shifted)
-            if optimize_all_probe_pos or len(w.nonzero(probe_pos_correction > 1e-3)) > 0:
+            if flag_shift_probe:
                 # Shape of probe_xxx_ls.shape is [n_dp_batch, n_probe_modes, y, x].
-                probe_real_ls = w.stack(probe_real_ls)
-                probe_imag_ls = w.stack(probe_imag_ls)
+                probe_real_ls, probe_imag_ls = self.get_shifted_probes(probe_real, probe_imag, probe_pos_correction,
+                                                                       this_i_theta, this_ind_subbatch)
             else:
                 # Shape of probe_xxx_ls.shape is [n_probe_modes, y, x].
                 probe_real_ls = probe_real
@@ -656,20 +797,8 @@ class SparseMultisliceModel(ForwardModel):
 
             # Get object list.
             if not self.distribution_mode:
-                if len(pos_batch) == 1:
-                    pos = pos_batch[0]
-                    pos_y = pos[0] + pad_arr[0, 0]
-                    pos_x = pos[1] + pad_arr[1, 0]
-                    subobj = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
-                    subobj_ls = w.reshape(subobj, [1, *subobj.shape])
-                else:
-                    for j in range(len(pos_batch)):
-                        pos = pos_batch[j]
-                        pos_y = pos[0] + pad_arr[0, 0]
-                        pos_x = pos[1] + pad_arr[1, 0]
-                        subobj = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
-                        subobj_ls.append(subobj)
-                    subobj_ls = w.stack(subobj_ls)
+                subobj_ls = extract_patches(obj_rot, pos_batch, probe_size, device=device_obj,
+                                            indices=self.get_patch_indices(this_i_theta, this_ind_subbatch))
             else:
                 subobj_ls = obj[pos_ind:pos_ind + len(pos_batch), :, :, :, :]
                 pos_ind += len(pos_batch)
@@ -739,20 +868,15 @@ class SparseMultisliceModel(ForwardModel):
                            probe_pos_offset, this_i_theta, this_pos_batch, prj,
                            probe_pos_correction, this_ind_batch, slice_pos_cm_ls)
             this_pred_batch = w.norm(ex_real_ls, ex_imag_ls)
-            if self.common_vars['n_probe_modes'] == 1:
+            if self.n_probe_modes == 1:
                 this_pred_batch = this_pred_batch[:, 0, :, :]
             else:
                 this_pred_batch = w.sqrt(w.sum(this_pred_batch ** 2, axis=1))
 
-            beamstop = self.common_vars['beamstop']
-            ds_level = self.common_vars['ds_level']
-            theta_downsample = self.common_vars['theta_downsample']
-            if theta_downsample is None: theta_downsample = 1
+            beamstop = self.beamstop
+            ds_level = self.ds_level
 
-            this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch]
-            this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
-            if ds_level > 1:
-                this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
+            this_prj_batch = self.get_measured_batch(prj, this_i_theta, this_ind_batch)
 
             if beamstop is not None:
                 beamstop_mask, beamstop_value = beamstop
@@ -789,42 +913,37 @@ class MultiDistModel(ForwardModel):
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
                 probe_pos_correction, this_ind_batch, free_prop_cm, safe_zone_width, prj_affine_ls, ctf_lg_kappa):
 
-        device_obj = self.common_vars['device_obj']
-        lmbda_nm = self.common_vars['lmbda_nm']
-        voxel_nm = self.common_vars['voxel_nm']
-        probe_size = self.common_vars['probe_size']
-        subprobe_size = self.common_vars['subprobe_size']
-        fresnel_approx = self.common_vars['fresnel_approx']
-        two_d_mode = self.common_vars['two_d_mode']
-        minibatch_size = self.common_vars['minibatch_size']
-        ds_level = self.common_vars['ds_level']
-        this_obj_size = self.common_vars['this_obj_size']
-        energy_ev = self.common_vars['energy_ev']
-        psize_cm = self.common_vars['psize_cm']
-        h = self.common_vars['h']
-        pure_projection = self.common_vars['pure_projection']
-        n_dp_batch = self.common_vars['n_dp_batch']
-        optimize_probe_defocusing = self.common_vars['optimize_probe_defocusing']
-        optimize_probe_pos_offset = self.common_vars['optimize_probe_pos_offset']
-        optimize_all_probe_pos = self.common_vars['optimize_all_probe_pos']
-        optimize_free_prop = self.common_vars['optimize_free_prop']
-        debug = self.common_vars['debug']
-        output_folder = self.common_vars['output_folder']
-        unknown_type = self.common_vars['unknown_type']
-        beamstop = self.common_vars['beamstop']
-        n_probe_modes = self.common_vars['n_probe_modes']
-        n_theta = self.common_vars['n_theta']
-        precalculate_rotation_coords = self.common_vars['precalculate_rotation_coords']
-        theta_ls = self.common_vars['theta_ls']
-        u_free = self.common_vars['u_free']
-        v_free = self.common_vars['v_free']
-        optimize_ctf_lg_kappa = self.common_vars['optimize_ctf_lg_kappa']
+        device_obj = self.device_obj
+        lmbda_nm = self.lmbda_nm
+        voxel_nm = self.voxel_nm
+        probe_size = self.probe_size
+        subprobe_size = self.subprobe_size
+        fresnel_approx = self.fresnel_approx
+        two_d_mode = self.two_d_mode
+        # Spots are counted from the batch, which may be a sub-batch of the minibatch.
+        minibatch_size = len(this_pos_batch)
+        ds_level = self.ds_level
+        this_obj_size = self.this_obj_size
+        energy_ev = self.energy_ev
+        psize_cm = self.psize_cm
+        h = self.h
+        pure_projection = self.pure_projection
+        n_dp_batch = self.n_dp_batch
+        optimize_probe_defocusing = self.optimize_probe_defocusing
+        optimize_probe_pos_offset = self.optimize_probe_pos_offset
+        optimize_all_probe_pos = self.optimize_all_probe_pos
+        optimize_free_prop = self.optimize_free_prop
+        debug = self.debug
+        output_folder = self.output_folder
+        unknown_type = self.unknown_type
+        beamstop = self.beamstop
+        n_probe_modes = self.n_probe_modes
+        n_theta = self.n_theta
+        u_free = self.u_free
+        v_free = self.v_free
+        optimize_ctf_lg_kappa = self.optimize_ctf_lg_kappa
 
         kappa = 10 ** ctf_lg_kappa[0] if optimize_ctf_lg_kappa else None
-        if precalculate_rotation_coords:
-            coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                          theta_ls[this_i_theta], reverse=False)
-
         n_dists = len(free_prop_cm)
         n_blocks = prj.shape[1] // n_dists
 
@@ -843,90 +962,43 @@ class MultiDistModel(ForwardModel):
 
         if not two_d_mode:
             if not self.rotate_out_of_loop:
-                if precalculate_rotation_coords:
-                    obj_rot = apply_rotation(obj, coord_ls, device=device_obj)
-                else:
-                    obj_rot = rotate_no_grad(obj, theta_ls[this_i_theta], device=device_obj)
+                obj_rot = self.rotate_object(obj, this_i_theta)
             else:
                 obj_rot = obj
         else:
             obj_rot = obj
 
-        # Pad object with safe zone width if not using low-mem mode (chunks will be read padded otherwise).
+        # Patches of the object and the probe are extended by the safe zone width. Regions beyond the boundary are
+        # filled in the gather (0 for the object, 1 + 0j for the probe), so neither of them is padded as a whole.
+        # In low-mem mode, chunks are read padded already.
         szw_arr = np.array([safe_zone_width] * 2)
-        if not self.distribution_mode:
-            obj_rot, pad_arr = pad_object(obj_rot, this_obj_size, this_pos_batch - szw_arr, subprobe_size + 2 * szw_arr, unknown_type=unknown_type)
-
-        # Pad probe with safe zone width.
-        if safe_zone_width > 0:
-            pad_arr = calculate_pad_len(probe_size, this_pos_batch - szw_arr, subprobe_size + 2 * szw_arr, unknown_type=unknown_type)
-            probe_real_sz = w.pad(probe_real, [[0, 0]] + pad_arr, mode='constant', constant_values=1)
-            probe_imag_sz = w.pad(probe_imag, [[0, 0]] + pad_arr, mode='constant', constant_values=0)
-        else:
-            probe_real_sz = probe_real
-            probe_imag_sz = probe_imag
-            pad_arr = np.array([[0, 0], [0, 0]])
+        patch_size = np.array(subprobe_size) + 2 * szw_arr
 
         subobj_ls_ls = []
         subprobe_real_ls_ls = []
         subprobe_imag_ls_ls = []
         pos_ind = 0
         for k, pos_batch in enumerate(probe_pos_batch_ls):
+            szw_pos_batch = np.round(pos_batch).astype(int) - szw_arr
+            flag_full_patch = len(pos_batch) == 1 and np.all(szw_pos_batch == 0) and \
+                              np.all(patch_size == np.array(this_obj_size[:2])) and np.all(patch_size == np.array(probe_size))
             if self.distribution_mode is None:
-                if n_blocks > 1:
-                    subobj_subbatch_ls = []
-                    subprobe_subbatch_real_ls = []
-                    subprobe_subbatch_imag_ls = []
-                    if len(pos_batch) == 1:
-                        pos = pos_batch[0]
-                        pos_y = pos[0] + pad_arr[0, 0]
-                        pos_x = pos[1] + pad_arr[1, 0]
-                        subobj = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
-                        subobj_subbatch_ls = w.reshape(subobj, [1, *subobj.shape])
-                        sub_probe_real = probe_real_sz[:, pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                                        pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2]
-                        sub_probe_imag = probe_imag_sz[:, pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                                        pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2]
-                        subprobe_subbatch_real_ls = w.reshape(sub_probe_real, [1, *sub_probe_real.shape])
-                        subprobe_subbatch_imag_ls = w.reshape(sub_probe_imag, [1, *sub_probe_imag.shape])
-
-                    else:
-                        for j in range(len(pos_batch)):
-                            pos = pos_batch[j]
-                            pos_y = pos[0] + pad_arr[0, 0] - safe_zone_width
-                            pos_x = pos[1] + pad_arr[1, 0] - safe_zone_width
-                            subobj = obj_rot[pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                             pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2, :, :]
-                            sub_probe_real = probe_real_sz[:, pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                                              pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2]
-                            sub_probe_imag = probe_imag_sz[:, pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                                              pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2]
-                            subobj_subbatch_ls.append(subobj)
-                            subprobe_subbatch_real_ls.append(sub_probe_real)
-                            subprobe_subbatch_imag_ls.append(sub_probe_imag)
-                        subobj_subbatch_ls = w.stack(subobj_subbatch_ls)
-                        subprobe_subbatch_real_ls = w.stack(subprobe_subbatch_real_ls)
-                        subprobe_subbatch_imag_ls = w.stack(subprobe_subbatch_imag_ls)
-                else:
+                if flag_full_patch:
                     subobj_subbatch_ls = w.reshape(obj_rot, [1, *obj_rot.shape])
-                    subprobe_subbatch_real_ls = w.reshape(probe_real_sz, [1, *probe_real_sz.shape])
-                    subprobe_subbatch_imag_ls = w.reshape(probe_imag_sz, [1, *probe_imag_sz.shape])
-                # Shape of subprobe_real_ls_ls is [n_subbatches, len(pos_batch), y, x, z].
+                else:
+                    subobj_subbatch_ls = extract_patches(obj_rot, szw_pos_batch, patch_size, device=device_obj)
+                # Shape of subobj_ls_ls is [n_subbatches, len(pos_batch), y, x, z, 2].
                 subobj_ls_ls.append(subobj_subbatch_ls)
             else:
                 subobj_ls_ls.append(obj[pos_ind:pos_ind + len(pos_batch)])
-                for j in range(len(pos_batch)):
-                    pos = pos_batch[j]
-                    pos_y = pos[0] + pad_arr[0, 0] - safe_zone_width
-                    pos_x = pos[1] + pad_arr[1, 0] - safe_zone_width
-                    sub_probe_real = probe_real_sz[:, pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                     pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2]
-                    sub_probe_imag = probe_imag_sz[:, pos_y:pos_y + subprobe_size[0] + safe_zone_width * 2,
-                                     pos_x:pos_x + subprobe_size[1] + safe_zone_width * 2]
-                    subprobe_subbatch_real_ls.append(sub_probe_real)
-                    subprobe_subbatch_imag_ls.append(sub_probe_imag)
-                subprobe_subbatch_real_ls = w.stack(subprobe_subbatch_real_ls)
-                subprobe_subbatch_imag_ls = w.stack(subprobe_subbatch_imag_ls)
+            if flag_full_patch:
+                subprobe_subbatch_real_ls = w.reshape(probe_real, [1, *probe_real.shape])
+                subprobe_subbatch_imag_ls = w.reshape(probe_imag, [1, *probe_imag.shape])
+            else:
+                subprobe_subbatch_real_ls = extract_patches(probe_real, szw_pos_batch, patch_size, axes=(1, 2),
+                                                            fill_value=1, device=device_obj)
+                subprobe_subbatch_imag_ls = extract_patches(probe_imag, szw_pos_batch, patch_size, axes=(1, 2),
+                                                            fill_value=0, device=device_obj)
 
             # Shape of subprobe_real_ls_ls is [n_subbatches, len(pos_batch), n_probe_modes, y, x].
             subprobe_real_ls_ls.append(subprobe_subbatch_real_ls)
@@ -937,25 +1009,23 @@ class MultiDistModel(ForwardModel):
         ex_imag_ls = []
         for i_dist, this_dist in enumerate(free_prop_cm):
             for k, pos_batch in enumerate(probe_pos_batch_ls):
-                ex_real = []
-                ex_imag = []
-                for i_mode in range(n_probe_modes):
-                    if self.forward_algorithm == 'fresnel':
-                        temp_real, temp_imag = multislice_propagate_batch(
-                            subobj_ls_ls[k],
-                            subprobe_real_ls_ls[k][:, i_mode, :, :], subprobe_imag_ls_ls[k][i_mode, :, :],
-                            energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=this_dist,
-                            obj_batch_shape=[len(pos_batch), subprobe_size[0] + 2 * safe_zone_width, subprobe_size[1] + 2 * safe_zone_width, this_obj_size[-1]],
-                            fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
-                            type=unknown_type, sign_convention=self.sign_convention, optimize_free_prop=optimize_free_prop,
-                            u_free=u_free, v_free=v_free, scale_ri_by_k=self.scale_ri_by_k, kappa=kappa)
-
-                    elif self.forward_algorithm == 'ctf':
-                        temp_real, temp_imag = modulate_and_get_ctf(subobj_ls_ls[k], energy_ev, this_dist, u_free, v_free, kappa=10 ** ctf_lg_kappa[0])
-                    ex_real.append(temp_real)
-                    ex_imag.append(temp_imag)
-                ex_real = w.swap_axes(w.stack(ex_real), [0, 1])
-                ex_imag = w.swap_axes(w.stack(ex_imag), [0, 1])
+                # All probe modes are propagated together. Shape of ex_real is [len(pos_batch), n_probe_modes, y, x].
+                if self.forward_algorithm == 'fresnel':
+                    ex_real, ex_imag = multislice_propagate_batch(
+                        subobj_ls_ls[k],
+                        subprobe_real_ls_ls[k], subprobe_imag_ls_ls[k],
+                        energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=this_dist,
+                        obj_batch_shape=[len(pos_batch), subprobe_size[0] + 2 * safe_zone_width, subprobe_size[1] + 2 * safe_zone_width, this_obj_size[-1]],
+                        fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
+                        type=unknown_type, sign_convention=self.sign_convention, optimize_free_prop=optimize_free_prop,
+                        u_free=u_free, v_free=v_free, scale_ri_by_k=self.scale_ri_by_k, kappa=kappa, batched_modes=True,
+                        checkpoint_slices=self.checkpoint_slices)
+
+                elif self.forward_algorithm == 'ctf':
+                    # CTF does not depend on the probe, so the same result is used for all modes.
+                    temp_real, temp_imag = modulate_and_get_ctf(subobj_ls_ls[k], energy_ev, this_dist, u_free, v_free, kappa=10 ** ctf_lg_kappa[0])
+                    ex_real = w.tile(w.reshape(temp_real, [temp_real.shape[0], 1, *temp_real.shape[1:]]), [1, n_probe_modes, 1, 1])
+                    ex_imag = w.tile(w.reshape(temp_imag, [temp_imag.shape[0], 1, *temp_imag.shape[1:]]), [1, n_probe_modes, 1, 1])
             ex_real_ls.append(ex_real)
             ex_imag_ls.append(ex_imag)
         # Output shape is [minibatch_size, n_probe_modes, y, x].
@@ -982,19 +1052,19 @@ class MultiDistModel(ForwardModel):
                            probe_pos_offset, this_i_theta, this_pos_batch, prj,
                            probe_pos_correction, this_ind_batch, free_prop_cm, safe_zone_width, prj_affine_ls, ctf_lg_kappa):
 
-            beamstop = self.common_vars['beamstop']
-            ds_level = self.common_vars['ds_level']
-            optimize_probe_pos_offset = self.common_vars['optimize_probe_pos_offset']
-            optimize_all_probe_pos = self.common_vars['optimize_all_probe_pos']
-            optimize_prj_affine = self.common_vars['optimize_prj_affine']
-            device_obj = self.common_vars['device_obj']
-            minibatch_size =self.common_vars['minibatch_size']
-            theta_downsample = self.common_vars['theta_downsample']
-            fourier_disparity = self.common_vars['fourier_disparity']
-            output_folder = self.common_vars['output_folder']
-            u_free = self.common_vars['u_free']
-            v_free = self.common_vars['v_free']
-            energy_ev = self.common_vars['energy_ev']
+            beamstop = self.beamstop
+            ds_level = self.ds_level
+            optimize_probe_pos_offset = self.optimize_probe_pos_offset
+            optimize_all_probe_pos = self.optimize_all_probe_pos
+            optimize_prj_affine = self.optimize_prj_affine
+            device_obj = self.device_obj
+            minibatch_size =self.minibatch_size
+            theta_downsample = self.theta_downsample
+            fourier_disparity = self.fourier_disparity
+            output_folder = self.output_folder
+            u_free = self.u_free
+            v_free = self.v_free
+            energy_ev = self.energy_ev
 
             if theta_downsample is None: theta_downsample = 1
 
@@ -1003,7 +1073,7 @@ class MultiDistModel(ForwardModel):
                                                   probe_pos_correction, this_ind_batch, free_prop_cm, safe_zone_width,
                                                   prj_affine_ls, ctf_lg_kappa)
             this_pred_batch = w.norm(ex_real_ls, ex_imag_ls)
-            if self.common_vars['n_probe_modes'] == 1:
+            if self.n_probe_modes == 1:
                 this_pred_batch = this_pred_batch[:, 0, :, :]
             else:
                 this_pred_batch = w.sqrt(w.sum(this_pred_batch ** 2, axis=1))
@@ -1013,10 +1083,7 @@ class MultiDistModel(ForwardModel):
             this_ind_batch_full = this_ind_batch
             for i in range(1, n_dists):
                 this_ind_batch_full = np.concatenate([this_ind_batch_full, this_ind_batch + i * n_blocks])
-            this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch_full]
-            this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
-            if ds_level > 1:
-                this_prj_batch = this_prj_batch[:, :ds_level, ::ds_level]
+            this_prj_batch = self.get_measured_batch(prj, this_i_theta, this_ind_batch_full)
 
             if optimize_prj_affine:
                 scaled_prj_ls = []
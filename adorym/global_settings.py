@@ -1 +1,39 @@
-backend = 'autograd'
\ No newline at end of file
+backend = 'autograd'
+use_native_complex = False
+
+# Precision policy. Each entry is the name of the real floating point dtype used for one class of arrays;
+# complex wavefields use the complex dtype of the same precision as compute_dtype. None means that each array
+# keeps the dtype it has without a policy (see get_dtype).
+storage_dtype = None        # Object, gradient and mask arrays kept in HDF5 files or distributed across ranks.
+compute_dtype = 'float64'   # Object chunks, probe and propagation kernels in the forward model.
+grad_dtype = None           # Accumulated object gradients.
+optimizer_dtype = None      # Optimizer states (e.g. Adam moments).
+precision_policy_defaults = {'storage': None, 'compute': 'float64', 'grad': None, 'optimizer': None}
+
+precision_policy_keys = ('storage', 'compute', 'grad', 'optimizer')
+
+
+def set_precision_policy(**kwargs):
+    """
+    Set the precision policy, e.g. set_precision_policy(storage='float32', compute='float32').
+    :param kwargs: Keys must be among 'storage', 'compute', 'grad' and 'optimizer'; values are dtype names, or None
+                   to restore the default of the entry.
+    """
+    for key, dtype in kwargs.items():
+        if key not in precision_policy_keys:
+            raise ValueError('Invalid precision policy key "{}". Must be among {}.'.format(key, precision_policy_keys))
+        if dtype is None:
+            globals()['{}_dtype'.format(key)] = precision_policy_defaults[key]
+            continue
+        if dtype not in ('float16', 'float32', 'float64'):
+            raise ValueError('Invalid dtype "{}" for {} precision.'.format(dtype, key))
+        globals()['{}_dtype'.format(key)] = dtype
+
+
+def get_dtype(key, default=None):
+    """
+    Get the dtype of a precision policy entry, or default if the entry is None, i.e. the dtype an array has when
+    no policy is given.
+    """
+    dtype = globals()['{}_dtype'.format(key)]
+    return default if dtype is None else dtype
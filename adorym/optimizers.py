@@ -65,7 +65,8 @@ class Optimizer(object):
                     self.params_file_pointer_dict[param_name] = h5py.File(os.path.join(self.output_folder, 'intermediate_{}.h5'.format(param_name)), fmode)
                 try:
                     dset_p = self.params_file_pointer_dict[param_name].create_dataset('obj', shape=self.whole_object_size,
-                                                                                      dtype='float64', data=np.zeros(self.whole_object_size))
+                                                                                      dtype=global_settings.get_dtype('optimizer', 'float64'),
+                                                                                      data=np.zeros(self.whole_object_size))
                 except:
                     dset_p = self.params_file_pointer_dict[param_name]['obj']
                 # if rank == 0: dset_p[...] = 0
@@ -76,21 +77,23 @@ class Optimizer(object):
 
         if len(self.params_list) > 0:
             for param_name in self.params_list:
-                self.params_whole_array_dict[param_name] = w.zeros(self.whole_object_size, device=device)
+                self.params_whole_array_dict[param_name] = w.zeros(self.whole_object_size, dtype=global_settings.optimizer_dtype,
+                                                                   device=device)
         return
 
     def create_distributed_param_arrays(self):
 
         if len(self.params_list) > 0 and self.slice_catalog[rank] is not None:
             for param_name in self.params_list:
-                self.params_whole_array_dict[param_name] = w.zeros([self.slice_catalog[rank][1] - self.slice_catalog[rank][0], *self.whole_object_size[1:]])
+                self.params_whole_array_dict[param_name] = w.zeros([self.slice_catalog[rank][1] - self.slice_catalog[rank][0], *self.whole_object_size[1:]],
+                                                                   dtype=global_settings.optimizer_dtype)
         return
 
     def restore_param_arrays_from_checkpoint(self, device=None):
 
         if len(self.params_list) > 0:
             arr = np.load(os.path.join(self.output_folder, 'checkpoint', 'opt_params_checkpoint.npy'))
-            arr = w.create_variable(arr, device=device)
+            arr = w.create_variable(arr, dtype=global_settings.optimizer_dtype, device=device)
             if len(self.params_list) > 0:
                 for i, param_name in enumerate(self.params_list):
                     self.params_whole_array_dict[param_name] = arr[i]
@@ -100,7 +103,7 @@ class Optimizer(object):
 
         if len(self.params_list) > 0:
             arr = np.load(os.path.join(self.output_folder, 'checkpoint', 'opt_params_checkpoint_rank_{}.npy'.format(rank)))
-            arr = w.create_variable(arr, device=device)
+            arr = w.create_variable(arr, dtype=global_settings.optimizer_dtype, device=device)
             if len(self.params_list) > 0:
                 for i, param_name in enumerate(self.params_list):
                     self.params_whole_array_dict[param_name] = arr[i]
@@ -182,12 +185,17 @@ class AdamOptimizer(Optimizer):
             else:
                 m = self.params_whole_array_dict['m']
                 v = self.params_whole_array_dict['v']
+        # With an optimizer dtype in the precision policy, moments are kept in that dtype and the update is cast
+        # back to the dtype of x.
+        flag_cast = global_settings.optimizer_dtype is not None
+        if flag_cast:
+            g = w.cast(g, w.get_dtype(m))
         m = (1 - b1) * g + b1 * m  # First moment estimate.
         v = (1 - b2) * (g ** 2) + b2 * v  # Second moment estimate.
         mhat = m / (1 - b1 ** (i_batch + 1))  # Bias correction.
         vhat = v / (1 - b2 ** (i_batch + 1))
         d = step_size * mhat / (w.sqrt(vhat) + eps)
-        x = x - d
+        x = x - (w.cast(d, w.get_dtype(x)) if flag_cast else d)
         if distribution_mode == 'shared_file':
             self.params_chunk_array_dict['m'] = m
             self.params_chunk_array_dict['v'] = v
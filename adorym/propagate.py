@@ -17,10 +17,47 @@ except:
 import os
 import pickle
 import glob
+from collections import OrderedDict
 from scipy.special import erf
 
 from adorym.constants import *
 import adorym.wrappers as w
+import adorym.global_settings as global_settings
+
+# Process-wide LRU cache of frequency meshes and transfer function kernels. Entries are keyed by the
+# propagation parameters (and by backend/device for kernels already converted to backend variables).
+# Cached arrays are shared between callers and must not be modified in place.
+kernel_cache_size = 64
+_kernel_cache = OrderedDict()
+
+
+def _is_hashable_number(x):
+    return isinstance(x, (int, float, np.integer, np.floating)) or (isinstance(x, np.ndarray) and x.size == 1)
+
+
+def _get_from_kernel_cache(key, func):
+    try:
+        val = _kernel_cache.pop(key)
+    except KeyError:
+        val = func()
+    _kernel_cache[key] = val
+    while len(_kernel_cache) > kernel_cache_size:
+        _kernel_cache.popitem(last=False)
+    return val
+
+
+def clear_kernel_cache():
+    _kernel_cache.clear()
+
+
+def set_kernel_cache_size(size):
+    """
+    :param size: int; maximum number of cached meshes and kernels. Least recently used entries are evicted first.
+    """
+    global kernel_cache_size
+    kernel_cache_size = int(size)
+    while len(_kernel_cache) > kernel_cache_size:
+        _kernel_cache.popitem(last=False)
 
 
 def gen_mesh(max, shape):
@@ -33,6 +70,11 @@ def gen_mesh(max, shape):
 
 
 def gen_freq_mesh(voxel_nm, shape):
+    key = ('freq_mesh', float(voxel_nm[0]), float(voxel_nm[1]), int(shape[0]), int(shape[1]))
+    return _get_from_kernel_cache(key, lambda: _gen_freq_mesh(voxel_nm, shape))
+
+
+def _gen_freq_mesh(voxel_nm, shape):
     u = np.fft.fftfreq(shape[0])
     v = np.fft.fftfreq(shape[1])
     vv, uu = np.meshgrid(v, u)
@@ -40,8 +82,26 @@ def gen_freq_mesh(voxel_nm, shape):
     uu /= voxel_nm[0]
     return uu, vv
 
+
+def get_freq_grid_variable(shape, device=None, override_backend=None):
+    """
+    Get cached unit-spacing frequency grids (freq_y, freq_x) of a 2D shape as backend variables.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    dtype = global_settings.compute_dtype
+
+    def convert():
+        freq_y, freq_x = gen_freq_mesh([1., 1.], shape)
+        freq_y = w.create_variable(freq_y, dtype=dtype, requires_grad=False, device=device, override_backend=override_backend)
+        freq_x = w.create_variable(freq_x, dtype=dtype, requires_grad=False, device=device, override_backend=override_backend)
+        return freq_y, freq_x
+
+    key = ('freq_grid_variable', int(shape[0]), int(shape[1]), dtype, bn, str(device))
+    return _get_from_kernel_cache(key, convert)
+
+
 def get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=True, sign_convention=1):
-    """Get unshifted Fresnel propagation kernel for TF algorithm.
+    """Get unshifted Fresnel propagation kernel for TF algorithm. Kernels of constant distances are cached.
 
     Parameters:
     -----------
@@ -50,6 +110,64 @@ def get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=True, sig
     dist : float
         Propagation distance in cm.
     """
+    if not (_is_hashable_number(dist_nm) and _is_hashable_number(lmbda_nm)):
+        return _get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx, sign_convention)
+    key = ('kernel', float(dist_nm), float(lmbda_nm), float(voxel_nm[0]), float(voxel_nm[1]),
+           int(grid_shape[0]), int(grid_shape[1]), bool(fresnel_approx), sign_convention)
+    return _get_from_kernel_cache(key, lambda: _get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape,
+                                                           fresnel_approx, sign_convention))
+
+
+def get_kernel_variable(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=True, sign_convention=1,
+                        device=None, override_backend=None):
+    """
+    Get the real and imaginary parts of the transfer function kernel as backend variables on the target device.
+    """
+    h = get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=fresnel_approx,
+                   sign_convention=sign_convention)
+    return kernel_to_variable(h, device=device, override_backend=override_backend)
+
+
+def kernel_to_variable(h, device=None, override_backend=None):
+    """
+    Convert a complex NumPy kernel into real and imaginary backend variables of the compute dtype. Conversions are
+    cached as long as the same array object is passed in.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    dtype = global_settings.compute_dtype
+
+    def convert():
+        h_real = w.create_variable(np.real(h), dtype=dtype, requires_grad=False, device=device, override_backend=override_backend)
+        h_imag = w.create_variable(np.imag(h), dtype=dtype, requires_grad=False, device=device, override_backend=override_backend)
+        return h, h_real, h_imag
+
+    key = ('kernel_variable', id(h), dtype, bn, str(device))
+    # The source array is held in the entry, so its id cannot be reused while the entry is alive.
+    h_cached, h_real, h_imag = _get_from_kernel_cache(key, convert)
+    if h_cached is not h:
+        h_cached, h_real, h_imag = convert()
+        _kernel_cache[key] = (h_cached, h_real, h_imag)
+    return h_real, h_imag
+
+
+def kernel_to_complex_variable(h, dtype='complex64', device=None, override_backend=None):
+    """
+    Convert a complex NumPy kernel into a single complex backend variable for the native complex path.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+
+    def convert():
+        return h, w.create_variable(h, dtype=dtype, requires_grad=False, device=device, override_backend=override_backend)
+
+    key = ('kernel_complex_variable', id(h), dtype, bn, str(device))
+    h_cached, h_var = _get_from_kernel_cache(key, convert)
+    if h_cached is not h:
+        h_cached, h_var = convert()
+        _kernel_cache[key] = (h_cached, h_var)
+    return h_var
+
+
+def _get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=True, sign_convention=1):
     u, v = gen_freq_mesh(voxel_nm, grid_shape[0:2])
     if fresnel_approx:
         # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
@@ -119,7 +237,24 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
                                pure_projection=False, binning=1, device=None, type='delta_beta',
                                normalize_fft=False, sign_convention=1, optimize_free_prop=False, u_free=None, v_free=None,
                                scale_ri_by_k=True, is_minus_logged=False, pure_projection_return_sqrt=False,
-                               kappa=None, repeating_slice=None, return_fft_time=False):
+                               kappa=None, repeating_slice=None, return_fft_time=False, use_native_complex=None,
+                               return_complex=False, batched_modes=False, checkpoint_slices=None,
+                               shift_far_field=True):
+    """
+    :param shift_far_field: bool; if False, the far-field wavefield (free_prop_cm = 'inf') is returned in FFT order,
+                            i.e., with the zero frequency at the corner instead of the center.
+    :param checkpoint_slices: int; if given, wavefields are stored for the backward pass only every this many slices
+                              and the slices in between are recomputed when gradients are calculated.
+    :param batched_modes: bool; if True, probe_real and probe_imag carry a probe mode axis right before the spatial
+                          axes, i.e., [n_modes, y, x] or [minibatch_size, n_modes, y, x]. The slice transmission
+                          function is computed once and broadcast to all modes. Output is [minibatch_size, n_modes, y, x].
+    :param use_native_complex: bool; if True, the wavefield is carried as a single complex array through the
+                               slice loop. If None, global_settings.use_native_complex is used.
+    :param return_complex: bool; if True, return the exit wave as one complex array instead of real and imaginary parts.
+    """
+    if use_native_complex is None:
+        use_native_complex = global_settings.use_native_complex
+    use_native_complex = use_native_complex and not pure_projection
 
     minibatch_size = grid_batch.shape[0]
     grid_shape = grid_batch.shape[1:-1]
@@ -138,17 +273,21 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
     if repeating_slice is not None:
         n_slices = repeating_slice
 
+    if batched_modes:
+        # Insert a mode axis so that slices of shape [minibatch_size, 1, y, x] broadcast against all modes.
+        grid_batch = w.reshape(grid_batch, [grid_batch.shape[0], 1, *grid_batch.shape[1:]])
+
     if pure_projection:
         k1 = 2. * PI * delta_nm / lmbda_nm if scale_ri_by_k else 1.
         if type == 'delta_beta':
             # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
             # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
             p = w.sum(grid_batch, axis=-2)
-            delta_slice = p[:, :, :, 0]
+            delta_slice = p[..., 0]
             if kappa is not None:
                 beta_slice = delta_slice * kappa
             else:
-                beta_slice = p[:, :, :, 1]
+                beta_slice = p[..., 1]
             # In conventional tomography beta is interpreted as mu. If projection data is minus-logged,
             # the line sum of beta (mu) directly equals image intensity. If raw_data_type is set to 'intensity',
             # measured data will be taken square root at the loss calculation step. To match this, the summed
@@ -163,8 +302,8 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
                 c_real, c_imag = w.exp_complex(-k1 * beta_slice, -sign_convention * k1 * delta_slice)
         elif type == 'real_imag':
             p = w.prod(grid_batch, axis=-2)
-            delta_slice = p[:, :, :, 0]
-            beta_slice = p[:, :, :, 1]
+            delta_slice = p[..., 0]
+            beta_slice = p[..., 1]
             c_real, c_imag = delta_slice, beta_slice
             if is_minus_logged:
                 if pure_projection_return_sqrt:
@@ -182,57 +321,132 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
             # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
             # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
             h = get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
-        h_real, h_imag = np.real(h), np.imag(h)
-        h_real = w.create_variable(h_real, requires_grad=False, device=device)
-        h_imag = w.create_variable(h_imag, requires_grad=False, device=device)
+        if use_native_complex:
+            complex_dtype = w.get_complex_dtype(probe_real)
+            h_complex = kernel_to_complex_variable(h, dtype=complex_dtype, device=device)
+            probe = w.to_complex(probe_real, probe_imag)
+        else:
+            h_real, h_imag = kernel_to_variable(h, device=device)
 
-        i_bin = 0
         t_tot = 0
-        for i in range(n_slices):
-            k1 = 2. * PI * delta_nm / lmbda_nm if scale_ri_by_k else 1.
-            # At the start of bin, initialize slice array.
-            if repeating_slice is None:
-                delta_slice = grid_batch[:, :, :, i, 0]
-            else:
-                delta_slice = grid_batch[:, :, :, 0, 0]
-            if kappa is not None:
-                # In sign = +1 convention, phase (delta) should be positive, and kappa is positive too.
-                beta_slice = delta_slice * kappa
+
+        def propagate_slices(i_start, i_end, grid_batch, *wave):
+            nonlocal t_tot
+            if use_native_complex:
+                probe, = wave
             else:
+                probe_real, probe_imag = wave
+            for i in range(i_start, i_end):
+                k1 = 2. * PI * delta_nm / lmbda_nm if scale_ri_by_k else 1.
+                # At the start of bin, initialize slice array.
                 if repeating_slice is None:
-                    beta_slice = grid_batch[:, :, :, i, 1]
+                    delta_slice = grid_batch[..., i, 0]
                 else:
-                    beta_slice = grid_batch[:, :, :, 0, 1]
-            t0 = time.time()
-            if type == 'delta_beta':
-                # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
-                # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
-                c_real, c_imag = w.exp_complex(-k1 * beta_slice, -sign_convention * k1 * delta_slice)
-            elif type == 'real_imag':
-                c_real, c_imag = delta_slice, beta_slice
-            else:
-                raise ValueError('unknown_type must be delta_beta or real_imag.')
-            probe_real, probe_imag = (probe_real * c_real - probe_imag * c_imag, probe_real * c_imag + probe_imag * c_real)
-            i_bin += 1
-
-            # When arriving at the last slice of bin or object, do propagation.
-            if i_bin == binning or i == n_slices - 1:
-                if i < n_slices - 1:
-                    if i_bin == binning:
-                        probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_real, h_imag)
+                    delta_slice = grid_batch[..., 0, 0]
+                if kappa is not None:
+                    # In sign = +1 convention, phase (delta) should be positive, and kappa is positive too.
+                    beta_slice = delta_slice * kappa
+                else:
+                    if repeating_slice is None:
+                        beta_slice = grid_batch[..., i, 1]
+                    else:
+                        beta_slice = grid_batch[..., 0, 1]
+                t0 = time.time()
+                if use_native_complex:
+                    if type == 'delta_beta':
+                        c = w.exp_complex_native(-k1 * beta_slice, -sign_convention * k1 * delta_slice)
+                    elif type == 'real_imag':
+                        c = w.to_complex(delta_slice, beta_slice)
+                    else:
+                        raise ValueError('unknown_type must be delta_beta or real_imag.')
+                    probe = probe * c
+                else:
+                    if type == 'delta_beta':
+                        # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
+                        # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
+                        c_real, c_imag = w.exp_complex(-k1 * beta_slice, -sign_convention * k1 * delta_slice)
+                    elif type == 'real_imag':
+                        c_real, c_imag = delta_slice, beta_slice
+                    else:
+                        raise ValueError('unknown_type must be delta_beta or real_imag.')
+                    probe_real, probe_imag = (probe_real * c_real - probe_imag * c_imag, probe_real * c_imag + probe_imag * c_real)
+                # Bins start at slice 0, so the position in the current bin is known from the slice index.
+                i_bin = i % binning + 1
+
+                # When arriving at the last slice of bin or object, do propagation.
+                if i_bin == binning or i == n_slices - 1:
+                    if i < n_slices - 1:
+                        if use_native_complex:
+                            if i_bin == binning:
+                                probe = w.convolve_with_transfer_function_complex(probe, h_complex)
+                            else:
+                                h_partial = get_kernel(delta_nm * i_bin, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
+                                h_partial = kernel_to_complex_variable(h_partial, dtype=complex_dtype, device=device)
+                                probe = w.convolve_with_transfer_function_complex(probe, h_partial)
+                        elif i_bin == binning:
+                            probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_real, h_imag)
+                        else:
+                            probe_real, probe_imag = fresnel_propagate(probe_real, probe_imag, delta_nm * i_bin, lmbda_nm, voxel_nm, device=device, sign_convention=sign_convention)
+                t_tot += (time.time() - t0)
+            return (probe,) if use_native_complex else (probe_real, probe_imag)
+
+        wave = (probe,) if use_native_complex else (probe_real, probe_imag)
+        if checkpoint_slices in [None, 0] or n_slices <= checkpoint_slices:
+            wave = propagate_slices(0, n_slices, grid_batch, *wave)
+        else:
+            # Only the wavefield at the start of each segment is kept for the backward pass; slices in between
+            # are recomputed. Segments are aligned with bins.
+            seg_len = int(ceil(checkpoint_slices / binning)) * binning
+            for i_start in range(0, n_slices, seg_len):
+                i_end = min(i_start + seg_len, n_slices)
+                wave = w.checkpoint(lambda g, *v, i_start=i_start, i_end=i_end: propagate_slices(i_start, i_end, g, *v),
+                                    grid_batch, *wave)
+        if use_native_complex:
+            probe, = wave
+        else:
+            probe_real, probe_imag = wave
+
+        if use_native_complex:
+            if free_prop_cm not in [0, None]:
+                if isinstance(free_prop_cm, str) and free_prop_cm == 'inf':
+                    if sign_convention == 1 and shift_far_field:
+                        probe = w.fft2_and_shift_complex(probe, axes=[-2, -1], normalize=normalize_fft)
+                    elif sign_convention == 1:
+                        probe = w.fft2_complex(probe, axes=[-2, -1], normalize=normalize_fft)
+                    elif shift_far_field:
+                        probe = w.ifft2_and_shift_complex(probe, axes=[-2, -1], normalize=normalize_fft)
+                    else:
+                        probe = w.ifft2_complex(probe, axes=[-2, -1], normalize=normalize_fft)
+                else:
+                    dist_nm = free_prop_cm * 1e7
+                    if optimize_free_prop:
+                        h_free_real, h_free_imag = get_kernel_wrapped(u_free, v_free, dist_nm, lmbda_nm, voxel_nm,
+                                                                      grid_shape, sign_convention=sign_convention)
+                        h_free = w.to_complex(h_free_real, h_free_imag)
                     else:
-                        probe_real, probe_imag = fresnel_propagate(probe_real, probe_imag, delta_nm * i_bin, lmbda_nm, voxel_nm, device=device, sign_convention=sign_convention)
-                i_bin = 0
-            t_tot += (time.time() - t0)
+                        h_free = get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
+                        h_free = kernel_to_complex_variable(h_free, dtype=complex_dtype, device=device)
+                    probe = w.convolve_with_transfer_function_complex(probe, h_free)
+            if return_complex:
+                return (probe, t_tot) if return_fft_time else probe
+            probe_real, probe_imag = w.split_complex(probe)
+            if return_fft_time:
+                return probe_real, probe_imag, t_tot
+            else:
+                return probe_real, probe_imag
 
     if free_prop_cm not in [0, None]:
         if isinstance(free_prop_cm, str) and free_prop_cm == 'inf':
             # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
             # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
-            if sign_convention == 1:
-                probe_real, probe_imag = w.fft2_and_shift(probe_real, probe_imag, axes=[1, 2], normalize=normalize_fft)
+            if sign_convention == 1 and shift_far_field:
+                probe_real, probe_imag = w.fft2_and_shift(probe_real, probe_imag, axes=[-2, -1], normalize=normalize_fft)
+            elif sign_convention == 1:
+                probe_real, probe_imag = w.fft2(probe_real, probe_imag, axes=[-2, -1], normalize=normalize_fft)
+            elif shift_far_field:
+                probe_real, probe_imag = w.ifft2_and_shift(probe_real, probe_imag, axes=[-2, -1], normalize=normalize_fft)
             else:
-                probe_real, probe_imag = w.ifft2_and_shift(probe_real, probe_imag, axes=[1, 2], normalize=normalize_fft)
+                probe_real, probe_imag = w.ifft2(probe_real, probe_imag, axes=[-2, -1], normalize=normalize_fft)
         else:
             dist_nm = free_prop_cm * 1e7
             l = np.prod(size_nm)**(1. / 3)
@@ -243,6 +457,9 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
             elif not optimize_free_prop:
                 probe_real, probe_imag = fresnel_propagate(probe_real, probe_imag, dist_nm, lmbda_nm, voxel_nm,
                                                            device=device, sign_convention=sign_convention)
+    if return_complex:
+        probe = w.to_complex(probe_real, probe_imag)
+        return (probe, t_tot) if return_fft_time else probe
     if return_fft_time:
         return probe_real, probe_imag, t_tot
     else:
@@ -311,20 +528,15 @@ def sparse_multislice_propagate_batch(u, v, grid_batch, probe_real, probe_imag,
     return probe_real, probe_imag
 
 
-def fresnel_propagate(probe_real, probe_imag, dist_nm, lmbda_nm, voxel_nm, h=None, device=None, override_backend=None, sign_convention=1):
+def fresnel_propagate(probe_real, probe_imag, dist_nm, lmbda_nm, voxel_nm, h=None, device=None, override_backend=None, sign_convention=1,
+                      fresnel_approx=True):
     """
-    :param h: A List of the real part and imaginary part of the transfer function kernel.
+    :param h: Complex NumPy array of the transfer function kernel. If None, it is fetched from the kernel cache.
     """
-    if len(probe_real.shape) == 3:
-        grid_shape = probe_real.shape[1:]
-    else:
-        grid_shape = probe_real.shape
+    grid_shape = probe_real.shape[-2:]
     if h is None:
-        h = get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
-    h_real = np.real(h)
-    h_imag = np.imag(h)
-    h_real = w.create_variable(h_real, requires_grad=False, device=device, override_backend=override_backend)
-    h_imag = w.create_variable(h_imag, requires_grad=False, device=device, override_backend=override_backend)
+        h = get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
+    h_real, h_imag = kernel_to_variable(h, device=device, override_backend=override_backend)
     probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_real, h_imag,
                                                                override_backend=override_backend)
     return probe_real, probe_imag
@@ -334,12 +546,21 @@ def fresnel_propagate_wrapped(u, v, probe_real, probe_imag, dist_nm, lmbda_nm, v
     """
     :param h: A List of the real part and imaginary part of the transfer function kernel.
     """
-    if len(probe_real.shape) == 3:
-        grid_shape = probe_real.shape[1:]
-    else:
-        grid_shape = probe_real.shape
+    grid_shape = probe_real.shape[-2:]
     if h is None:
-        h_real, h_imag = get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
+        if _is_hashable_number(dist_nm) and _is_hashable_number(lmbda_nm):
+            key = ('kernel_wrapped', id(u), id(v), float(dist_nm), float(lmbda_nm), sign_convention)
+            # Mesh variables are held in the entry, so their ids cannot be reused while the entry is alive.
+            u_cached, v_cached, h_real, h_imag = _get_from_kernel_cache(
+                key, lambda: (u, v) + tuple(get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape,
+                                                               sign_convention=sign_convention)))
+            if u_cached is not u or v_cached is not v:
+                h_real, h_imag = get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
+                _kernel_cache[key] = (u, v, h_real, h_imag)
+        else:
+            h_real, h_imag = get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
+    else:
+        h_real, h_imag = h
     probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_real, h_imag,
                                                                override_backend=override_backend)
     return probe_real, probe_imag
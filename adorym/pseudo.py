@@ -47,7 +47,7 @@ class Comm():
     def alltoall(self, a):
         return a
 
-    def allreduce(self, a):
+    def allreduce(self, a, op=None):
         return a
 
     def Allreduce(self, a):
@@ -57,4 +57,6 @@ class Comm():
 class MPI(object):
 
     COMM_WORLD = Comm()
+    SUM = None
+    MAX = None
 
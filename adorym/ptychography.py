@@ -22,6 +22,8 @@ import adorym.wrappers as w
 import adorym.global_settings
 from adorym.forward_model import *
 from adorym.conventional import *
+from adorym.data_loader import *
+from adorym.rotation import *
 
 PI = 3.1415927
 
@@ -97,6 +99,10 @@ def reconstruct_ptychography(
         distribution_mode=None, # Choose from None (for data parallelism), 'shared_file', 'distributed_object'
         dist_mode_n_batch_per_update=None, # If None, object is updated only after all DPs on an angle are processed.
         precalculate_rotation_coords=True,
+        rotation_method='bilinear',
+        # Choose from 'bilinear' and 'fft_shear'. 'fft_shear' rotates the object with three Fourier-domain shears,
+        # which needs no rotation coordinates and does not blur the object, and rotates gradients back with the
+        # exact transpose. The object is treated as periodic in x and z.
         cache_dtype='float32',
         rotate_out_of_loop=False,
         # Applies to simple data parallelism mode only. If True, DP will do rotation outside the loss function
@@ -104,6 +110,64 @@ def reconstruct_ptychography(
         # of rotation operations if minibatch_size < n_tiles_per_angle, but object can be updated once only after
         # all tiles on an angle are processed. Also this will save the object-sized gradient array in GPU memory
         # or RAM depending on current device setting.
+        use_native_complex=False,
+        # If True, wavefields are carried as complex64/complex128 arrays through multislice propagation instead of
+        # separate real and imaginary parts. For PyTorch this requires a version with complex tensor support.
+        checkpoint_slices=None,
+        # If an integer is given, wavefields in multislice propagation are stored for the backward pass only every
+        # this many slices, and the slices in between are recomputed. Reduces memory at the cost of compute.
+        cache_shifted_probes=True,
+        # If True and neither the probe nor probe positions are optimized, probes shifted by sub-pixel position
+        # corrections are computed once and kept in memory (n_spots * n_probe_modes probe-sized arrays).
+        pin_rotation_coords=True,
+        # If True, precalculated rotation coordinates of each angle are decoded from the coordinate store only once
+        # and kept in memory, along with the sampling grids used by PyTorch. Set to False for large objects with
+        # many angles if RAM is limited.
+        rotation_coords_folder=None,
+        # Folder of the file holding precalculated rotation coordinates, shared by all ranks of a node. If given, the
+        # file persists and is reused by later runs with the same object size and angles. If None, the file is
+        # created in /dev/shm if available so that it stays in RAM (or in the working directory otherwise), and
+        # deleted at the end of each multiscale level.
+        accumulate_dp_batch_gradients=False,
+        # If True, each sub-batch of n_dp_batch spots gets its own forward and backward pass and the gradients are
+        # summed, so that the memory footprint depends on n_dp_batch instead of minibatch_size. If the object is
+        # rotated inside the loss function, it is rotated for every sub-batch; use rotate_out_of_loop to avoid that.
+        # Off by default, as this adds rotations to 3D reconstructions.
+        n_prefetch_batches=2,
+        # Number of upcoming minibatches whose diffraction data are read from the HDF5 file in a background thread
+        # while the current minibatch is computed. Set to 0 to read data synchronously in the loss function.
+        n_data_read_threads=4,
+        # Number of threads the prefetcher uses to read a batch if the data store supports parallel reads
+        # (directory of .npy files or Zarr). HDF5 reads are always done by one thread.
+        shard_data_by_rank=False,
+        # If True, each rank is assigned a fixed, contiguous part of the dataset for the whole run and preloads it
+        # into RAM with sequential reads; batches are then shuffled only within the part of each rank. Only used
+        # if distribution_mode is None and update_scheme is 'immediate'.
+        data_chunk_cache_nbytes=None,
+        # Size of the HDF5 chunk cache used when reading raw data. If None, the size recommended by rechunk_data is
+        # used if the file has one; otherwise h5py's default is used.
+        # Raw data given by fname may be an HDF5 file, a list or glob pattern of per-angle HDF5 files, a directory
+        # of per-angle .npy files or a Zarr store; see open_data_store.
+        live_mode=False,
+        # If True, data are assumed to be still being acquired: an HDF5 file is opened in SWMR mode (see
+        # HDF5DataStore.get_acquired_counts for how the writer reports progress), and a glob pattern of per-angle
+        # files is globbed again in every epoch. Each epoch only uses data acquired so far, and n_epochs counts
+        # from the first epoch in which all data are available. theta and probe positions of all angles must be
+        # known in advance; for per-angle files, n_theta must be given. Data statistics are not available, so
+        # probe_type='ifft' and rescale_probe_intensity cannot be used.
+        live_poll_interval=10.,
+        # Seconds to wait before checking again when not enough data have arrived in live mode.
+        live_new_data_weight=2.,
+        # In live mode, patterns acquired since the previous epoch are all used, while earlier patterns are used
+        # with a probability of 1 / live_new_data_weight.
+        preprocessed_data_cache_folder=None,
+        # If a folder is given, raw data are downsampled, converted to the quantity compared in the loss function
+        # and written to a float32 memory-mapped file there before reconstruction. The file is reused by later
+        # runs with the same data file and settings.
+        precision_policy=None,
+        # Dict of dtypes with keys among 'storage', 'compute', 'grad' and 'optimizer', e.g.
+        # {'compute': 'float32', 'optimizer': 'float32'}. 'compute' defaults to float64. Entries that are not given
+        # keep the dtypes used without a policy: cache_dtype for distributed arrays and float64 for object files.
         # _________________________
         # |Other optimizer options|_____________________________________________
         optimize_probe=False, probe_learning_rate=1e-5,
@@ -123,7 +187,8 @@ def reconstruct_ptychography(
         # ________________
         # |Other settings|______________________________________________________
         dynamic_rate=True, pupil_function=None, probe_circ_mask=0.9, dynamic_dropping=False, dropping_threshold=8e-5,
-        backend='autograd', # Choose from 'autograd' or 'pytorch
+        backend='autograd', # Choose from 'autograd', 'pytorch' or 'adjoint'. 'adjoint' uses hand-derived gradients
+        # for multislice ptychography (object, probe and probe positions) and NumPy arrays.
         debug=False,
         t_max_min=None,
         # At the end of a batch, terminate the program with status 0 if total time exceeds the set value.
@@ -154,7 +219,14 @@ def reconstruct_ptychography(
     n_ranks = comm.Get_size()
     rank = comm.Get_rank()
     t_zero = time.time()
-    global_settings.backend = backend
+    use_adjoint = backend == 'adjoint'
+    global_settings.backend = 'autograd' if use_adjoint else backend
+    global_settings.use_native_complex = use_native_complex
+    policy = dict(global_settings.precision_policy_defaults)
+    if precision_policy is not None:
+        policy.update(precision_policy)
+    global_settings.set_precision_policy(**policy)
+    cache_dtype = global_settings.get_dtype('storage', cache_dtype)
     device_obj = None if cpu_only else 0
     device_obj = w.get_device(device_obj)
 
@@ -187,9 +259,34 @@ def reconstruct_ptychography(
     # Create pointer for raw data.
     # ================================================================================
     t0 = time.time()
+    if isinstance(fname, (list, tuple)):
+        data_path = [os.path.join(save_path, i) for i in fname]
+    else:
+        data_path = os.path.join(save_path, fname)
+    data_store = open_data_store(data_path, live=live_mode)
+    if is_photon_count_data(data_store.data) and raw_data_type != 'intensity':
+        warnings.warn('Data are stored as integer photon counts. Setting raw_data_type to \'intensity\'.')
+        raw_data_type = 'intensity'
+    if probe_type == 'ifft' or rescale_probe_intensity:
+        if live_mode:
+            # Statistics of a file being written would include frames that are not acquired yet.
+            raise ValueError('probe_type=\'ifft\' and rescale_probe_intensity require statistics of the full data, '
+                             'which are not available in live mode.')
+        if isinstance(data_store, HDF5DataStore):
+            # Statistics are saved into the HDF5 file, which is therefore closed while they are computed.
+            data_store.close()
+            data_stats = get_dataset_statistics(data_path, raw_data_type=raw_data_type)
+        else:
+            data_stats = compute_dataset_statistics(data_store.data, raw_data_type=raw_data_type)
+    else:
+        data_stats = None
+    data_store.close()
     print_flush('Reading data...', sto_rank, rank, **stdout_options)
-    f = h5py.File(os.path.join(save_path, fname), 'r')
-    prj = f['exchange/data']
+    if data_chunk_cache_nbytes is None:
+        data_store = open_data_store(data_path, live=live_mode)
+    else:
+        data_store = open_data_store(data_path, live=live_mode, rdcc_nbytes=int(data_chunk_cache_nbytes))
+    prj = data_store.data
 
     # ================================================================================
     # Get metadata.
@@ -203,7 +300,10 @@ def reconstruct_ptychography(
     prj_theta_ind = np.arange(n_theta, dtype=int)
 
     try:
-        theta_ls = f['metadata/theta'][...]
+        theta_ls = data_store.get_metadata('theta')
+        if live_mode and len(theta_ls) != n_theta:
+            # Not all angles are acquired yet.
+            raise ValueError
         print_flush('Theta list read from HDF5.', sto_rank, rank, **stdout_options)
     except:
         theta_ls = np.linspace(theta_st, theta_end, n_theta, dtype='float32')
@@ -217,24 +317,24 @@ def reconstruct_ptychography(
     # Probe position.
     if probe_pos is None:
         if common_probe_pos:
-            probe_pos = f['metadata/probe_pos_px']
+            probe_pos = data_store.get_metadata('probe_pos_px')
             probe_pos = np.array(probe_pos).astype(float)
         else:
             probe_pos_ls = []
             n_pos_ls = []
             for i in range(n_theta):
-                probe_pos_ls.append(f['metadata/probe_pos_px_{}'.format(i)])
-                n_pos_ls.append(len(f['metadata/probe_pos_px_{}'.format(i)]))
+                probe_pos_ls.append(data_store.get_metadata('probe_pos_px_{}'.format(i)))
+                n_pos_ls.append(len(probe_pos_ls[-1]))
     else:
         probe_pos = np.array(probe_pos).astype(float)
 
     # Energy.
     if energy_ev is None:
-        energy_ev = float(f['metadata/energy_ev'][...])
+        energy_ev = float(data_store.get_metadata('energy_ev'))
 
     # Pixel size on sample plane.
     if psize_cm is None:
-        psize_cm = float(f['metadata/psize_cm'][...])
+        psize_cm = float(data_store.get_metadata('psize_cm'))
 
     # Slice positions (sparse).
     if slice_pos_cm_ls is None or len(slice_pos_cm_ls) == 1:
@@ -247,7 +347,7 @@ def reconstruct_ptychography(
 
     # Sample to detector distance.
     if free_prop_cm is None:
-        free_prop_cm = f['metadata/free_prop_cm'][...]
+        free_prop_cm = data_store.get_metadata('free_prop_cm')
     if np.array(free_prop_cm).size == 1:
         is_multi_dist = False
         if isinstance(free_prop_cm, np.ndarray):
@@ -281,6 +381,8 @@ def reconstruct_ptychography(
     comm.Barrier()
 
     not_first_level = False
+    rank_shard_ls = None
+    prj_shard = None
 
     # ================================================================================
     # Remove kwargs that may cause issue (removing args that were required in
@@ -298,6 +400,14 @@ def reconstruct_ptychography(
                       'minibatch > 1. A rank can only process data from the same rotation'
                       'angle at a time. I am setting minibatch_size to 1.')
         minibatch_size = 1
+    if live_mode and (shard_data_by_rank or preprocessed_data_cache_folder is not None):
+        warnings.warn('Data sharding and the preprocessed data cache are not used in live mode.')
+        shard_data_by_rank = False
+        preprocessed_data_cache_folder = None
+    if shard_data_by_rank and (distribution_mode is not None or update_scheme != 'immediate' or is_multi_dist):
+        warnings.warn('Data sharding requires distribution_mode to be None, update_scheme to be \'immediate\', '
+                      'and single-distance data. Data will not be sharded.')
+        shard_data_by_rank = False
     if distribution_mode is not None and common_probe_pos and len(probe_pos) == 1:
         warnings.warn('It seems that you are processing undivided fullfield data with'
                       'distribution_mode not None. In shared-file mode and distributed '
@@ -345,16 +455,13 @@ def reconstruct_ptychography(
         h = get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, probe_size, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
 
         # ================================================================================
-        # Read or write rotation transformation coordinates.
+        # Set up rotation transformation coordinates.
         # ================================================================================
-        if precalculate_rotation_coords:
-            if not os.path.exists('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta)):
-                comm.Barrier()
-                if rank == 0:
-                    os.makedirs('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta))
-                comm.Barrier()
-                print_flush('Saving rotation coordinates...', sto_rank, rank, **stdout_options)
-                save_rotation_lookup(this_obj_size, theta_ls)
+        # Coordinates of each angle are computed when first used.
+        if precalculate_rotation_coords and rotation_method != 'fft_shear':
+            rotation_coord_store = RotationCoordinateStore(this_obj_size, theta_ls, folder=rotation_coords_folder)
+        else:
+            rotation_coord_store = None
         comm.Barrier()
 
         # ================================================================================
@@ -441,7 +548,7 @@ def reconstruct_ptychography(
                                      random_guess_means_sigmas=random_guess_means_sigmas, unknown_type=unknown_type,
                                      non_negativity=non_negativity)
             else:
-                obj.arr = w.create_variable(obj_arr, device=device_obj)
+                obj.arr = w.create_variable(obj_arr, dtype=global_settings.compute_dtype, device=device_obj)
 
 
         # ================================================================================
@@ -476,11 +583,12 @@ def reconstruct_ptychography(
         gradient = Gradient(obj)
         if distribution_mode == 'shared_file':
             gradient.create_file_object()
-            gradient.initialize_gradient_file()
+            gradient.initialize_gradient_file(dtype=global_settings.get_dtype('storage', 'float32'))
         elif distribution_mode == 'distributed_object':
-            gradient.initialize_distributed_array_with_zeros(dtype=cache_dtype)
+            gradient.initialize_distributed_array_with_zeros(dtype=global_settings.get_dtype('grad', cache_dtype))
         else:
-            gradient.initialize_array_with_values(np.zeros(this_obj_size), np.zeros(this_obj_size), device=device_obj)
+            gradient.initialize_array_with_values(np.zeros(this_obj_size), np.zeros(this_obj_size), device=device_obj,
+                                                  dtype=global_settings.grad_dtype)
 
         # ================================================================================
         # If a finite support mask path is specified (common for full-field imaging),
@@ -522,7 +630,8 @@ def reconstruct_ptychography(
                                                       rescale_intensity=rescale_probe_intensity, save_path=save_path, fname=fname,
                                                       extra_defocus_cm=probe_extra_defocus_cm,
                                                       raw_data_type=raw_data_type, stdout_options=stdout_options,
-                                                      sign_convention=sign_convention, **probe_init_kwargs)
+                                                      sign_convention=sign_convention, data_stats=data_stats,
+                                                      **probe_init_kwargs)
             if n_probe_modes == 1:
                 probe_real = np.stack([np.squeeze(probe_real_init)])
                 probe_imag = np.stack([np.squeeze(probe_imag_init)])
@@ -555,8 +664,8 @@ def reconstruct_ptychography(
             probe_imag = None
         probe_real = comm.bcast(probe_real, root=0)
         probe_imag = comm.bcast(probe_imag, root=0)
-        probe_real = w.create_variable(probe_real, device=device_obj)
-        probe_imag = w.create_variable(probe_imag, device=device_obj)
+        probe_real = w.create_variable(probe_real, dtype=global_settings.compute_dtype, device=device_obj)
+        probe_imag = w.create_variable(probe_imag, dtype=global_settings.compute_dtype, device=device_obj)
 
         # ================================================================================
         # Create variables and optimizers for other parameters (probe, probe defocus,
@@ -633,12 +742,65 @@ def reconstruct_ptychography(
                                     minibatch_size=minibatch_size, alpha=epie_alpha, n_epochs=n_epochs, energy_ev=energy_ev,
                                     psize_cm=psize_cm, output_folder=output_folder,
                                     raw_data_type=raw_data_type)
+            if rotation_coord_store is not None:
+                rotation_coord_store.close()
             return
 
         # ================================================================================
         # Get gradient of loss function w.r.t. optimizable variables.
         # ================================================================================
-        diff = Differentiator()
+        if preprocessed_data_cache_folder is not None:
+            cache_quantity = 'magnitude' if loss_function_type == 'lsq' else 'intensity'
+            # Far-field data are stored in FFT order, which saves the fftshift of predictions in every batch.
+            # The beamstop mask is given in the centered order, so the cache is not reordered if one is used.
+            cache_fft_order = (isinstance(free_prop_cm, str) and free_prop_cm == 'inf' and beamstop is None
+                               and isinstance(forward_model, PtychographyModel))
+            prj_cache = get_preprocessed_data_cache(prj, data_store.path, preprocessed_data_cache_folder,
+                                                    ds_level=ds_level, theta_downsample=theta_downsample,
+                                                    raw_data_type=raw_data_type, quantity=cache_quantity,
+                                                    fft_order=cache_fft_order)
+            forward_model.prj_cache = prj_cache
+            forward_model.prj_cache_quantity = cache_quantity
+            forward_model.prj_cache_fft_order = cache_fft_order
+        else:
+            prj_cache = None
+        if shard_data_by_rank:
+            if rank_shard_ls is None:
+                if two_d_mode:
+                    shard_theta_ind_ls = [np.nonzero(abs(theta_ls - theta_st) < 1e-5)[0][0]]
+                else:
+                    shard_theta_ind_ls = range(n_theta)
+                shard_n_pos_ls = [len(probe_pos)] * n_theta if common_probe_pos else n_pos_ls
+                rank_shard_ls = get_rank_shards(shard_n_pos_ls, shard_theta_ind_ls, n_ranks)
+            t00 = time.time()
+            if prj_cache is not None:
+                prj_cache = ShardedData(prj_cache, rank_shard_ls[rank])
+                forward_model.prj_cache = prj_cache
+            else:
+                if prj_shard is None:
+                    prj_shard = ShardedData(prj, rank_shard_ls[rank], theta_downsample=theta_downsample)
+                forward_model.prj_shard = prj_shard
+            print_flush('Data shard preloaded in {} s.'.format(time.time() - t00), sto_rank, rank, **stdout_options)
+        forward_model.setup(locals())
+        if n_prefetch_batches > 0 and not is_multi_dist:
+            if prj_cache is not None:
+                prefetcher = DataPrefetcher(prj_cache, n_prefetch=n_prefetch_batches, device=device_obj,
+                                            n_read_threads=n_data_read_threads)
+            else:
+                # Data are converted to the quantity compared in the loss function once when they are read, e.g.
+                # photon counts to magnitudes for the least-squares loss.
+                prefetcher = DataPrefetcher(prj if prj_shard is None else prj_shard, theta_downsample=theta_downsample,
+                                            ds_level=ds_level, n_prefetch=n_prefetch_batches, device=device_obj,
+                                            n_read_threads=n_data_read_threads if data_store.parallel_reads else 1,
+                                            raw_data_type=raw_data_type,
+                                            quantity='magnitude' if loss_function_type == 'lsq' else 'intensity')
+            forward_model.prefetcher = prefetcher
+        else:
+            prefetcher = None
+        if use_adjoint:
+            diff = AdjointDifferentiator(forward_model)
+        else:
+            diff = Differentiator()
         calculate_loss = forward_model.get_loss_function()
         diff.create_loss_node(calculate_loss, opt_args_ls)
 
@@ -667,6 +829,10 @@ def reconstruct_ptychography(
         cont = True
         i_epoch = starting_epoch
         i_full_angle = 0
+        if live_mode:
+            n_acquired_prev = np.zeros(n_theta, dtype=int)
+            n_live_epochs_complete = 0
+            t_first_image = None
         while cont:
             t0 = time.time()
 
@@ -686,43 +852,77 @@ def reconstruct_ptychography(
                 temp = abs(theta_ls - theta_st) < 1e-5
                 i_theta = np.nonzero(temp)[0][0]
                 theta_ind_ls = np.array([i_theta])
+            if live_mode:
+                n_acquired_ls = data_store.get_acquired_counts(prj_theta_ind[-1] + 1)[prj_theta_ind]
+                n_acquired_ls = comm.bcast(n_acquired_ls, root=0)
+                n_pos_all_ls = [len(probe_pos)] * n_theta if common_probe_pos else n_pos_ls
+                live_acquisition_complete = np.all(n_acquired_ls >= np.array(n_pos_all_ls))
 
             # ================================================================================
             # Put diffraction spots from all angles together, and divide into minibatches.
             # ================================================================================
-            for i, i_theta in enumerate(theta_ind_ls):
-                n_pos = len(probe_pos) if common_probe_pos else n_pos_ls[i_theta]
-                spots_ls = range(n_pos)
-                if randomize_probe_pos:
-                    spots_ls = np.random.choice(spots_ls, len(spots_ls), replace=False)
-                # ================================================================================
-                # Append randomly selected diffraction spots if necessary, so that a rank won't be given
-                # spots from different angles in one batch.
-                # When using shared file object, we must also ensure that all ranks deal with data at the
-                # same angle at a time.
-                # ================================================================================
-                if (distribution_mode is None and update_scheme == 'immediate') and n_pos % minibatch_size != 0:
-                    spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % minibatch_size],
-                                                                    minibatch_size - (n_pos % minibatch_size),
-                                                                    replace=False))
-                elif (distribution_mode is not None or update_scheme == 'per angle') and n_pos % n_tot_per_batch != 0:
-                    spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % n_tot_per_batch],
-                                                                    n_tot_per_batch - (n_pos % n_tot_per_batch),
-                                                                    replace=False))
-                # ================================================================================
-                # Create task list for the current angle.
-                # ind_list_rand is in the format of [((5, 0), (5, 1), ...), ((17, 0), (17, 1), ..., (...))]
-                #                                    |___________________|   |_____|
-                #                       a batch for all ranks  _|               |_ (i_theta, i_spot)
-                #                    (minibatch_size * n_ranks)
-                # ================================================================================
-                if i == 0:
-                    ind_list_rand = np.vstack([np.array([i_theta] * len(spots_ls)), spots_ls]).transpose()
-                else:
-                    ind_list_rand = np.concatenate(
-                        [ind_list_rand, np.vstack([np.array([i_theta] * len(spots_ls)), spots_ls]).transpose()], axis=0)
-            ind_list_rand = split_tasks(ind_list_rand, n_tot_per_batch)
+            if shard_data_by_rank:
+                ind_list_rand = get_sharded_task_list(rank_shard_ls, minibatch_size,
+                                                      randomize_probe_pos=randomize_probe_pos)
+            else:
+                for i, i_theta in enumerate(theta_ind_ls):
+                    n_pos = len(probe_pos) if common_probe_pos else n_pos_ls[i_theta]
+                    spots_ls = range(n_pos)
+                    if live_mode:
+                        spots_ls = get_live_spots(n_acquired_ls[i_theta], n_acquired_prev[i_theta], n_pos,
+                                                  minibatch_size, new_data_weight=live_new_data_weight)
+                        if len(spots_ls) == 0:
+                            continue
+                        n_pos = len(spots_ls)
+                    if randomize_probe_pos:
+                        spots_ls = np.random.choice(spots_ls, len(spots_ls), replace=False)
+                    # ================================================================================
+                    # Append randomly selected diffraction spots if necessary, so that a rank won't be given
+                    # spots from different angles in one batch.
+                    # When using shared file object, we must also ensure that all ranks deal with data at the
+                    # same angle at a time.
+                    # ================================================================================
+                    if (distribution_mode is None and update_scheme == 'immediate') and n_pos % minibatch_size != 0:
+                        spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % minibatch_size],
+                                                                        minibatch_size - (n_pos % minibatch_size),
+                                                                        replace=False))
+                    elif (distribution_mode is not None or update_scheme == 'per angle') and n_pos % n_tot_per_batch != 0:
+                        spots_ls = np.append(spots_ls, np.random.choice(spots_ls[:-n_pos % n_tot_per_batch],
+                                                                        n_tot_per_batch - (n_pos % n_tot_per_batch),
+                                                                        replace=False))
+                    # ================================================================================
+                    # Create task list for the current angle.
+                    # ind_list_rand is in the format of [((5, 0), (5, 1), ...), ((17, 0), (17, 1), ..., (...))]
+                    #                                    |___________________|   |_____|
+                    #                       a batch for all ranks  _|               |_ (i_theta, i_spot)
+                    #                    (minibatch_size * n_ranks)
+                    # ================================================================================
+                    if len(ind_list_rand) == 0:
+                        ind_list_rand = np.vstack([np.array([i_theta] * len(spots_ls)), spots_ls]).transpose()
+                    else:
+                        ind_list_rand = np.concatenate(
+                            [ind_list_rand, np.vstack([np.array([i_theta] * len(spots_ls)), spots_ls]).transpose()], axis=0)
+                if len(ind_list_rand) == 0:
+                    # Only happens in live mode before enough data have arrived.
+                    print_flush('Waiting for data...', sto_rank, rank, **stdout_options)
+                    time.sleep(live_poll_interval)
+                    continue
+                n_scheduled = len(np.unique(ind_list_rand, axis=0))
+                ind_list_rand = split_tasks(ind_list_rand, n_tot_per_batch)
+            if live_mode:
+                print_flush('{} of {} patterns acquired; {} distinct patterns scheduled in this epoch.'.format(
+                            np.sum(n_acquired_ls), np.sum(n_pos_all_ls), n_scheduled), sto_rank, rank, **stdout_options)
+                n_acquired_prev = n_acquired_ls
             n_batch = len(ind_list_rand)
+            # Supplement the last batch with spots from the first batch if it is not full.
+            for i_batch in range(n_batch):
+                if len(ind_list_rand[i_batch]) < n_tot_per_batch:
+                    n_supp = n_tot_per_batch - len(ind_list_rand[i_batch])
+                    ind_list_rand[i_batch] = np.concatenate([ind_list_rand[i_batch], ind_list_rand[0][:n_supp]])
+            if prefetcher is not None:
+                prefetcher.start([(ind_list_rand[i_batch][rank * minibatch_size, 0],
+                                   np.sort(ind_list_rand[i_batch][rank * minibatch_size:(rank + 1) * minibatch_size, 1]))
+                                  for i_batch in range(starting_batch, n_batch)])
 
             print_flush('Allocation done in {} s.'.format(time.time() - t00), sto_rank, rank, **stdout_options)
 
@@ -766,10 +966,6 @@ def reconstruct_ptychography(
                 # Get scan position, rotation angle indices, and raw data for current batch.
                 # ================================================================================
                 t00 = time.time()
-                if len(ind_list_rand[i_batch]) < n_tot_per_batch:
-                    n_supp = n_tot_per_batch - len(ind_list_rand[i_batch])
-                    ind_list_rand[i_batch] = np.concatenate([ind_list_rand[i_batch], ind_list_rand[0][:n_supp]])
-
                 this_ind_batch_allranks = ind_list_rand[i_batch]
                 this_i_theta = this_ind_batch_allranks[rank * minibatch_size, 0]
                 this_ind_batch = np.sort(this_ind_batch_allranks[rank * minibatch_size:(rank + 1) * minibatch_size, 1])
@@ -788,23 +984,26 @@ def reconstruct_ptychography(
                     current_i_theta = this_i_theta
                     print_flush('  Rotating dataset...', sto_rank, rank, **stdout_options)
                     t_rot_0 = time.time()
-                    if precalculate_rotation_coords:
-                        coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                                      theta_ls[this_i_theta], reverse=False)
+                    if rotation_method == 'fft_shear':
+                        coord_ls = theta_ls[this_i_theta]
+                    elif precalculate_rotation_coords:
+                        coord_ls = forward_model.get_rotation_coords(this_i_theta)
                     else:
                         coord_ls = theta_ls[this_i_theta]
                     if distribution_mode == 'shared_file':
                         obj.rotate_data_in_file(coord_ls, interpolation=interpolation, dset_2=obj.dset_rot,
-                                                precalculate_rotation_coords=precalculate_rotation_coords)
+                                                precalculate_rotation_coords=precalculate_rotation_coords,
+                                                rotation_method=rotation_method)
                     elif distribution_mode == 'distributed_object':
                         obj.rotate_array(coord_ls, interpolation=interpolation,
                                          precalculate_rotation_coords=precalculate_rotation_coords,
                                          apply_to_arr_rot=False, override_backend='autograd', dtype=cache_dtype,
-                                         override_device='cpu')
+                                         override_device='cpu', rotation_method=rotation_method)
                     elif distribution_mode is None and rotate_out_of_loop:
                         obj.rotate_array(coord_ls, interpolation=interpolation,
                                          precalculate_rotation_coords=precalculate_rotation_coords,
-                                         apply_to_arr_rot=False, override_device=device_obj)
+                                         apply_to_arr_rot=False, override_device=device_obj,
+                                         rotation_method=rotation_method)
                     # if mask is not None: mask.rotate_data_in_file(coord_ls[this_i_theta], interpolation=interpolation)
                     comm.Barrier()
                     print_flush('  Dataset rotation done in {} s.'.format(time.time() - t_rot_0), sto_rank, rank, **stdout_options)
@@ -874,7 +1073,11 @@ def reconstruct_ptychography(
                             grad_func_args[arg] = locals()[arg]
                 comm.Barrier()
                 print_flush('  Entering differentiation loop...', sto_rank, rank, **stdout_options)
-                grads = diff.get_gradients(**grad_func_args)
+                if accumulate_dp_batch_gradients and not use_adjoint and n_dp_batch < len(this_ind_batch):
+                    grads = diff.get_gradients_by_subbatch(forward_model, n_dp_batch, split_obj=bool(distribution_mode),
+                                                           **grad_func_args)
+                else:
+                    grads = diff.get_gradients(**grad_func_args)
                 comm.Barrier()
                 print_flush('  Gradient calculation done in {} s.'.format(time.time() - t_grad_0), sto_rank, rank, **stdout_options)
                 grads = list(grads)
@@ -900,19 +1103,29 @@ def reconstruct_ptychography(
                 else:
                     if initialize_gradients:
                         del gradient.arr
-                        gradient.arr = w.zeros(grads[0].shape, requires_grad=False, device=device_obj)
+                        gradient.arr = w.zeros(grads[0].shape, dtype=global_settings.grad_dtype, requires_grad=False,
+                                               device=device_obj)
                     gradient.arr += grads[0]
                     # If rotation is not done in the AD loop, the above gradient array is at theta, and needs to be
                     # rotated back to 0.
                     if rotate_out_of_loop:
-                        if precalculate_rotation_coords:
-                            coord_new = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                                           theta_ls[this_i_theta], reverse=True)
+                        matrix_t = None
+                        if rotation_method == 'fft_shear':
+                            coord_new = theta_ls[this_i_theta]
+                        elif precalculate_rotation_coords:
+                            coord_new = forward_model.get_rotation_coords(this_i_theta)
+                            # With PyTorch, the gradient is on the device, where the matrix is kept as well.
+                            as_tensor = global_settings.backend == 'pytorch'
+                            matrix_dtype = w.get_dtype(gradient.arr) if as_tensor else None
+                            matrix_t = forward_model.get_rotation_matrix(this_i_theta, transpose=True,
+                                                                         interpolation=interpolation,
+                                                                         as_tensor=as_tensor, dtype=matrix_dtype)
                         else:
                             coord_new = -theta_ls[this_i_theta]
                         gradient.rotate_array(coord_new, interpolation=interpolation,
                                               precalculate_rotation_coords=precalculate_rotation_coords,
-                                              override_device=device_obj, overwrite_arr=True)
+                                              override_device=device_obj, overwrite_arr=True,
+                                              rotation_method=rotation_method, adjoint=True, matrix_t=matrix_t)
                 if rank == 0 and debug:
                     print_flush('  Average gradient is {} for rank 0.'.format(w.mean(grads[0])), 0, rank,
                                 **stdout_options)
@@ -999,28 +1212,35 @@ def reconstruct_ptychography(
                 # update the object using gradient at 0 deg.
                 # ================================================================================
                 if distribution_mode and shared_file_update_flag:
-                    if precalculate_rotation_coords:
-                        coord_new = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
-                                                       theta_ls[this_i_theta], reverse=True)
+                    matrix_t = None
+                    if rotation_method == 'fft_shear':
+                        coord_new = theta_ls[this_i_theta]
+                    elif precalculate_rotation_coords:
+                        coord_new = forward_model.get_rotation_coords(this_i_theta)
+                        matrix_t = forward_model.get_rotation_matrix(this_i_theta, transpose=True,
+                                                                     interpolation=interpolation)
                     else:
                         coord_new = -theta_ls[this_i_theta]
                     print_flush('  Rotating gradient dataset back...', sto_rank, rank, **stdout_options)
                     t_rot_0 = time.time()
                     if distribution_mode == 'shared_file':
                         gradient.rotate_data_in_file(coord_new, interpolation=interpolation,
-                                                     precalculate_rotation_coords=precalculate_rotation_coords)
+                                                     precalculate_rotation_coords=precalculate_rotation_coords,
+                                                     rotation_method=rotation_method, adjoint=True,
+                                                     matrix_t=matrix_t)
                     elif distribution_mode == 'distributed_object':
                         gradient.rotate_array(coord_new, interpolation=interpolation,
                                               precalculate_rotation_coords=precalculate_rotation_coords,
                                               apply_to_arr_rot=False, overwrite_arr=True, override_backend='autograd',
-                                              dtype=cache_dtype, override_device='cpu')
+                                              dtype=global_settings.get_dtype('grad', cache_dtype), override_device='cpu',
+                                              rotation_method=rotation_method, adjoint=True, matrix_t=matrix_t)
                     comm.Barrier()
                     print_flush('  Gradient rotation done in {} s.'.format(time.time() - t_rot_0), sto_rank, rank, **stdout_options)
 
                     t_apply_grad_0 = time.time()
                     if distribution_mode == 'shared_file' and optimize_object:
                         opt.apply_gradient_to_file(obj, gradient, i_batch=i_full_angle, **optimizer_options_obj)
-                        gradient.initialize_gradient_file()
+                        gradient.initialize_gradient_file(dtype=global_settings.get_dtype('storage', 'float32'))
                     elif distribution_mode == 'distributed_object' and obj.arr is not None and optimize_object:
                         obj.arr = opt.apply_gradient(obj.arr, gradient.arr / n_ranks, i_full_angle, **optimizer_options_obj)
                         gradient.arr[...] = 0
@@ -1090,11 +1310,18 @@ def reconstruct_ptychography(
                 # ================================================================================
                 if i_batch == n_batch - 1 or ind_list_rand[i_batch + 1][0, 0] != current_i_theta: i_full_angle += 1
 
+            if prefetcher is not None:
+                prefetcher.stop()
+
             # ================================================================================
             # Stopping criterion.
             # ================================================================================
             if n_epochs == 'auto':
                     pass
+            elif live_mode:
+                if live_acquisition_complete:
+                    n_live_epochs_complete += 1
+                    if n_live_epochs_complete >= n_epochs: cont = False
             else:
                 if i_epoch == n_epochs - 1: cont = False
 
@@ -1112,5 +1339,10 @@ def reconstruct_ptychography(
                               full_output=True, ds_level=ds_level)
                 output_probe(optimizable_params['probe_real'], optimizable_params['probe_imag'], output_folder,
                              full_output=True, ds_level=ds_level)
+            if live_mode and t_first_image is None:
+                t_first_image = time.time() - t_zero
+                print_flush('Time to first image: {} s.'.format(t_first_image), sto_rank, rank, **stdout_options)
             print_flush('Current iteration finished.', sto_rank, rank, **stdout_options)
         comm.Barrier()
+        if rotation_coord_store is not None:
+            rotation_coord_store.close()
@@ -0,0 +1,283 @@
+import numpy as np
+import os
+import socket
+import atexit
+import hashlib
+from math import floor
+try:
+    from mpi4py import MPI
+except:
+    from adorym.pseudo import MPI
+
+import adorym.wrappers as w
+import adorym.global_settings as global_settings
+from adorym.constants import PI
+from adorym.util import get_cooridnates_stack_for_rotation, calculate_original_coordinates_for_rotation, \
+    get_interpolation_matrix
+
+comm = MPI.COMM_WORLD
+n_ranks = comm.Get_size()
+rank = comm.Get_rank()
+
+
+def get_node_comm():
+    """
+    Get the communicator of ranks sharing memory with this rank, or COMM_WORLD if MPI can't tell.
+    """
+    try:
+        return comm.Split_type(MPI.COMM_TYPE_SHARED)
+    except AttributeError:
+        return comm
+
+
+class RotationCoordinateStore(object):
+    """
+    Rotation coordinates about axis 0 of all angles, kept in a single memory-mapped file shared by the ranks of a
+    node. For each voxel of the rotated object, the file holds the flattened integer index of the voxel at the
+    floor of its coordinates in the unrotated frame, and the fractional parts of the coordinates as integers
+    scaled by the maximum of frac_dtype. Coordinates are clipped to the array, which is how all consumers treat
+    out-of-array coordinates anyway. Only forward rotations are stored, as rotating back uses the transpose of
+    the forward interpolation. Angles are computed when first requested.
+    """
+    def __init__(self, array_size, theta_ls, folder=None, frac_dtype='uint16'):
+        """
+        :param array_size: size of the object in [y, x, z].
+        :param folder: where the file is kept. If given, the file is named after the array size and the angles and
+                       persists after close(), so that later runs on the same node reuse it. If None, a file private
+                       to this run is created in /dev/shm if it exists (so that it stays in RAM) or in the working
+                       directory otherwise, and deleted by close(), or when the process exits if close() is not
+                       reached.
+        """
+        self.array_size = [int(x) for x in array_size[:3]]
+        self.theta_ls = np.array(theta_ls, dtype='float64')
+        self.n_theta = len(self.theta_ls)
+        self.frac_dtype = np.dtype(frac_dtype)
+        self.frac_scale = np.iinfo(self.frac_dtype).max
+        self.keep_file = folder is not None
+        if folder is None:
+            folder = '/dev/shm' if os.path.isdir('/dev/shm') else '.'
+        n_vox = self.array_size[1] * self.array_size[2]
+        self.dtype = np.dtype([('base', 'int32', (n_vox,)), ('frac', self.frac_dtype, (n_vox, 2)),
+                               ('computed', 'uint8')])
+        self.node_comm = get_node_comm()
+        key = hashlib.sha1(self.theta_ls.tobytes() + self.frac_dtype.str.encode()).hexdigest()[:16]
+        if not self.keep_file:
+            key += '_{}_{}'.format(socket.gethostname(), self.node_comm.bcast(os.getpid(), root=0))
+        self.fname = os.path.join(folder, 'adorym_rotation_coords_{}_{}_{}_{}.npy'.format(*self.array_size, key))
+        if self.node_comm.Get_rank() == 0 and not os.path.exists(self.fname):
+            os.makedirs(folder, exist_ok=True)
+            # Row i_theta holds the coordinates of angle i_theta.
+            tmp_fname = '{}.{}.{}.tmp'.format(self.fname, socket.gethostname(), os.getpid())
+            np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=self.dtype, shape=(self.n_theta,))
+            os.replace(tmp_fname, self.fname)
+        self.node_comm.Barrier()
+        self.table = np.load(self.fname, mmap_mode='r+')
+        self.coords = {}
+        self.grids = {}
+        self.matrices = {}
+        if not self.keep_file and self.node_comm.Get_rank() == 0:
+            # A private file in /dev/shm takes RAM until it is deleted, so do not leave it behind if the run fails.
+            atexit.register(self.remove_private_file)
+
+    def remove_private_file(self):
+        if not self.keep_file and os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def close(self):
+        """
+        Release the file, and delete it if it is private to this run. Must be called by all ranks.
+        """
+        self.coords = {}
+        self.grids = {}
+        self.matrices = {}
+        del self.table
+        self.node_comm.Barrier()
+        if self.node_comm.Get_rank() == 0:
+            self.remove_private_file()
+
+    def compute(self, i_theta):
+        coord_new = get_cooridnates_stack_for_rotation(self.array_size, axis=0)
+        coord_old = calculate_original_coordinates_for_rotation(self.array_size, coord_new, self.theta_ls[i_theta],
+                                                                override_backend='autograd')
+        coord_old = np.stack([np.clip(coord_old[:, 0], 0, self.array_size[1] - 1),
+                              np.clip(coord_old[:, 1], 0, self.array_size[2] - 1)], axis=1)
+        base = np.floor(coord_old)
+        i_row = int(i_theta)
+        self.table['frac'][i_row] = np.round((coord_old - base) * self.frac_scale)
+        self.table['base'][i_row] = base[:, 0] * self.array_size[2] + base[:, 1]
+        self.table['computed'][i_row] = 1
+
+    def get_coords(self, i_theta, keep_in_memory=True):
+        """
+        Get coordinates in the unrotated frame of all voxels in a slice of the rotated object, in [N, 2].
+        :param keep_in_memory: if True, decoded coordinates are also kept in RAM.
+        """
+        key = int(i_theta)
+        if key in self.coords:
+            return self.coords[key]
+        if not self.table['computed'][key]:
+            self.compute(i_theta)
+        base = self.table['base'][key]
+        coords = np.stack([base // self.array_size[2], base % self.array_size[2]], axis=1).astype('float32')
+        coords += self.table['frac'][key] / np.float32(self.frac_scale)
+        if keep_in_memory:
+            self.coords[key] = coords
+        return coords
+
+    def get_grid(self, i_theta, device=None, dtype='float32', keep_in_memory=True):
+        """
+        Get coordinates as a sampling grid normalized for wrappers.grid_sample, which then needs neither
+        conversion nor copies of the grid for each slice. Requires PyTorch.
+        """
+        key = (int(i_theta), str(device), dtype)
+        if key in self.grids:
+            return self.grids[key]
+        grid = w.normalize_sampling_grid(self.get_coords(i_theta, keep_in_memory=False),
+                                         self.array_size[1:3], device=device)
+        grid = w.cast(grid, dtype, override_backend='pytorch')
+        if keep_in_memory:
+            self.grids[key] = grid
+        return grid
+
+    def get_interpolation_matrix(self, i_theta, interpolation='bilinear', transpose=False, keep_in_memory=True):
+        """
+        Get the sparse interpolation matrix of the coordinates, used for rotation with the Autograd backend.
+        :param transpose: if True, get the transposed matrix in CSR format, used to rotate back (see
+                          apply_rotation_adjoint).
+        """
+        key = (int(i_theta), interpolation, transpose)
+        if key in self.matrices:
+            return self.matrices[key]
+        if transpose:
+            matrix = self.get_interpolation_matrix(i_theta, interpolation=interpolation,
+                                                   keep_in_memory=keep_in_memory).T.tocsr()
+        else:
+            matrix = get_interpolation_matrix(self.get_coords(i_theta, keep_in_memory=False),
+                                              self.array_size[1:3], interpolation=interpolation)
+        if keep_in_memory:
+            self.matrices[key] = matrix
+        return matrix
+
+    def get_sparse_tensor(self, i_theta, interpolation='bilinear', transpose=False, device=None, dtype='float32',
+                          keep_in_memory=True):
+        """
+        Get the interpolation matrix (or its transpose) as a PyTorch sparse tensor on device, so that
+        wrappers.sparse_matmul does not convert and upload it on every call. Requires PyTorch.
+        """
+        key = ('tensor', int(i_theta), interpolation, transpose, str(device), dtype)
+        if key in self.matrices:
+            return self.matrices[key]
+        matrix = w.to_sparse_tensor(self.get_interpolation_matrix(i_theta, interpolation=interpolation,
+                                                                  transpose=transpose, keep_in_memory=keep_in_memory),
+                                    dtype=dtype, device=device)
+        if keep_in_memory:
+            self.matrices[key] = matrix
+        return matrix
+
+
+def get_quarter_turn_indices(image_shape, n_quarter_turns):
+    """
+    Get indices that rotate images in [H, W] by n_quarter_turns * 90 degrees about the same center as
+    rotation with precalculated coordinates, i.e. out[j] = arr[M j] with M the rotation matrix. Indices wrap
+    around the edges, so the permutation is exact and its transpose is the rotation by the opposite angle.
+    """
+    n_quarter_turns = n_quarter_turns % 4
+    if n_quarter_turns % 2 == 1 and image_shape[0] != image_shape[1]:
+        raise ValueError('Rotating by an odd multiple of 90 degrees requires square slices.')
+    center = [floor(x / 2) for x in image_shape]
+    c = int(round(np.cos(n_quarter_turns * PI / 2)))
+    s = int(round(np.sin(n_quarter_turns * PI / 2)))
+    c1, c2 = np.meshgrid(np.arange(image_shape[0]) - center[0], np.arange(image_shape[1]) - center[1],
+                         indexing='ij')
+    ind_1 = (c * c1 - s * c2 + center[0]) % image_shape[0]
+    ind_2 = (s * c1 + c * c2 + center[1]) % image_shape[1]
+    return ind_1, ind_2
+
+
+def get_shear_multiplier(image_shape, amount, shear_axis, dtype='float64', device=None, override_backend=None):
+    """
+    Get the Fourier-domain multiplier that shears images in [H, W] along shear_axis (0 or 1) by amount pixels per
+    pixel along the other axis, i.e. out(c) = arr(c + amount * c_other * e_shear_axis). The Nyquist frequency of
+    even-sized axes is given only the real part of its phase factor, so that real images stay real and the
+    shear by -amount is the exact transpose.
+    :return: real and imaginary parts, broadcastable to [N, H, W].
+    """
+    center = [floor(x / 2) for x in image_shape]
+    freq = np.fft.fftfreq(image_shape[shear_axis])
+    coords = np.arange(image_shape[1 - shear_axis]) - center[1 - shear_axis]
+    phase = 2 * PI * amount * np.outer(freq, coords)
+    mult_imag = np.sin(phase)
+    if image_shape[shear_axis] % 2 == 0:
+        mult_imag[image_shape[shear_axis] // 2] = 0
+    mult_real = np.cos(phase)
+    if shear_axis == 1:
+        mult_real, mult_imag = mult_real.T, mult_imag.T
+    mult_real = w.create_variable(mult_real[None], dtype=dtype, requires_grad=False, device=device,
+                                  override_backend=override_backend)
+    mult_imag = w.create_variable(mult_imag[None], dtype=dtype, requires_grad=False, device=device,
+                                  override_backend=override_backend)
+    return mult_real, mult_imag
+
+
+def rotate_fft_shear(obj, theta, adjoint=False, device=None, override_backend=None):
+    """
+    Rotate an object about axis 0 by three Fourier-domain shears, processing all slices at once. The result
+    matches rotation with precalculated coordinates of the same angle, except that the object is treated as
+    periodic instead of being padded with edge values; nothing is interpolated, so repeated rotation does not
+    blur the object. Multiples of 90 degrees are done by exact index permutations and only the remainder by
+    shears, which keeps the shears small.
+    :param obj: object in [N, H, W, C] or [N, H, W]. With 2 channels, both are rotated in one complex array.
+    :param theta: angle in radian.
+    :param adjoint: if True, apply the transpose of the rotation by theta. It is also the inverse, except for the
+                    Nyquist frequency of even-sized slices.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    image_shape = obj.shape[1:3]
+    n_quarter_turns = int(np.round(theta / (PI / 2)))
+    if n_quarter_turns % 2 == 1 and image_shape[0] != image_shape[1]:
+        n_quarter_turns = 2 * int(np.round(theta / PI))
+    residue = theta - n_quarter_turns * PI / 2
+    if adjoint:
+        n_quarter_turns, residue = -n_quarter_turns, -residue
+    dtype = 'float32' if '32' in str(obj.dtype) else 'float64'
+
+    def quarter_turn(arr):
+        if n_quarter_turns % 4 == 0:
+            return arr
+        ind_1, ind_2 = get_quarter_turn_indices(image_shape, n_quarter_turns)
+        if bn == 'pytorch':
+            ind_1 = w.create_variable(ind_1, dtype='int64', requires_grad=False, device=device, override_backend=bn)
+            ind_2 = w.create_variable(ind_2, dtype='int64', requires_grad=False, device=device, override_backend=bn)
+        return arr[:, ind_1, ind_2]
+
+    def shear(arr):
+        if abs(residue) < 1e-10:
+            return arr
+        alpha = -np.tan(residue / 2)
+        beta = np.sin(residue)
+        # Rotation matrix = shear(axis 0, alpha) @ shear(axis 1, beta) @ shear(axis 0, alpha).
+        for amount, shear_axis in ((alpha, 0), (beta, 1), (alpha, 0)):
+            mult_real, mult_imag = get_shear_multiplier(image_shape, amount, shear_axis, dtype=dtype,
+                                                        device=device, override_backend=bn)
+            mult = w.to_complex(mult_real, mult_imag, override_backend=bn)
+            arr = w.ifft_complex(w.fft_complex(arr, axis=shear_axis + 1, override_backend=bn) * mult,
+                                 axis=shear_axis + 1, override_backend=bn)
+        return arr
+
+    if len(obj.shape) == 4 and obj.shape[-1] == 2:
+        arr = w.to_complex(obj[:, :, :, 0], obj[:, :, :, 1], override_backend=bn)
+    elif len(obj.shape) == 4:
+        arr = w.to_complex(obj[:, :, :, 0], 0., override_backend=bn)
+    else:
+        arr = w.to_complex(obj, 0., override_backend=bn)
+    if not adjoint:
+        arr = shear(quarter_turn(arr))
+    else:
+        arr = quarter_turn(shear(arr))
+    arr_real, arr_imag = w.split_complex(arr, override_backend=bn)
+    if len(obj.shape) == 4 and obj.shape[-1] == 2:
+        return w.stack([arr_real, arr_imag], axis=3, override_backend=bn)
+    elif len(obj.shape) == 4:
+        return w.reshape(arr_real, obj.shape, override_backend=bn)
+    else:
+        return arr_real
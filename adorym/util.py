@@ -24,6 +24,8 @@ import os
 import pickle
 import glob
 from scipy.special import erf
+from scipy.sparse import csr_matrix
+from concurrent.futures import ThreadPoolExecutor
 
 from adorym.constants import *
 import adorym.wrappers as w
@@ -208,6 +210,8 @@ def initialize_probe(probe_size, probe_type, pupil_function=None, probe_initial=
             probe_guess_kwargs['raw_data_type'] = kwargs['raw_data_type']
         if 'beamstop' in kwargs.keys() and kwargs['beamstop'] is not None:
             probe_guess_kwargs['beamstop'] = [w.to_numpy(i) for i in kwargs['beamstop']]
+        if kwargs.get('data_stats') is not None:
+            probe_guess_kwargs['mean_magnitude'] = kwargs['data_stats']['mean_magnitude']
         probe_init = create_probe_initial_guess_ptycho(os.path.join(save_path, fname), sign_convention=sign_convention, **probe_guess_kwargs)
         probe_real = probe_init.real
         probe_imag = probe_init.imag
@@ -235,26 +239,27 @@ def initialize_probe(probe_size, probe_type, pupil_function=None, probe_initial=
     #     probe_real, probe_imag = np.real(wavefront), np.imag(wavefront)
     if rescale_intensity:
         n_probe_modes = kwargs['n_probe_modes']
-        f = h5py.File(os.path.join(save_path, fname), 'r')
-        dat = f['exchange/data'][...]
-        if kwargs['raw_data_type'] == 'magnitude':
-            dat = dat ** 2
+        if kwargs.get('data_stats') is not None:
+            mean_intensity = kwargs['data_stats']['mean_intensity']
+        else:
+            mean_intensity = get_dataset_statistics(os.path.join(save_path, fname),
+                                                    raw_data_type=kwargs['raw_data_type'],
+                                                    collective=False)['mean_intensity']
         if not kwargs['normalize_fft']:
             # The direct return of FFT function has a total power that is n_pixels times of the input.
             # This should be removed.
             if sign_convention == 1:
-                intensity_target = np.sum(np.mean(np.abs(dat), axis=(0, 1))) / np.prod(probe_real.shape[-2:])
+                intensity_target = np.sum(mean_intensity) / np.prod(probe_real.shape[-2:])
             else:
-                intensity_target = np.sum(np.mean(np.abs(dat), axis=(0, 1))) * np.prod(probe_real.shape[-2:])
+                intensity_target = np.sum(mean_intensity) * np.prod(probe_real.shape[-2:])
         else:
-            intensity_target = np.sum(np.mean(np.abs(dat), axis=(0, 1)))
+            intensity_target = np.sum(mean_intensity)
         intensity_current = np.sum(probe_real ** 2 + probe_imag ** 2)
         s = np.sqrt(intensity_target / intensity_current)
         # s = np.sqrt(intensity_target / intensity_current / n_probe_modes)
         probe_real = probe_real * s
         probe_imag = probe_imag * s
         print_flush('Probe magnitude scaling factor is {}.'.format(s), 0, rank, **kwargs['stdout_options'])
-        f.close()
     return probe_real, probe_imag
 
 
@@ -272,13 +277,102 @@ def create_probe_initial_guess(data_fname, dist_nm, energy_ev, psize_nm, raw_dat
     return wavefront
 
 
-def create_probe_initial_guess_ptycho(data_fname, noise=False, raw_data_type='intensity', beamstop=None, sign_convention=1):
-
+def get_dataset_statistics(data_fname, raw_data_type='intensity', chunk_size=256, recompute=False, collective=True,
+                           save_to_file=True):
+    """
+    Get statistics of diffraction data in one streaming pass, with reads distributed over ranks and results
+    reduced with MPI. Results are saved in group "statistics" of the HDF5 file, and read from there in later calls.
+    Note that this modifies the raw data file (which is opened in r+ mode for this). If the file is not writable,
+    a warning is issued and statistics are recomputed in every call.
+    :param raw_data_type: 'magnitude' or 'intensity'; type of data in exchange/data.
+    :param chunk_size: number of diffraction patterns in each read.
+    :param collective: if True, must be called by all ranks. Otherwise the calling rank reads all data itself.
+    :param save_to_file: if False, the raw data file is left untouched and statistics are not saved.
+    :return: dict with keys 'mean_magnitude' and 'mean_intensity' (mean patterns), 'total_intensity',
+             'max_intensity' and 'intensity_sum_per_angle'.
+    """
+    keys = ['mean_magnitude', 'mean_intensity', 'total_intensity', 'max_intensity', 'intensity_sum_per_angle']
     f = h5py.File(data_fname, 'r')
-    dat = f['exchange/data'][...]
-    if raw_data_type == 'intensity':
-        dat = np.sqrt(dat)
-    wavefront = np.mean(np.abs(dat), axis=(0, 1))
+    dset = f['exchange/data']
+    shape = dset.shape
+    if not recompute and 'statistics' in f:
+        grp = f['statistics']
+        if grp.attrs.get('raw_data_type') == raw_data_type and tuple(grp.attrs.get('data_shape', ())) == tuple(shape):
+            stats = {key: grp[key][...] for key in keys}
+            f.close()
+            return stats
+
+    stats = compute_dataset_statistics(dset, raw_data_type=raw_data_type, chunk_size=chunk_size, collective=collective)
+    f.close()
+
+    if save_to_file and (rank == 0 or not collective):
+        try:
+            f = h5py.File(data_fname, 'r+')
+        except OSError as e:
+            f = None
+            warnings.warn('Cannot save dataset statistics to {}, so they will be computed again in the next run: '
+                          '{}'.format(data_fname, e))
+        if f is not None:
+            if 'statistics' in f:
+                del f['statistics']
+            grp = f.create_group('statistics')
+            for key in keys:
+                grp.create_dataset(key, data=stats[key])
+            grp.attrs['raw_data_type'] = raw_data_type
+            grp.attrs['data_shape'] = shape
+            f.close()
+    if collective:
+        comm.Barrier()
+    return stats
+
+
+def compute_dataset_statistics(dset, raw_data_type='intensity', chunk_size=256, collective=True):
+    """
+    Compute statistics of diffraction data in one streaming pass. See get_dataset_statistics.
+    :param dset: array-like of shape [n_theta, n_spots, len_y, len_x] supporting dset[i_theta, slice].
+    """
+    shape = dset.shape
+    t0 = time.time()
+    print_flush('Computing dataset statistics...', 0, rank, save_stdout=False)
+    sum_mag = np.zeros(shape[2:])
+    sum_int = np.zeros(shape[2:])
+    sum_per_angle = np.zeros(shape[0])
+    max_int = 0.
+    task_ls = [(i_theta, i_st) for i_theta in range(shape[0]) for i_st in range(0, shape[1], chunk_size)]
+    if collective:
+        task_ls = task_ls[rank::n_ranks]
+    for i_theta, i_st in task_ls:
+        dat = np.abs(dset[i_theta, i_st:min(i_st + chunk_size, shape[1])]).astype('float64')
+        if raw_data_type == 'intensity':
+            mag, intensity = np.sqrt(dat), dat
+        else:
+            mag, intensity = dat, dat ** 2
+        sum_mag += np.sum(mag, axis=0)
+        sum_int += np.sum(intensity, axis=0)
+        sum_per_angle[i_theta] += np.sum(intensity)
+        max_int = max(max_int, float(np.max(intensity)))
+    n_patterns = shape[0] * shape[1]
+    if collective:
+        sum_mag = comm.allreduce(sum_mag)
+        sum_int = comm.allreduce(sum_int)
+        sum_per_angle = comm.allreduce(sum_per_angle)
+        max_int = comm.allreduce(max_int, op=MPI.MAX)
+    stats = {'mean_magnitude': sum_mag / n_patterns,
+             'mean_intensity': sum_int / n_patterns,
+             'total_intensity': np.array(np.sum(sum_per_angle)),
+             'max_intensity': np.array(max_int),
+             'intensity_sum_per_angle': sum_per_angle}
+    print_flush('Dataset statistics computed in {} s.'.format(time.time() - t0), 0, rank, save_stdout=False)
+    return stats
+
+
+def create_probe_initial_guess_ptycho(data_fname, noise=False, raw_data_type='intensity', beamstop=None, sign_convention=1,
+                                      mean_magnitude=None):
+
+    if mean_magnitude is None:
+        mean_magnitude = get_dataset_statistics(data_fname, raw_data_type=raw_data_type,
+                                                collective=False)['mean_magnitude']
+    wavefront = mean_magnitude
     if beamstop is not None:
         beamstop_mask = beamstop[0]
         xx, yy =  np.meshgrid(range(beamstop_mask.shape[1]), range(beamstop_mask.shape[0]))
@@ -304,7 +398,6 @@ def create_probe_initial_guess_ptycho(data_fname, noise=False, raw_data_type='in
         wavefront_mean = np.mean(wavefront)
         wavefront += np.random.normal(size=wavefront.shape, loc=wavefront_mean, scale=wavefront_mean * 0.2)
         wavefront = np.clip(wavefront, 0, None)
-    f.close()
     return wavefront
 
 
@@ -372,6 +465,25 @@ def realign_image_fourier(a_real, a_imag, shift, axes=(0, 1), device=None):
     return w.ifft2(a_real, a_imag, axes=axes)
 
 
+def shift_images_fourier_batch(a_real, a_imag, shifts, device=None):
+    """
+    Shift the same complex image(s) by a batch of sub-pixel shifts using one FFT pair.
+    :param a_real: [..., y, x].
+    :param shifts: [n, 2] array of (y, x) shifts in pixels.
+    :return: Real and imaginary parts in [n, ..., y, x].
+    """
+    f_real, f_imag = w.fft2(a_real, a_imag)
+    freq_y, freq_x = get_freq_grid_variable(a_real.shape[-2:], device=device)
+    n = shifts.shape[0]
+    broadcast_shape = [n] + [1] * len(a_real.shape)
+    shift_y = w.reshape(shifts[:, 0], broadcast_shape)
+    shift_x = w.reshape(shifts[:, 1], broadcast_shape)
+    phase = -2 * PI * (freq_x * shift_x + freq_y * shift_y)
+    mult_real, mult_imag = w.cos(phase), w.sin(phase)
+    a_real, a_imag = (f_real * mult_real - f_imag * mult_imag, f_real * mult_imag + f_imag * mult_real)
+    return w.ifft2(a_real, a_imag)
+
+
 def create_batches(arr, batch_size):
 
     arr_len = len(arr)
@@ -499,91 +611,131 @@ def read_all_origin_coords(src_folder, theta_ls):
     return coord_ls
 
 
-def apply_rotation(obj, coord_old, interpolation='bilinear', axis=0, device=None, override_backend=None):
-
+def apply_rotation(obj, coord_old, interpolation='bilinear', axis=0, device=None, override_backend=None, grid=None,
+                   matrix=None):
+    """
+    :param grid: sampling grid of coord_old already normalized for grid_sample, e.g. from
+                 RotationCoordinateStore.get_grid. Saves normalizing coord_old again if given.
+    :param matrix: interpolation matrix of coord_old, e.g. from RotationCoordinateStore.get_interpolation_matrix.
+                   Only used with the Autograd backend.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return apply_rotation_primitive(obj, coord_old, interpolation=interpolation, axis=axis,
+                                        override_backend=bn, matrix=matrix)
     # PyTorch CPU doesn't support float16 computation.
     if device is None or device == 'cpu':
         coord_old = coord_old.astype('float64')
     try:
-        obj_rot = w.grid_sample(obj, coord_old, axis=axis, interpolation=interpolation, device=device)
+        if grid is not None:
+            obj_rot = w.grid_sample(obj, grid, axis=axis, interpolation=interpolation, device=device,
+                                    grid_normalized=True)
+        else:
+            obj_rot = w.grid_sample(obj, coord_old, axis=axis, interpolation=interpolation, device=device)
     except:
         warnings.warn('PyTorch is not available, so I am applying rotation using apply_rotation_primitive which may '
                       'lead to lower performance. Installing PyTorch is strongly recommnended even if you do not'
                       'wish to use the PyTorch backend for AD.')
-        obj_rot = apply_rotation_primitive(obj, coord_old, axis=axis, interpolation=interpolation, device=device)
+        obj_rot = apply_rotation_primitive(obj, coord_old, axis=axis, interpolation=interpolation,
+                                           override_backend=override_backend)
     return obj_rot
 
 
-def apply_rotation_primitive(obj, coord_old, interpolation='bilinear', axis=0, device=None, override_backend=None):
-
-    # PyTorch CPU doesn't support float16 computation.
-    if global_settings.backend == 'pytorch' and device is None:
-        coord_old = coord_old.astype('float64')
-
+def get_interpolation_matrix(coord_old, image_shape, interpolation='bilinear'):
+    """
+    Get the sparse matrix that samples a flattened image at coord_old. Edge values are used beyond the boundary,
+    as in grid_sample with padding_mode='border'.
+    :param coord_old: [N, 2] coordinates in pixels.
+    :param image_shape: (H, W) of the image to be sampled.
+    :return: scipy.sparse.csr_matrix in [N, H * W].
+    """
+    c1 = np.clip(coord_old[:, 0].astype('float64'), 0, image_shape[0] - 1)
+    c2 = np.clip(coord_old[:, 1].astype('float64'), 0, image_shape[1] - 1)
+    n = len(c1)
+    shape = [n, image_shape[0] * image_shape[1]]
+    if interpolation == 'nearest':
+        ind = np.round(c1).astype(int) * image_shape[1] + np.round(c2).astype(int)
+        return csr_matrix((np.ones(n), (np.arange(n), ind)), shape=shape)
+    floor_1 = np.floor(c1).astype(int)
+    floor_2 = np.floor(c2).astype(int)
+    ceil_1 = np.minimum(floor_1 + 1, image_shape[0] - 1)
+    ceil_2 = np.minimum(floor_2 + 1, image_shape[1] - 1)
+    frac_1 = c1 - floor_1
+    frac_2 = c2 - floor_2
+    rows = np.tile(np.arange(n), 4)
+    cols = np.concatenate([floor_1 * image_shape[1] + floor_2, floor_1 * image_shape[1] + ceil_2,
+                           ceil_1 * image_shape[1] + floor_2, ceil_1 * image_shape[1] + ceil_2])
+    vals = np.concatenate([(1 - frac_1) * (1 - frac_2), (1 - frac_1) * frac_2,
+                           frac_1 * (1 - frac_2), frac_1 * frac_2])
+    # Duplicate entries, from coordinates on the last row or column, are summed.
+    return csr_matrix((vals, (rows, cols)), shape=shape)
+
+
+def apply_rotation_primitive(obj, coord_old, interpolation='bilinear', axis=0, device=None, override_backend=None,
+                             matrix=None):
+    """
+    Rotate all slices of obj at once by multiplying with a sparse interpolation matrix. The gradient is the
+    product with the transposed matrix, so it is computed without going through the generic indexing gradient.
+    :param matrix: output of get_interpolation_matrix for coord_old. Built from coord_old if None.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
     s = obj.shape
-    axes_rot = []
-    for i in range(len(obj.shape)):
-        if i != axis and i <= 2:
-            axes_rot.append(i)
-    coord_old = w.create_variable(coord_old, device=device, requires_grad=False, override_backend=override_backend)
+    axes_rot = [i for i in range(3) if i != axis]
+    if matrix is None:
+        matrix = get_interpolation_matrix(coord_old, [s[axes_rot[0]], s[axes_rot[1]]], interpolation=interpolation)
+    # Move rotated axes to the front, and fold the rest into the columns of a 2D array.
+    axes_order = axes_rot + [axis] + list(range(3, len(s)))
+    arr = w.permute_axes(obj, axes_order, override_backend=bn)
+    arr = w.reshape(arr, [s[axes_rot[0]] * s[axes_rot[1]], -1], override_backend=bn)
+    arr = w.sparse_matmul(matrix, arr, override_backend=bn)
+    # The matrix may cover only some rows of the rotated slices, which then have fewer voxels along the first axis.
+    arr = w.reshape(arr, [-1] + [s[i] for i in axes_order[1:]], override_backend=bn)
+    return w.permute_axes(arr, [int(i) for i in np.argsort(axes_order)], override_backend=bn)
+
+
+def apply_interpolation_matrix_to_slices(arr, matrix, slice_chunk_size=16, n_threads=4):
+    """
+    Multiply each slice of a Numpy array in [N, H, W, ...] by a sparse interpolation matrix, processing chunks of
+    slice_chunk_size slices in n_threads threads.
+    """
+    s = arr.shape
+    arr_rot = np.empty_like(arr)
 
-    if interpolation == 'nearest':
-        coord_old_1 = w.round_and_cast(coord_old[:, 0], override_backend=override_backend)
-        coord_old_2 = w.round_and_cast(coord_old[:, 1], override_backend=override_backend)
-    else:
-        coord_old_1 = coord_old[:, 0]
-        coord_old_2 = coord_old[:, 1]
+    def process_chunk(i_start):
+        chunk = arr[i_start:i_start + slice_chunk_size]
+        n = chunk.shape[0]
+        chunk = np.reshape(np.moveaxis(chunk, 0, 2), [s[1] * s[2], -1])
+        chunk = np.reshape(matrix.dot(chunk), [s[1], s[2], n, *s[3:]])
+        arr_rot[i_start:i_start + n] = np.moveaxis(chunk, 2, 0)
 
-    # Clip coords, so that edge values are used for out-of-array indices
-    coord_old_1 = w.clip(coord_old_1, 0, s[axes_rot[0]] - 2, override_backend=override_backend)
-    coord_old_2 = w.clip(coord_old_2, 0, s[axes_rot[1]] - 2, override_backend=override_backend)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(process_chunk, range(0, s[0], slice_chunk_size)))
+    return arr_rot
 
-    if interpolation == 'nearest':
-        slicer = [slice(None), slice(None), slice(None)]
-        slicer[axes_rot[0]] = coord_old_1
-        slicer[axes_rot[1]] = coord_old_2
-        obj_rot = w.reshape(obj[slicer], s, override_backend=override_backend)
-    else:
-        coord_old_floor_1 = w.floor_and_cast(coord_old_1, dtype='int64', override_backend=override_backend)
-        coord_old_ceil_1 = coord_old_floor_1 + 1
-        coord_old_floor_2 = w.floor_and_cast(coord_old_2, dtype='int64', override_backend=override_backend)
-        coord_old_ceil_2 = coord_old_floor_2 + 1
-
-        obj_rot = []
-        fac_ff = (coord_old_ceil_1 - coord_old_1) * (coord_old_ceil_2 - coord_old_2)
-        fac_fc = (coord_old_ceil_1 - coord_old_1) * (coord_old_2 - coord_old_floor_2)
-        fac_cf = (coord_old_1 - coord_old_floor_1) * (coord_old_ceil_2 - coord_old_2)
-        fac_cc = (coord_old_1 - coord_old_floor_1) * (coord_old_2 - coord_old_floor_2)
-        fac_ff = w.stack([fac_ff] * 2, axis=1, override_backend=override_backend)
-        fac_fc = w.stack([fac_fc] * 2, axis=1, override_backend=override_backend)
-        fac_cf = w.stack([fac_cf] * 2, axis=1, override_backend=override_backend)
-        fac_cc = w.stack([fac_cc] * 2, axis=1, override_backend=override_backend)
-
-        for i_slice in range(s[axis]):
-            slicer_ff = [i_slice, i_slice, i_slice]
-            slicer_ff[axes_rot[0]] = coord_old_floor_1
-            slicer_ff[axes_rot[1]] = coord_old_floor_2
-            slicer_fc = [i_slice, i_slice, i_slice]
-            slicer_fc[axes_rot[0]] = coord_old_floor_1
-            slicer_fc[axes_rot[1]] = coord_old_ceil_2
-            slicer_cf = [i_slice, i_slice, i_slice]
-            slicer_cf[axes_rot[0]] = coord_old_ceil_1
-            slicer_cf[axes_rot[1]] = coord_old_floor_2
-            slicer_cc = [i_slice, i_slice, i_slice]
-            slicer_cc[axes_rot[0]] = coord_old_ceil_1
-            slicer_cc[axes_rot[1]] = coord_old_ceil_2
-            vals_ff = obj[tuple(slicer_ff)]
-            vals_fc = obj[tuple(slicer_fc)]
-            vals_cf = obj[tuple(slicer_cf)]
-            vals_cc = obj[tuple(slicer_cc)]
-            vals = vals_ff * fac_ff + vals_fc * fac_fc + vals_cf * fac_cf + vals_cc * fac_cc
-            obj_rot.append(w.reshape(vals, [s[axes_rot[0]], s[axes_rot[1]], 2], override_backend=override_backend))
-        obj_rot = w.stack(obj_rot, axis=axis, override_backend=override_backend)
-    return obj_rot
+
+def apply_rotation_adjoint(arr, coord_old, interpolation='bilinear', matrix=None, slice_chunk_size=16, n_threads=4,
+                           override_backend=None, matrix_t=None):
+    """
+    Apply the exact transpose of rotating arr about axis 0 with coord_old: every voxel of arr is added to the
+    voxels it is interpolated from in the forward rotation, with the same weights, so that
+    <R x, y> = <x, R^T y>. Rotating with inverse coordinates only approximates this.
+    Numpy arrays are processed in chunks of slices in parallel threads. Variables of the backend go through the
+    differentiable sparse product.
+    :param matrix: output of get_interpolation_matrix for coord_old. Built from coord_old if None.
+    :param matrix_t: transpose of matrix in CSR format, e.g. from RotationCoordinateStore.get_interpolation_matrix
+                     with transpose=True. If given, matrix and coord_old are not used.
+    """
+    if matrix_t is None:
+        if matrix is None:
+            matrix = get_interpolation_matrix(coord_old, arr.shape[1:3], interpolation=interpolation)
+        matrix_t = matrix.T.tocsr()
+    if not isinstance(arr, np.ndarray):
+        return apply_rotation_primitive(arr, None, matrix=matrix_t, override_backend=override_backend)
+    return apply_interpolation_matrix_to_slices(arr, matrix_t, slice_chunk_size=slice_chunk_size, n_threads=n_threads)
 
 
 def apply_rotation_to_hdf5(dset, coord_old, rank, n_ranks, interpolation='bilinear', monochannel=False, dset_2=None,
-                           precalculate_rotation_coords=True):
+                           precalculate_rotation_coords=True, n_slices_per_read=64, n_threads=4):
     """
     If another dataset is used to store the rotated object, pass the dataset object to
     dset_2. If dset_2 is None, rotated object will overwrite the original dataset.
@@ -594,50 +746,12 @@ def apply_rotation_to_hdf5(dset, coord_old, rank, n_ranks, interpolation='biline
     if dset_2 is None: dset_2 = dset
 
     if precalculate_rotation_coords:
-        if interpolation == 'nearest':
-            coord_old_1 = np.round(coord_old[:, 0]).astype('int')
-            coord_old_2 = np.round(coord_old[:, 1]).astype('int')
-        else:
-            coord_old_1 = coord_old[:, 0]
-            coord_old_2 = coord_old[:, 1]
-
-        # Clip coords, so that edge values are used for out-of-array indices
-        coord_old_1 = np.clip(coord_old_1, 0, s[1] - 2)
-        coord_old_2 = np.clip(coord_old_2, 0, s[2] - 2)
-
-    if precalculate_rotation_coords:
-        if interpolation == 'nearest':
-            for i_slice in slice_ls:
-                obj = dset[i_slice]
-                obj_rot = np.reshape(obj[coord_old_1, coord_old_2], s[1:])
-                dset_2[i_slice] = obj_rot
-        else:
-            coord_old_floor_1 = np.floor(coord_old_1).astype(int)
-            coord_old_ceil_1 = coord_old_floor_1 + 1
-            coord_old_floor_2 = np.floor(coord_old_2).astype(int)
-            coord_old_ceil_2 = coord_old_floor_2 + 1
-            coord_old_floor_1 = np.clip(coord_old_floor_1, 0, s[1] - 1)
-            coord_old_floor_2 = np.clip(coord_old_floor_2, 0, s[2] - 1)
-            coord_old_ceil_1 = np.clip(coord_old_ceil_1, 0, s[1] - 1)
-            coord_old_ceil_2 = np.clip(coord_old_ceil_2, 0, s[2] - 1)
-            fac_ff = (coord_old_ceil_1 - coord_old_1) * (coord_old_ceil_2 - coord_old_2)
-            fac_fc = (coord_old_ceil_1 - coord_old_1) * (coord_old_2 - coord_old_floor_2)
-            fac_cf = (coord_old_1 - coord_old_floor_1) * (coord_old_ceil_2 - coord_old_2)
-            fac_cc = (coord_old_1 - coord_old_floor_1) * (coord_old_2 - coord_old_floor_2)
-            if not monochannel:
-                fac_ff = np.stack([fac_ff] * 2, axis=1)
-                fac_fc = np.stack([fac_fc] * 2, axis=1)
-                fac_cf = np.stack([fac_cf] * 2, axis=1)
-                fac_cc = np.stack([fac_cc] * 2, axis=1)
-            for i_slice in slice_ls:
-                obj = dset[i_slice]
-                vals_ff = obj[coord_old_floor_1, coord_old_floor_2]
-                vals_fc = obj[coord_old_floor_1, coord_old_ceil_2]
-                vals_cf = obj[coord_old_ceil_1, coord_old_floor_2]
-                vals_cc = obj[coord_old_ceil_1, coord_old_ceil_2]
-                vals = vals_ff * fac_ff + vals_fc * fac_fc + vals_cf * fac_cf + vals_cc * fac_cc
-                obj_rot = np.reshape(vals, s[1:])
-                dset_2[i_slice] = obj_rot
+        matrix = get_interpolation_matrix(coord_old, s[1:3], interpolation=interpolation)
+        for i in range(0, len(slice_ls), n_slices_per_read):
+            ind = list(slice_ls[i:i + n_slices_per_read])
+            dset_2[ind] = apply_interpolation_matrix_to_slices(dset[ind], matrix,
+                                                               slice_chunk_size=ceil(len(ind) / n_threads),
+                                                               n_threads=n_threads)
     else:
         for i_slice in slice_ls:
             obj = dset[i_slice]
@@ -648,69 +762,32 @@ def apply_rotation_to_hdf5(dset, coord_old, rank, n_ranks, interpolation='biline
 
 
 def revert_rotation_to_hdf5(dset, coord_old, rank, n_ranks, interpolation='bilinear', monochannel=False,
-                            precalculate_rotation_coords=True):
-
+                            precalculate_rotation_coords=True, dset_2=None, n_slices_per_read=64, n_threads=4,
+                            matrix_t=None):
+    """
+    Apply the exact transpose of apply_rotation_to_hdf5 with the same coord_old, e.g. to rotate gradients back to
+    the unrotated frame. See apply_rotation_adjoint.
+    If another dataset is used to store the result, pass it to dset_2; otherwise dset is overwritten.
+    :param matrix_t: transposed interpolation matrix of coord_old in CSR format. Built from coord_old if None.
+    """
     s = dset.shape
     slice_ls = range(rank, s[0], n_ranks)
 
-    if precalculate_rotation_coords:
-        if interpolation == 'nearest':
-            coord_old_1 = np.round(coord_old[:, 0]).astype('int')
-            coord_old_2 = np.round(coord_old[:, 1]).astype('int')
-        else:
-            coord_old_1 = coord_old[:, 0]
-            coord_old_2 = coord_old[:, 1]
-
-        # Clip coords, so that edge values are used for out-of-array indices
-        coord_old_1 = np.clip(coord_old_1, 0, s[1] - 1)
-        coord_old_2 = np.clip(coord_old_2, 0, s[2] - 1)
+    if dset_2 is None: dset_2 = dset
 
     if precalculate_rotation_coords:
-        if interpolation == 'nearest':
-            for i_slice in slice_ls:
-                obj = dset[i_slice]
-                obj_rot = np.reshape(obj[coord_old_1, coord_old_2], s[1:])
-                dset[i_slice] = obj_rot
-        else:
-            coord_old_floor_1 = np.floor(coord_old_1).astype(int)
-            coord_old_ceil_1 = np.ceil(coord_old_1).astype(int)
-            coord_old_floor_2 = np.floor(coord_old_2).astype(int)
-            coord_old_ceil_2 = np.ceil(coord_old_2).astype(int)
-            # integer_mask_1 = (abs(coord_old_ceil_1 - coord_old_1) < 1e-5).astype(int)
-            # integer_mask_2 = (abs(coord_old_ceil_2 - coord_old_2) < 1e-5).astype(int)
-            coord_old_floor_1 = np.clip(coord_old_floor_1, 0, s[1] - 1)
-            coord_old_floor_2 = np.clip(coord_old_floor_2, 0, s[2] - 1)
-            coord_old_ceil_1 = np.clip(coord_old_ceil_1, 0, s[1] - 1)
-            coord_old_ceil_2 = np.clip(coord_old_ceil_2, 0, s[2] - 1)
-            integer_mask_1 = abs(coord_old_ceil_1 - coord_old_floor_1) < 1e-5
-            integer_mask_2 = abs(coord_old_ceil_2 - coord_old_floor_2) < 1e-5
-            fac_ff = (coord_old_ceil_1 + integer_mask_1 - coord_old_1) * (coord_old_ceil_2 + integer_mask_2 - coord_old_2)
-            fac_fc = (coord_old_ceil_1 + integer_mask_1 - coord_old_1) * (coord_old_2 - coord_old_floor_2)
-            fac_cf = (coord_old_1 - coord_old_floor_1) * (coord_old_ceil_2 + integer_mask_2 - coord_old_2)
-            fac_cc = (coord_old_1 - coord_old_floor_1) * (coord_old_2 - coord_old_floor_2)
-            if not monochannel:
-                fac_ff = w.stack([fac_ff] * 2, axis=1)
-                fac_fc = w.stack([fac_fc] * 2, axis=1)
-                fac_cf = w.stack([fac_cf] * 2, axis=1)
-                fac_cc = w.stack([fac_cc] * 2, axis=1)
-
-            for i_slice in slice_ls:
-                current_arr = dset[i_slice]
-                obj = np.zeros_like(current_arr)
-                if not monochannel:
-                    current_arr = current_arr.reshape([s[1] * s[2], 2])
-                else:
-                    current_arr = current_arr.flatten()
-                obj[coord_old_floor_1, coord_old_floor_2] += current_arr * fac_ff
-                obj[coord_old_floor_1, coord_old_ceil_2] += current_arr * fac_fc
-                obj[coord_old_ceil_1, coord_old_floor_2] += current_arr * fac_cf
-                obj[coord_old_ceil_1, coord_old_ceil_2] += current_arr * fac_cc
-                dset[i_slice] = obj
+        if matrix_t is None:
+            matrix_t = get_interpolation_matrix(coord_old, s[1:3], interpolation=interpolation).T.tocsr()
+        for i in range(0, len(slice_ls), n_slices_per_read):
+            ind = list(slice_ls[i:i + n_slices_per_read])
+            dset_2[ind] = apply_interpolation_matrix_to_slices(dset[ind], matrix_t,
+                                                               slice_chunk_size=ceil(len(ind) / n_threads),
+                                                               n_threads=n_threads)
     else:
         for i_slice in slice_ls:
             obj = dset[i_slice]
             obj_rot = sp_rotate(obj, -coord_old, axes=(1, 2), reshape=False, order=1)
-            dset[i_slice] = obj_rot
+            dset_2[i_slice] = obj_rot
 
     return None
 
@@ -876,7 +953,7 @@ def get_subblocks_from_distributed_object_mpi(obj, slice_catalog, probe_pos, thi
         else:
             my_chunk = np.zeros([probe_size[0], probe_size[1], whole_object_size[2], 2])
             my_chunk_ls.append(my_chunk)
-    my_chunk_ls = np.stack(my_chunk_ls).astype('float64')
+    my_chunk_ls = np.stack(my_chunk_ls).astype(global_settings.compute_dtype)
     return my_chunk_ls
 
 
@@ -1168,7 +1245,7 @@ def get_rotated_subblocks(dset, this_pos_batch, probe_size, whole_object_size, m
                                                  [px_st_clip - px_st, px_end - px_end_clip],
                                                  [0, 0]], mode='constant')
         block_stack.append(this_block)
-    block_stack = np.stack(block_stack, axis=0).astype('float64')
+    block_stack = np.stack(block_stack, axis=0).astype(global_settings.compute_dtype)
     return block_stack
 
 
@@ -1229,6 +1306,101 @@ def pad_object(obj_rot, this_obj_size, probe_pos, probe_size, mode='constant', u
     return obj_rot, pad_arr
 
 
+def get_patch_indices(pos, patch_size, arr_size):
+    """
+    Get clamped row and column indices of patches and the mask of in-bound pixels.
+    :param pos: [n, 2] integer array of the top-left corners of patches. Can be negative.
+    :return: iy in [n, py], ix in [n, px], and mask in [n, py, px] (None if all patches are in bound).
+    """
+    pos = np.round(np.asarray(pos)).astype(int)
+    iy = pos[:, 0:1] + np.arange(patch_size[0])
+    ix = pos[:, 1:2] + np.arange(patch_size[1])
+    valid_y = (iy >= 0) & (iy < arr_size[0])
+    valid_x = (ix >= 0) & (ix < arr_size[1])
+    if np.all(valid_y) and np.all(valid_x):
+        mask = None
+    else:
+        mask = valid_y[:, :, None] & valid_x[:, None, :]
+    iy = np.clip(iy, 0, arr_size[0] - 1)
+    ix = np.clip(ix, 0, arr_size[1] - 1)
+    return iy, ix, mask
+
+
+def get_patch_index_variables(pos, patch_size, arr_size, device=None):
+    """
+    Get patch indices from get_patch_indices as integer variables ready for indexing, i.e., iy in [n, py, 1] and
+    ix in [n, 1, px]. The mask stays a NumPy array (None if all patches are in bound).
+    """
+    iy, ix, mask = get_patch_indices(pos, patch_size, arr_size)
+    iy = w.create_variable(iy[:, :, None], dtype='int64', requires_grad=False, device=device)
+    ix = w.create_variable(ix[:, None, :], dtype='int64', requires_grad=False, device=device)
+    return iy, ix, mask
+
+
+def _get_patch_axes_order(ndim, axes):
+    assert axes[1] == axes[0] + 1, 'Spatial axes of patches must be adjacent.'
+    return list(axes) + [i for i in range(ndim) if i not in axes]
+
+
+def extract_patches(arr, pos, patch_size, axes=(0, 1), fill_value=0, device=None, indices=None):
+    """
+    Gather patches from an array with one indexing operation, without padding the whole array.
+    Regions beyond the array boundary are filled with fill_value. The gradient of this operation
+    is a scatter-add of the patches back into the array (see scatter_add_patches).
+    :param arr: array whose spatial axes are axes[0] and axes[1], e.g., object in [y, x, z, 2]
+                or probe in [n_modes, y, x] with axes=(1, 2).
+    :param pos: [n, 2] integer array of the top-left corners of patches. Can be negative.
+    :param indices: optional precomputed output of get_patch_index_variables for pos, which are then not
+                    recalculated.
+    :return: patches in [n, ...], where the other axes of arr keep their order and size.
+    """
+    ndim = len(arr.shape)
+    arr_size = [arr.shape[axes[0]], arr.shape[axes[1]]]
+    if indices is None:
+        indices = get_patch_index_variables(pos, patch_size, arr_size, device=device)
+    iy, ix, mask = indices
+    axes_order = _get_patch_axes_order(ndim, axes)
+    if axes_order != list(range(ndim)):
+        arr = w.permute_axes(arr, axes_order)
+    # Shape of patches is [n, py, px, (other axes)].
+    patches = arr[iy, ix]
+    if mask is not None:
+        mask = np.reshape(mask, list(mask.shape) + [1] * (ndim - 2))
+        mask_var = w.create_variable(mask, dtype=w.get_dtype(patches), requires_grad=False, device=device)
+        patches = patches * mask_var
+        if fill_value != 0:
+            fill_var = w.create_variable((~mask) * fill_value, dtype=w.get_dtype(patches), requires_grad=False, device=device)
+            patches = patches + fill_var
+    if axes_order != list(range(ndim)):
+        # Move spatial axes back to their original place, after the patch axis.
+        back_order = [0] + [axes_order.index(i) + 1 for i in range(ndim)]
+        patches = w.permute_axes(patches, back_order)
+    return patches
+
+
+def scatter_add_patches(patches, pos, arr_shape, axes=(0, 1), device=None):
+    """
+    Adjoint of extract_patches. Add patches into a zero array of arr_shape at the given positions.
+    Overlapping regions are accumulated and parts beyond the array boundary are dropped.
+    :param patches: [n, ...] in the same layout as returned by extract_patches.
+    """
+    ndim = len(arr_shape)
+    patch_size = [patches.shape[axes[0] + 1], patches.shape[axes[1] + 1]]
+    iy, ix, mask = get_patch_indices(pos, patch_size, [arr_shape[axes[0]], arr_shape[axes[1]]])
+    axes_order = _get_patch_axes_order(ndim, axes)
+    if axes_order != list(range(ndim)):
+        patches = w.permute_axes(patches, [0] + [i + 1 for i in axes_order])
+    if mask is not None:
+        mask = np.reshape(mask, list(mask.shape) + [1] * (ndim - 2))
+        mask_var = w.create_variable(mask, dtype=w.get_dtype(patches), requires_grad=False, device=device)
+        patches = patches * mask_var
+    arr = w.zeros([arr_shape[i] for i in axes_order], dtype=w.get_dtype(patches), requires_grad=False, device=device)
+    arr = w.scatter_add(arr, (iy[:, :, None], ix[:, None, :]), patches)
+    if axes_order != list(range(ndim)):
+        arr = w.permute_axes(arr, [axes_order.index(i) for i in range(ndim)])
+    return arr
+
+
 def calculate_pad_len(this_obj_size, probe_pos, probe_size, unknown_type='delta_beta'):
     """
     Pad the object with 0 if any of the probes' extents go beyond the object boundary.
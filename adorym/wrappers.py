@@ -9,6 +9,8 @@ engine_dict = {}
 try:
     import autograd.numpy as anp
     import autograd as ag
+    from autograd.extend import primitive, defvjp
+    import autograd.builtins as agb
     engine_dict['autograd'] = anp
     flag_autograd_avail = True
 except:
@@ -17,6 +19,7 @@ except:
 try:
     import torch as tc
     import torch.autograd as tag
+    import torch.utils.checkpoint
     engine_dict['pytorch'] = tc
     flag_pytorch_avail = True
 except:
@@ -57,6 +60,8 @@ dtype_mapping_dict = {'float32':    {'autograd': 'float32',    'tensorflow': 'fl
                       'int32':      {'autograd': 'int32',      'tensorflow': 'int32',      'pytorch': 'int'},
                       'int64':      {'autograd': 'int64',      'tensorflow': 'int64',      'pytorch': 'long'},
                       'bool':       {'autograd': 'bool',       'tensorflow': 'bool',       'pytorch': 'bool'},
+                      'complex64':  {'autograd': 'complex64',  'tensorflow': 'complex64',  'pytorch': 'cfloat'},
+                      'complex128': {'autograd': 'complex128', 'tensorflow': 'complex128', 'pytorch': 'cdouble'},
                       }
 
 if flag_pytorch_avail:
@@ -101,6 +106,38 @@ def create_variable(arr, dtype=None, device=None, requires_grad=True, override_b
     return var
 
 
+def pin_memory(arr, override_backend=None):
+    """
+    Copy a Numpy array to page-locked host memory, from where it can be moved to GPU asynchronously.
+    The array is returned as is if the backend does not support pinned memory or no GPU is present.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'pytorch' and tc.cuda.is_available():
+        return tc.from_numpy(np.ascontiguousarray(arr)).pin_memory()
+    return arr
+
+
+def pinned_to_variable(arr, device=None, override_backend=None):
+    """
+    Create a constant variable on device from an array returned by pin_memory.
+    """
+    if isinstance(arr, np.ndarray):
+        return create_variable(arr, device=device, requires_grad=False, override_backend=override_backend)
+    if device is None:
+        return arr
+    return arr.to(device, non_blocking=True)
+
+
+def get_dtype(var):
+    """
+    Get the name of the dtype of a variable as a string, e.g. 'float32'.
+    """
+    if global_settings.backend == 'pytorch' and isinstance(var, tc.Tensor):
+        return str(var.dtype).replace('torch.', '')
+    else:
+        return str(var.dtype)
+
+
 def to_numpy(var):
     if isinstance(var, np.ndarray):
         return var
@@ -218,6 +255,20 @@ def get_allocated_tensors():
             except:
                 pass
 
+def checkpoint(func, *args):
+    """
+    Call func(*args) without keeping its intermediate results for the backward pass. They are recomputed
+    when gradients are calculated. func should return a tuple of variables.
+    """
+    if global_settings.backend == 'autograd':
+        # Outputs are returned in an Autograd tuple, as a plain tuple returned by a primitive is not traced and
+        # would get no gradient.
+        return ag.checkpoint(lambda *a: agb.tuple(func(*a)))(*args)
+    elif global_settings.backend == 'pytorch':
+        # The reentrant implementation does not support torch.autograd.grad, which get_gradients uses.
+        return tc.utils.checkpoint.checkpoint(func, *args, use_reentrant=False)
+
+
 def no_grad():
     if global_settings.backend == 'pytorch':
         return tc.no_grad()
@@ -236,7 +287,10 @@ def reattach(var):
 
 def zeros(shape, dtype=None, device=None, requires_grad=True):
     kwargs = {}
-    if dtype is not None: kwargs['dtype'] = dtype
+    if dtype is not None:
+        if isinstance(dtype, str):
+            dtype = getattr(engine_dict[global_settings.backend], dtype_mapping_dict[dtype][global_settings.backend])
+        kwargs['dtype'] = dtype
     func = getattr(engine_dict[global_settings.backend], func_mapping_dict['zeros'][global_settings.backend])
     if global_settings.backend == 'pytorch':
         arr = func(shape, device=device, requires_grad=requires_grad, **kwargs)
@@ -247,7 +301,10 @@ def zeros(shape, dtype=None, device=None, requires_grad=True):
 
 def ones(shape, dtype=None, device=None, requires_grad=True):
     kwargs = {}
-    if dtype is not None: kwargs['dtype'] = dtype
+    if dtype is not None:
+        if isinstance(dtype, str):
+            dtype = getattr(engine_dict[global_settings.backend], dtype_mapping_dict[dtype][global_settings.backend])
+        kwargs['dtype'] = dtype
     func = getattr(engine_dict[global_settings.backend], func_mapping_dict['ones'][global_settings.backend])
     if global_settings.backend == 'pytorch':
         arr = func(shape, device=device, requires_grad=requires_grad, **kwargs)
@@ -342,7 +399,7 @@ def concatenate(var_list, axis=0):
 def cast(var, dtype, override_backend=None):
     bn = override_backend if override_backend is not None else global_settings.backend
     dtype = str(dtype)
-    if bn == 'autograd':
+    if bn == 'autograd' or isinstance(var, np.ndarray):
         return var.astype(dtype)
     elif bn == 'pytorch':
         return getattr(var, dtype_mapping_dict[dtype]['pytorch'])()
@@ -723,20 +780,89 @@ def permute_axes(arr, axes_order, override_backend=None):
         return arr.permute(axes_order)
 
 
-def grid_sample(arr, grid, interpolation='bilinear', axis=0, device=None):
+def scatter_add(arr, indices, values, override_backend=None):
+    """
+    Add values to arr at integer array indices. Repeated indices are accumulated.
+    For Autograd this is not differentiable and is meant for explicitly computed adjoints.
+    :param indices: tuple of integer index arrays, one for each leading axis of arr.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn in ['autograd', 'numpy']:
+        arr = np.array(arr)
+        np.add.at(arr, indices, values)
+        return arr
+    elif bn == 'pytorch':
+        indices = tuple(tc.as_tensor(i, device=arr.device) for i in indices)
+        return arr.index_put(indices, values, accumulate=True)
+
+
+if flag_autograd_avail:
+    @primitive
+    def _sparse_matmul_autograd(matrix, x):
+        return matrix.dot(x).astype(x.dtype, copy=False)
+
+    defvjp(_sparse_matmul_autograd,
+           lambda ans, matrix, x: lambda g: matrix.T.dot(g).astype(g.dtype, copy=False), argnums=[1])
+
+
+def to_sparse_tensor(matrix, dtype='float32', device=None):
+    """
+    Convert a scipy.sparse matrix to a PyTorch sparse tensor that can be kept and passed to sparse_matmul.
+    """
+    assert flag_pytorch_avail, 'Wrapper function to_sparse_tensor requires Pytorch.'
+    matrix = matrix.tocoo()
+    matrix = tc.sparse_coo_tensor(np.stack([matrix.row, matrix.col]), matrix.data, matrix.shape,
+                                  dtype=getattr(tc, dtype_mapping_dict[dtype]['pytorch']), device=device)
+    return matrix.coalesce()
+
+
+def sparse_matmul(matrix, x, override_backend=None):
+    """
+    Multiply a scipy.sparse matrix with a dense 2D array. Differentiable with regards to x, whose gradient is
+    the product with the transposed matrix.
+    :param matrix: scipy.sparse matrix. With PyTorch, it can also be the output of to_sparse_tensor, which is
+                   then not converted and uploaded again.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return _sparse_matmul_autograd(matrix, x)
+    elif bn == 'pytorch':
+        if not isinstance(matrix, tc.Tensor):
+            matrix = to_sparse_tensor(matrix, dtype=str(x.dtype).replace('torch.', ''), device=x.device)
+        elif matrix.dtype != x.dtype:
+            matrix = matrix.to(x.dtype)
+        return tc.sparse.mm(matrix, x)
+
+
+def normalize_sampling_grid(grid, image_shape, device=None):
+    """
+    Convert sampling coordinates in pixels to the normalized grid used by torch's grid_sample.
+    :param grid: [N, 2], with y coordinates first.
+    :param image_shape: (H, W) of the images to be sampled; N = H * W.
+    :return: [1, H, W, 2] tensor.
+    """
+    assert flag_pytorch_avail, 'Wrapper function normalize_sampling_grid requires Pytorch.'
+    if not isinstance(grid, tc.Tensor):
+        grid = tc.tensor(grid, requires_grad=False, device=device)
+    # x coordinates comes first in torch.grid_sample.
+    grid = tc.flip(grid, (1,))
+    # Convert grid to [0, 1] scale.
+    arr_center = (tc.tensor(image_shape, requires_grad=False, device=device) - 1) / 2
+    grid = (grid - arr_center) / (arr_center + 0.5)
+    grid = reshape(grid, [1, *image_shape, 2], override_backend='pytorch')
+    return grid
+
+
+def grid_sample(arr, grid, interpolation='bilinear', axis=0, device=None, grid_normalized=False):
     """
     :param arr: a stack of 2D images in [N, H, W, C].
-    :param grid: [N, 2].
+    :param grid: [N, 2], or the output of normalize_sampling_grid if grid_normalized is True.
     """
     assert flag_pytorch_avail, 'Wrapper function grid_sample requires Pytorch.'
     flag_convert_arr = False
     if not isinstance(arr, tc.Tensor):
         flag_convert_arr = True
         arr = tc.tensor(arr, requires_grad=False, device=device)
-    if not isinstance(grid, tc.Tensor):
-        grid = tc.tensor(grid, requires_grad=False, device=device)
-    # x coordinates comes first in torch.grid_sample.
-    grid = tc.flip(grid, (1,))
 
     axis_arrangement = [0, 1, 2, 3]
     # Move channel to the 2nd dimension.
@@ -749,12 +875,11 @@ def grid_sample(arr, grid, interpolation='bilinear', axis=0, device=None):
         axis_arrangement[2], axis_arrangement[3] = axis_arrangement[3], axis_arrangement[2]
     arr = permute_axes(arr, axis_arrangement, override_backend='pytorch')
 
-    # Convert grid to [0, 1] scale.
-    arr_center = (tc.tensor(arr.shape[2:4], requires_grad=False, device=device) - 1) / 2
-    grid = (grid - arr_center) / (arr_center + 0.5)
-    grid = reshape(grid, [1, *arr.shape[2:4], 2], override_backend='pytorch')
-    grid = tile(grid, [arr.shape[0], 1, 1, 1], override_backend='pytorch')
+    if not grid_normalized:
+        grid = normalize_sampling_grid(grid, arr.shape[2:4], device=device)
     grid = cast(grid, pytorch_dtype_query_mapping_dict[arr.dtype], override_backend='pytorch')
+    # Expanding shares memory among slices, unlike tiling.
+    grid = grid.expand(arr.shape[0], -1, -1, -1)
     arr = tc.nn.functional.grid_sample(arr, grid, padding_mode='border', mode=interpolation)
     arr = permute_axes(arr, [axis_arrangement.index(0), axis_arrangement.index(1),
                              axis_arrangement.index(2), axis_arrangement.index(3)], override_backend='pytorch')
@@ -824,3 +949,146 @@ def rotate(arr, theta, axis=0, override_backend=None, device=None):
         return arr
 
 
+
+
+# _________________________
+# |Native complex functions|_____________________________________________________
+# These functions operate on complex64/complex128 arrays instead of pairs of real and imaginary parts. They are
+# used when global_settings.use_native_complex is True.
+
+flag_pytorch_fft_module = flag_pytorch_avail and hasattr(tc, 'fft') and hasattr(tc.fft, 'fft2')
+
+def get_complex_dtype(var):
+    """
+    Get the name of the complex dtype whose precision matches the real-valued variable.
+    """
+    return 'complex64' if '32' in str(var.dtype) or '16' in str(var.dtype) else 'complex128'
+
+
+def to_complex(var_real, var_imag, override_backend=None):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return var_real + 1j * var_imag
+    elif bn == 'pytorch':
+        if not isinstance(var_imag, tc.Tensor):
+            var_imag = tc.zeros_like(var_real) + var_imag
+        if hasattr(tc, 'complex'):
+            return tc.complex(var_real, var_imag)
+        else:
+            return tc.view_as_complex(tc.stack([var_real, var_imag], dim=-1).contiguous())
+
+
+def split_complex(var, override_backend=None):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return anp.real(var), anp.imag(var)
+    elif bn == 'pytorch':
+        return tc.real(var), tc.imag(var)
+
+
+def exp_complex_native(var_real, var_imag, override_backend=None):
+    """
+    Returns exp(var_real + i * var_imag) as a single complex array.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return anp.exp(var_real + 1j * var_imag)
+    elif bn == 'pytorch':
+        return tc.exp(to_complex(var_real, var_imag, override_backend=bn))
+
+
+def abs2_complex(var, override_backend=None):
+    """
+    Returns the squared modulus (intensity) of a complex array.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return anp.real(var) ** 2 + anp.imag(var) ** 2
+    elif bn == 'pytorch':
+        return tc.real(var) ** 2 + tc.imag(var) ** 2
+
+
+def abs_complex(var, override_backend=None):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return anp.abs(var)
+    elif bn == 'pytorch':
+        return tc.abs(var)
+
+
+def _fft2_complex_pytorch(var, axes, normalize, inverse=False):
+    if flag_pytorch_fft_module:
+        norm = 'ortho' if normalize else 'backward'
+        func = tc.fft.ifft2 if inverse else tc.fft.fft2
+        return func(var, dim=tuple(axes), norm=norm)
+    else:
+        # Legacy API only takes stacked real and imaginary parts and always transforms the last 2 dimensions.
+        func = tc.ifft if inverse else tc.fft
+        var = func(tc.view_as_real(var), signal_ndim=2, normalized=normalize)
+        return tc.view_as_complex(var.contiguous())
+
+
+def _fft_complex_pytorch(var, axis, inverse=False):
+    if flag_pytorch_fft_module:
+        func = tc.fft.ifft if inverse else tc.fft.fft
+        return func(var, dim=axis)
+    else:
+        # Legacy API always transforms the last dimension.
+        func = tc.ifft if inverse else tc.fft
+        var = tc.transpose(var, axis, -1).contiguous()
+        var = tc.view_as_complex(func(tc.view_as_real(var), signal_ndim=1).contiguous())
+        return tc.transpose(var, axis, -1)
+
+
+def fft_complex(var, axis=-1, override_backend=None):
+    """
+    1D FFT of a complex array along one axis.
+    """
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return anp.fft.fft(var, axis=axis)
+    elif bn == 'pytorch':
+        return _fft_complex_pytorch(var, axis)
+
+
+def ifft_complex(var, axis=-1, override_backend=None):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        return anp.fft.ifft(var, axis=axis)
+    elif bn == 'pytorch':
+        return _fft_complex_pytorch(var, axis, inverse=True)
+
+
+def fft2_complex(var, axes=(-2, -1), override_backend=None, normalize=False):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        norm = None if not normalize else 'ortho'
+        return anp.fft.fft2(var, axes=axes, norm=norm)
+    elif bn == 'pytorch':
+        return _fft2_complex_pytorch(var, axes, normalize)
+
+
+def ifft2_complex(var, axes=(-2, -1), override_backend=None, normalize=False):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    if bn == 'autograd':
+        norm = None if not normalize else 'ortho'
+        return anp.fft.ifft2(var, axes=axes, norm=norm)
+    elif bn == 'pytorch':
+        return _fft2_complex_pytorch(var, axes, normalize, inverse=True)
+
+
+def fft2_and_shift_complex(var, axes=(-2, -1), override_backend=None, normalize=False):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    var = fft2_complex(var, axes=axes, override_backend=bn, normalize=normalize)
+    return fftshift(var, axes=axes, override_backend=bn)
+
+
+def ifft2_and_shift_complex(var, axes=(-2, -1), override_backend=None, normalize=False):
+    bn = override_backend if override_backend is not None else global_settings.backend
+    var = ifft2_complex(var, axes=axes, override_backend=bn, normalize=normalize)
+    return fftshift(var, axes=axes, override_backend=bn)
+
+
+def convolve_with_transfer_function_complex(arr, h, axes=(-2, -1), override_backend=None):
+    f = fft2_complex(arr, axes=axes, override_backend=override_backend)
+    return ifft2_complex(f * h, axes=axes, override_backend=override_backend)
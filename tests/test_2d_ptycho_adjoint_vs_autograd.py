@@ -0,0 +1,57 @@
+from adorym.ptychography import reconstruct_ptychography
+import numpy as np
+import dxchange
+import os
+
+# Run the same reconstruction with Autograd and with the adjoint engine, and check that the results agree.
+
+params_cameraman = {'fname': 'data_cameraman_err_10.h5',
+                    'theta_st': 0,
+                    'theta_end': 0,
+                    'theta_downsample': 1,
+                    'n_epochs': 1,
+                    'obj_size': (256, 256, 1),
+                    'alpha_d': 0,
+                    'alpha_b': 0,
+                    'gamma': 0,
+                    'probe_size': (72, 72),
+                    'learning_rate': 4e-3,
+                    'center': 512,
+                    'energy_ev': 5000,
+                    'psize_cm': 1.e-7,
+                    'minibatch_size': 52,
+                    'n_batch_per_update': 1,
+                    'cpu_only': True,
+                    'save_path': '../demos/cameraman_pos_error',
+                    'multiscale_level': 1,
+                    'n_epoch_final_pass': None,
+                    'save_intermediate': False,
+                    'initial_guess': None,
+                    'random_guess_means_sigmas': (1e-7, 0, 0, 0),
+                    'n_dp_batch': 20,
+                    'probe_type': 'supplied',
+                    'probe_initial': [np.squeeze(dxchange.read_tiff('../demos/cameraman_pos_error/probe_mag_true.tiff')), np.squeeze(dxchange.read_tiff('../demos/cameraman_pos_error/probe_phase_true.tiff'))],
+                    'forward_algorithm': 'fresnel',
+                    'object_type': 'phase_only',
+                    'probe_pos': np.array([(y, x) for y in np.arange(-10, 246, 5) for x in np.arange(-10, 246, 5)]),
+                    'finite_support_mask': None,
+                    'free_prop_cm': 'inf',
+                    'optimizer': 'gd',
+                    'two_d_mode': True,
+                    'shared_file_object': False,
+                    'use_checkpoint': False,
+                    'optimize_probe': True,
+                    'optimize_all_probe_pos': True,
+                    }
+
+for backend in ['autograd', 'adjoint']:
+    params = dict(params_cameraman)
+    params['backend'] = backend
+    params['output_folder'] = 'recon_{}'.format(backend)
+    reconstruct_ptychography(**params)
+
+delta_ls = [dxchange.read_tiff(os.path.join(params_cameraman['save_path'], 'recon_{}'.format(backend), 'delta_ds_1.tiff'))
+            for backend in ['autograd', 'adjoint']]
+err = np.max(np.abs(delta_ls[0] - delta_ls[1])) / np.max(np.abs(delta_ls[0]))
+print('Relative difference between Autograd and adjoint results: {}'.format(err))
+assert err < 1e-4
@@ -0,0 +1,58 @@
+from adorym.propagate import multislice_propagate_batch
+import adorym.global_settings as global_settings
+import autograd.numpy as anp
+import autograd as ag
+import numpy as np
+
+# Check that propagating all probe modes in one batched call gives the same detected intensity, and the same
+# gradients with regard to the object and the probe modes, as propagating each mode separately, for probe modes
+# shared by all spots and for probe modes given per spot.
+
+global_settings.backend = 'autograd'
+n_probe_modes = 3
+
+
+def get_intensity_batched(grid, probe_real, probe_imag, **kwargs):
+    ex_real, ex_imag = multislice_propagate_batch(grid, probe_real, probe_imag, 5000, 1e-7,
+                                                  obj_batch_shape=grid.shape[:-1], batched_modes=True, **kwargs)
+    assert ex_real.shape == (grid.shape[0], n_probe_modes, *grid.shape[1:3])
+    return anp.sum(ex_real ** 2 + ex_imag ** 2, axis=1)
+
+
+def get_intensity_loop(grid, probe_real, probe_imag, **kwargs):
+    intensity = 0
+    for i_mode in range(n_probe_modes):
+        ex_real, ex_imag = multislice_propagate_batch(grid, probe_real[..., i_mode, :, :],
+                                                      probe_imag[..., i_mode, :, :], 5000, 1e-7,
+                                                      obj_batch_shape=grid.shape[:-1], **kwargs)
+        intensity = intensity + ex_real ** 2 + ex_imag ** 2
+    return intensity
+
+
+def run():
+    np.random.seed(0)
+    grid = np.stack([np.random.rand(2, 32, 32, 4) * 1e-5, np.random.rand(2, 32, 32, 4) * 1e-6], axis=-1)
+    weight = np.random.rand(2, 32, 32)
+    for probe_shape in [(n_probe_modes, 32, 32), (2, n_probe_modes, 32, 32)]:
+        probe_real = np.random.rand(*probe_shape)
+        probe_imag = np.random.rand(*probe_shape)
+        for free_prop_cm in [1e-4, 'inf']:
+            for use_native_complex in [False, True]:
+                kwargs = {'free_prop_cm': free_prop_cm, 'use_native_complex': use_native_complex}
+                res = []
+                for func in [get_intensity_loop, get_intensity_batched]:
+                    def loss(grid, probe_real, probe_imag):
+                        return anp.sum(weight * func(grid, probe_real, probe_imag, **kwargs))
+                    intensity = func(grid, probe_real, probe_imag, **kwargs)
+                    grads = ag.grad(loss, [0, 1, 2])(grid, probe_real, probe_imag)
+                    res.append([intensity, *grads])
+                for val_loop, val_batched, name in zip(*res, ['intensity', 'object gradient', 'probe real gradient',
+                                                              'probe imaginary gradient']):
+                    err = np.max(np.abs(val_batched - val_loop)) / np.max(np.abs(val_loop))
+                    print('Probe shape {}, free_prop_cm = {}, native complex = {}: relative difference of {} = {}.'.format(
+                          probe_shape, free_prop_cm, use_native_complex, name, err))
+                    assert err < 1e-10
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,65 @@
+from adorym.propagate import multislice_propagate_batch
+import adorym.global_settings as global_settings
+import adorym.wrappers as w
+import autograd.numpy as anp
+import autograd as ag
+import numpy as np
+import torch as tc
+
+# Check that propagating with checkpoint_slices gives the same exit wave intensity and the same gradients with
+# regard to the object and the probe as propagating without checkpoints, on both backends, for segment lengths
+# that do and do not divide the number of slices.
+
+n_slices = 7
+
+
+def get_intensity(grid, probe_real, probe_imag, checkpoint_slices, use_native_complex, binning=1):
+    ex_real, ex_imag = multislice_propagate_batch(grid, probe_real, probe_imag, 5000, 1e-7, free_prop_cm='inf',
+                                                  obj_batch_shape=grid.shape[:-1], binning=binning,
+                                                  use_native_complex=use_native_complex,
+                                                  checkpoint_slices=checkpoint_slices)
+    return ex_real ** 2 + ex_imag ** 2
+
+
+def get_intensity_and_gradients(backend, grid, probe_real, probe_imag, weight, **kwargs):
+    global_settings.backend = backend
+    if backend == 'autograd':
+        def loss(grid, probe_real, probe_imag):
+            return anp.sum(weight * get_intensity(grid, probe_real, probe_imag, **kwargs))
+        intensity = get_intensity(grid, probe_real, probe_imag, **kwargs)
+        return [intensity, *ag.grad(loss, [0, 1, 2])(grid, probe_real, probe_imag)]
+    else:
+        var_ls = [w.create_variable(x, dtype='float64', requires_grad=True) for x in [grid, probe_real, probe_imag]]
+        intensity = get_intensity(*var_ls, **kwargs)
+        grads = tc.autograd.grad(tc.sum(w.create_variable(weight, dtype='float64') * intensity), var_ls)
+        return [w.to_numpy(x) for x in [intensity, *grads]]
+
+
+def run():
+    np.random.seed(0)
+    grid = np.stack([np.random.rand(2, 32, 32, n_slices) * 1e-5, np.random.rand(2, 32, 32, n_slices) * 1e-6],
+                    axis=-1)
+    probe_real = np.random.rand(32, 32)
+    probe_imag = np.random.rand(32, 32)
+    weight = np.random.rand(2, 32, 32)
+    for backend in ['autograd', 'pytorch']:
+        for use_native_complex in [False, True]:
+            for binning in [1, 2]:
+                kwargs = {'use_native_complex': use_native_complex, 'binning': binning}
+                res_plain = get_intensity_and_gradients(backend, grid, probe_real, probe_imag, weight,
+                                                        checkpoint_slices=None, **kwargs)
+                for checkpoint_slices in [1, 2, 3]:
+                    res = get_intensity_and_gradients(backend, grid, probe_real, probe_imag, weight,
+                                                      checkpoint_slices=checkpoint_slices, **kwargs)
+                    for val_plain, val, name in zip(res_plain, res, ['intensity', 'object gradient',
+                                                                     'probe real gradient', 'probe imaginary gradient']):
+                        err = np.max(np.abs(val - val_plain)) / np.max(np.abs(val_plain))
+                        assert err < 1e-10, '{}, native complex = {}, binning = {}, checkpoint_slices = {}: ' \
+                                            'relative difference of {} = {}.'.format(
+                                            backend, use_native_complex, binning, checkpoint_slices, name, err)
+                print('{}, native complex = {}, binning = {}: checkpointed gradients match.'.format(
+                      backend, use_native_complex, binning))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,75 @@
+from adorym.data_loader import DataPrefetcher
+import numpy as np
+import h5py
+import time
+import os
+
+# Check that the prefetcher returns the same data as direct reads, that reading overlaps with computation
+# when each read of the HDF5 file is artificially delayed, and that the prefetcher stays in step with the
+# schedule when some batches are skipped.
+
+read_delay = 0.05
+compute_time = 0.05
+fname = 'test_data_prefetcher.h5'
+
+
+class DelayedDataset(object):
+
+    def __init__(self, dset):
+        self.dset = dset
+
+    def __getitem__(self, item):
+        time.sleep(read_delay)
+        return self.dset[item]
+
+
+def run():
+    arr = np.random.rand(4, 64, 16, 16).astype('float32')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('exchange/data', data=arr)
+    f = h5py.File(fname, 'r')
+    prj = DelayedDataset(f['exchange/data'])
+
+    np.random.seed(0)
+    schedule = [(i % 4, np.sort(np.random.choice(64, 16, replace=False))) for i in range(20)]
+
+    t0 = time.time()
+    for this_i_theta, this_ind_batch in schedule:
+        data = np.abs(prj[this_i_theta, this_ind_batch])[:, ::2, ::2]
+        time.sleep(compute_time)
+    t_sync = time.time() - t0
+
+    prefetcher = DataPrefetcher(prj, ds_level=2, n_prefetch=2)
+    t0 = time.time()
+    prefetcher.start(schedule)
+    for this_i_theta, this_ind_batch in schedule:
+        # Request in two sub-batches, as done when gradients are accumulated over n_dp_batch.
+        for sub_batch in (this_ind_batch[:8], this_ind_batch[8:]):
+            data = np.array(prefetcher.get(this_i_theta, sub_batch))
+            assert np.allclose(data, arr[this_i_theta, sub_batch][:, ::2, ::2])
+        time.sleep(compute_time)
+    t_prefetch = time.time() - t0
+    prefetcher.stop()
+    print('Synchronous: {} s; prefetched: {} s; misses: {}.'.format(t_sync, t_prefetch, prefetcher.n_misses))
+    assert prefetcher.n_misses == 0
+    assert t_prefetch < 0.8 * t_sync
+
+    # Skip every third batch, as happens when a batch is dropped. Later batches should still be served from
+    # the staged data.
+    prefetcher = DataPrefetcher(f['exchange/data'], ds_level=2, n_prefetch=2)
+    prefetcher.start(schedule)
+    for i, (this_i_theta, this_ind_batch) in enumerate(schedule):
+        if i % 3 == 1:
+            continue
+        data = np.array(prefetcher.get(this_i_theta, this_ind_batch))
+        assert np.allclose(data, arr[this_i_theta, this_ind_batch][:, ::2, ::2])
+    prefetcher.stop()
+    print('Misses with skipped batches: {}.'.format(prefetcher.n_misses))
+    assert prefetcher.n_misses == 0
+
+    f.close()
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    run()
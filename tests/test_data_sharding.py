@@ -0,0 +1,65 @@
+from adorym.data_loader import get_rank_shards, get_sharded_task_list, ShardedData
+import numpy as np
+import h5py
+import os
+
+# Check that rank shards cover each (angle, spot) pair exactly once as contiguous ranges of the file, that the
+# sharded task list of an epoch gives every rank only batches of its own shard, of one angle each, and visits every
+# pair of the shard, and that ShardedData reads the same data as the source. Ranks are simulated in one process,
+# so the test runs with the pseudo MPI communicator.
+
+fname = 'test_data_sharding.h5'
+minibatch_size = 4
+
+
+def run():
+    np.random.seed(0)
+    n_pos_ls = [13, 7, 10, 9]
+    theta_ind_ls = [0, 1, 3]
+    dat = np.random.rand(4, 13, 6, 6)
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('exchange/data', data=dat)
+    f = h5py.File(fname, 'r')
+    all_pairs = {(i_theta, i_spot) for i_theta in theta_ind_ls for i_spot in range(n_pos_ls[i_theta])}
+
+    for n_ranks in [1, 3, 4, 7]:
+        shard_ls = get_rank_shards(n_pos_ls, theta_ind_ls, n_ranks)
+        assert len(shard_ls) == n_ranks
+        pair_ls = [(i_theta, int(i_spot)) for shard in shard_ls for i_theta in sorted(shard.keys())
+                   for i_spot in shard[i_theta]]
+        # Pairs are listed in file order, rank after rank, so this also checks that shards are contiguous.
+        assert pair_ls == sorted(all_pairs)
+        n_pairs_ls = [sum(len(spots_ls) for spots_ls in shard.values()) for shard in shard_ls]
+        assert max(n_pairs_ls) - min(n_pairs_ls) <= 1
+
+        for randomize_probe_pos in [False, True]:
+            task_ls = get_sharded_task_list(shard_ls, minibatch_size, randomize_probe_pos=randomize_probe_pos)
+            for i_rank, shard in enumerate(shard_ls):
+                visited = set()
+                for batch in task_ls:
+                    assert batch.shape == (minibatch_size * n_ranks, 2)
+                    rank_batch = batch[i_rank * minibatch_size:(i_rank + 1) * minibatch_size]
+                    assert len(np.unique(rank_batch[:, 0])) == 1
+                    i_theta = int(rank_batch[0, 0])
+                    assert np.all(np.isin(rank_batch[:, 1], shard[i_theta]))
+                    visited.update((i_theta, int(i_spot)) for i_spot in rank_batch[:, 1])
+                assert visited == {(i_theta, int(i_spot)) for i_theta, spots_ls in shard.items() for i_spot in spots_ls}
+
+            for i_rank, shard in enumerate(shard_ls):
+                data = ShardedData(f['exchange/data'], shard)
+                for i_theta, spots_ls in shard.items():
+                    ind = np.random.permutation(spots_ls)[:3]
+                    assert np.array_equal(data[i_theta, ind], dat[i_theta, ind])
+        print('{} ranks: shards and task lists cover all spots.'.format(n_ranks))
+
+    try:
+        get_rank_shards([1, 1], [0, 1], 3)
+        raise AssertionError('Sharding 2 patterns over 3 ranks should fail.')
+    except ValueError:
+        pass
+    f.close()
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    run()
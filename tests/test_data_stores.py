@@ -0,0 +1,94 @@
+from adorym.data_loader import open_data_store, HDF5DataStore, NpyDirectoryDataStore, ZarrDataStore, \
+    MultiFileDataStore
+import numpy as np
+import warnings
+import shutil
+import h5py
+import os
+
+# Write the same data and metadata as a single HDF5 file, a directory of .npy files, a Zarr store and one HDF5 file
+# per angle, and check that open_data_store picks the right store for each, and that all stores read the same
+# batches and metadata as the HDF5 file.
+
+folder = 'test_data_stores'
+
+
+def write_stores(dat, theta, probe_pos):
+    path_dict = {}
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    path_dict['hdf5'] = os.path.join(folder, 'data.h5')
+    with h5py.File(path_dict['hdf5'], 'w') as f:
+        f.create_dataset('exchange/data', data=dat)
+        f.create_dataset('metadata/theta', data=theta)
+        f.create_dataset('metadata/probe_pos_px', data=probe_pos)
+
+    path_dict['npy'] = os.path.join(folder, 'data_npy')
+    os.makedirs(os.path.join(path_dict['npy'], 'metadata'))
+    for i_theta in range(dat.shape[0]):
+        np.save(os.path.join(path_dict['npy'], 'data_{:05d}.npy'.format(i_theta)), dat[i_theta])
+    np.save(os.path.join(path_dict['npy'], 'metadata', 'theta.npy'), theta)
+    np.save(os.path.join(path_dict['npy'], 'metadata', 'probe_pos_px.npy'), probe_pos)
+
+    try:
+        import zarr
+        path_dict['zarr'] = os.path.join(folder, 'data.zarr')
+        root = zarr.open_group(path_dict['zarr'], mode='w')
+        with warnings.catch_warnings():
+            # create_dataset is deprecated in newer versions of Zarr, but is the only method that older ones have.
+            warnings.simplefilter('ignore')
+            for name, arr, chunks in [('exchange/data', dat, (1, 4, *dat.shape[2:])),
+                                      ('metadata/theta', theta, theta.shape),
+                                      ('metadata/probe_pos_px', probe_pos, probe_pos.shape)]:
+                root.create_dataset(name, shape=arr.shape, dtype=arr.dtype, chunks=chunks)[...] = arr
+    except ImportError:
+        print('Zarr is not installed. Skipping ZarrDataStore.')
+
+    # Files of one angle each, holding data in [n_spots, y, x] or [1, n_spots, y, x].
+    fname_ls = []
+    for i_theta in range(dat.shape[0]):
+        fname = os.path.join(folder, 'angle_{:03d}.h5'.format(i_theta))
+        with h5py.File(fname, 'w') as f:
+            f.create_dataset('exchange/data', data=dat[i_theta] if i_theta % 2 == 0 else dat[i_theta:i_theta + 1])
+            f.create_dataset('metadata/theta', data=[theta[i_theta]])
+            f.create_dataset('metadata/probe_pos_px', data=probe_pos)
+        fname_ls.append(fname)
+    path_dict['multi_file_list'] = fname_ls
+    path_dict['multi_file_pattern'] = os.path.join(folder, 'angle_*.h5')
+    return path_dict
+
+
+def run():
+    np.random.seed(0)
+    dat = np.random.rand(3, 12, 8, 8).astype('float32')
+    theta = np.linspace(0, np.pi, 3)
+    probe_pos = np.random.rand(12, 2)
+    path_dict = write_stores(dat, theta, probe_pos)
+    store_class_dict = {'hdf5': HDF5DataStore, 'npy': NpyDirectoryDataStore, 'zarr': ZarrDataStore,
+                        'multi_file_list': MultiFileDataStore, 'multi_file_pattern': MultiFileDataStore}
+
+    ref = open_data_store(path_dict['hdf5'])
+    batch_ls = [(0, np.array([0, 3, 4, 11])), (2, np.array([1, 2, 7])), (1, np.arange(12))]
+    for name, path in path_dict.items():
+        store = open_data_store(path)
+        assert isinstance(store, store_class_dict[name])
+        assert tuple(store.data.shape) == dat.shape
+        for i_theta, ind in batch_ls:
+            assert np.array_equal(store.data[i_theta, ind], ref.data[i_theta, ind])
+        assert np.array_equal(store.data[1, 2:9], ref.data[1, 2:9])
+        assert np.allclose(store.get_metadata('theta'), ref.get_metadata('theta'))
+        if isinstance(store, MultiFileDataStore):
+            assert np.allclose(store.get_metadata('probe_pos_px_1'), ref.get_metadata('probe_pos_px'))
+        else:
+            assert np.allclose(store.get_metadata('probe_pos_px'), ref.get_metadata('probe_pos_px'))
+        assert np.array_equal(store.get_acquired_counts(3), [12, 12, 12])
+        store.close()
+        print('{}: batches and metadata match the HDF5 file.'.format(name))
+    ref.close()
+    shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    run()
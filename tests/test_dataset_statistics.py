@@ -0,0 +1,72 @@
+from adorym.util import get_dataset_statistics
+import numpy as np
+import warnings
+import h5py
+import os
+
+# Check that dataset statistics match a direct calculation, that statistics saved in the file are reused by later
+# calls with the same settings and recomputed otherwise, and that a file that can't be written only causes a
+# warning.
+
+fname = 'test_dataset_statistics.h5'
+
+
+def get_stats_direct(dat, raw_data_type):
+    intensity = dat if raw_data_type == 'intensity' else dat ** 2
+    return {'mean_magnitude': np.mean(np.sqrt(intensity), axis=(0, 1)),
+            'mean_intensity': np.mean(intensity, axis=(0, 1)),
+            'total_intensity': np.sum(intensity),
+            'max_intensity': np.max(intensity),
+            'intensity_sum_per_angle': np.sum(intensity, axis=(1, 2, 3))}
+
+
+def assert_stats_equal(stats, stats_ref):
+    for key in stats_ref.keys():
+        assert np.allclose(stats[key], stats_ref[key]), key
+
+
+def run():
+    np.random.seed(0)
+    dat = np.random.rand(3, 10, 8, 8)
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('exchange/data', data=dat)
+    stats = get_dataset_statistics(fname, raw_data_type='intensity', chunk_size=4)
+    assert_stats_equal(stats, get_stats_direct(dat, 'intensity'))
+    with h5py.File(fname, 'r') as f:
+        assert f['statistics'].attrs['raw_data_type'] == 'intensity'
+
+    # Change the data in place. Saved statistics are then returned unless recomputation is asked for or the raw
+    # data type differs.
+    with h5py.File(fname, 'r+') as f:
+        f['exchange/data'][...] = dat * 2
+    assert_stats_equal(get_dataset_statistics(fname, raw_data_type='intensity'), get_stats_direct(dat, 'intensity'))
+    assert_stats_equal(get_dataset_statistics(fname, raw_data_type='magnitude'),
+                       get_stats_direct(dat * 2, 'magnitude'))
+    assert_stats_equal(get_dataset_statistics(fname, raw_data_type='magnitude', recompute=True),
+                       get_stats_direct(dat * 2, 'magnitude'))
+    with h5py.File(fname, 'r') as f:
+        assert f['statistics'].attrs['raw_data_type'] == 'magnitude'
+        assert len(f['statistics'].keys()) == 5
+
+    with h5py.File(fname, 'r+') as f:
+        del f['statistics']
+    # Holding the file open read-only makes opening it for writing fail, even for users who could write to it.
+    f_read = h5py.File(fname, 'r')
+    with warnings.catch_warnings(record=True) as warning_ls:
+        warnings.simplefilter('always')
+        stats = get_dataset_statistics(fname, raw_data_type='intensity')
+    assert any('Cannot save dataset statistics' in str(x.message) for x in warning_ls)
+    assert_stats_equal(stats, get_stats_direct(dat * 2, 'intensity'))
+    assert 'statistics' not in f_read
+    f_read.close()
+
+    stats = get_dataset_statistics(fname, raw_data_type='intensity', save_to_file=False)
+    assert_stats_equal(stats, get_stats_direct(dat * 2, 'intensity'))
+    with h5py.File(fname, 'r') as f:
+        assert 'statistics' not in f
+    os.remove(fname)
+    print('Dataset statistics are correct, reused and saved as expected.')
+
+
+if __name__ == '__main__':
+    run()
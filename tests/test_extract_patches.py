@@ -0,0 +1,70 @@
+from adorym.util import extract_patches, scatter_add_patches
+import adorym.global_settings as global_settings
+import autograd.numpy as anp
+import autograd as ag
+import numpy as np
+
+# Check extract_patches against slicing a padded array, including patches that extend beyond the array and are
+# filled with fill_value, check scatter_add_patches against adding patches into a padded array, and check that
+# the two are adjoint, also through the gradient of extract_patches.
+
+global_settings.backend = 'autograd'
+patch_size = [8, 6]
+# Patches inside the array, overlapping each other, and extending beyond each of its edges.
+pos = np.array([[0, 0], [3, 2], [4, 5], [-3, 1], [2, -4], [14, 7], [5, 15], [-2, -3], [15, 16]])
+
+
+def pad_and_slice(arr, axes, fill_value):
+    pad = [(0, 0)] * arr.ndim
+    pad[axes[0]] = (8, 8)
+    pad[axes[1]] = (8, 8)
+    arr = np.pad(arr, pad, mode='constant', constant_values=fill_value)
+    patches = []
+    for py, px in pos:
+        slicer = [slice(None)] * arr.ndim
+        slicer[axes[0]] = slice(py + 8, py + 8 + patch_size[0])
+        slicer[axes[1]] = slice(px + 8, px + 8 + patch_size[1])
+        patches.append(arr[tuple(slicer)])
+    return np.stack(patches)
+
+
+def add_into_padded(patches, arr_shape, axes):
+    pad_shape = list(arr_shape)
+    pad_shape[axes[0]] += 16
+    pad_shape[axes[1]] += 16
+    arr = np.zeros(pad_shape)
+    for patch, (py, px) in zip(patches, pos):
+        slicer = [slice(None)] * len(arr_shape)
+        slicer[axes[0]] = slice(py + 8, py + 8 + patch_size[0])
+        slicer[axes[1]] = slice(px + 8, px + 8 + patch_size[1])
+        arr[tuple(slicer)] += patch
+    slicer = [slice(None)] * len(arr_shape)
+    slicer[axes[0]] = slice(8, 8 + arr_shape[axes[0]])
+    slicer[axes[1]] = slice(8, 8 + arr_shape[axes[1]])
+    return arr[tuple(slicer)]
+
+
+def run():
+    np.random.seed(0)
+    # Object in [y, x, z, 2] and probe modes in [n_modes, y, x].
+    for arr_shape, axes in [((20, 21, 3, 2), (0, 1)), ((2, 20, 21), (1, 2))]:
+        arr = np.random.rand(*arr_shape)
+        for fill_value in [0, 1.5]:
+            patches = extract_patches(arr, pos, patch_size, axes=axes, fill_value=fill_value)
+            assert np.allclose(patches, pad_and_slice(arr, axes, fill_value))
+
+        patches = np.random.rand(len(pos), *pad_and_slice(arr, axes, 0).shape[1:])
+        arr_sum = scatter_add_patches(patches, pos, arr_shape, axes=axes)
+        assert np.allclose(arr_sum, add_into_padded(patches, arr_shape, axes))
+
+        lhs = np.sum(extract_patches(arr, pos, patch_size, axes=axes) * patches)
+        rhs = np.sum(arr * scatter_add_patches(patches, pos, arr_shape, axes=axes))
+        assert abs(lhs - rhs) < 1e-10 * abs(lhs)
+        grad = ag.grad(lambda a: anp.sum(extract_patches(a, pos, patch_size, axes=axes) * patches))(arr)
+        assert np.allclose(grad, scatter_add_patches(patches, pos, arr_shape, axes=axes))
+        print('Array shape {}, axes {}: patches match slicing, and scatter_add_patches is the adjoint.'.format(
+              arr_shape, axes))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,34 @@
+from adorym.rotation import rotate_fft_shear
+from adorym.util import rotate_no_grad
+import adorym.global_settings as global_settings
+import numpy as np
+
+# Check that FFT shear rotation agrees with bilinear rotation on a smooth object, and that its adjoint is the exact
+# transpose.
+
+global_settings.backend = 'autograd'
+
+
+def run():
+    y, x = np.meshgrid(np.arange(64) - 32, np.arange(64) - 32, indexing='ij')
+    img = np.exp(-((y - 5) ** 2 / 60 + (x + 8) ** 2 / 30))
+    obj = np.stack([img, 0.5 * img[::-1]], axis=-1)[None].repeat(4, axis=0)
+    for theta in [0.3, -1.2, np.pi / 2, 2.5]:
+        obj_shear = rotate_fft_shear(obj, theta)
+        obj_bilinear = rotate_no_grad(obj, theta, override_backend='autograd')
+        print('Theta = {}: max difference from bilinear rotation = {}.'.format(
+            theta, np.max(np.abs(obj_shear - obj_bilinear))))
+        assert np.allclose(obj_shear, obj_bilinear, atol=0.02)
+
+    np.random.seed(0)
+    for shape in [(2, 32, 32, 2), (2, 33, 33, 2), (2, 32, 40, 2)]:
+        for theta in [0.4, 1.9, -2.5, np.pi / 2]:
+            a = np.random.normal(size=shape)
+            b = np.random.normal(size=shape)
+            lhs = np.sum(rotate_fft_shear(a, theta) * b)
+            rhs = np.sum(a * rotate_fft_shear(b, theta, adjoint=True))
+            assert abs(lhs - rhs) < 1e-9 * abs(lhs)
+
+
+if __name__ == '__main__':
+    run()
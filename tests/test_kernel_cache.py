@@ -0,0 +1,60 @@
+import adorym.propagate as propagate
+from adorym.propagate import get_kernel, clear_kernel_cache, set_kernel_cache_size
+import numpy as np
+
+# Check that Fresnel kernels are returned from the cache for the same parameters, recomputed when the distance,
+# grid shape or sign convention changes, and that the least recently used kernels are evicted once the cache
+# holds kernel_cache_size entries. Frequency meshes used to compute the kernels share the cache.
+
+lmbda_nm = 1240. / 5000
+voxel_nm = np.array([10., 10., 10.])
+grid_shape = [32, 32]
+
+
+def get_n_kernels():
+    return len([key for key in propagate._kernel_cache.keys() if key[0] == 'kernel'])
+
+
+def run():
+    clear_kernel_cache()
+    set_kernel_cache_size(64)
+
+    h = get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape)
+    assert np.allclose(h, propagate._get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape, True, 1))
+    assert get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape) is h
+    assert get_n_kernels() == 1
+
+    # Misses on distance, shape and sign convention.
+    h_dist = get_kernel(2e5, lmbda_nm, voxel_nm, grid_shape)
+    h_shape = get_kernel(1e5, lmbda_nm, voxel_nm, [32, 16])
+    h_sign = get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape, sign_convention=-1)
+    for h_new in [h_dist, h_shape, h_sign]:
+        assert h_new is not h
+    assert h_shape.shape == (32, 16)
+    assert np.allclose(h_dist, propagate._get_kernel(2e5, lmbda_nm, voxel_nm, grid_shape, True, 1))
+    assert np.allclose(h_sign, propagate._get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape, True, -1))
+    assert get_n_kernels() == 4
+    # Kernels and the meshes of the two grid shapes.
+    assert len(propagate._kernel_cache) == 6
+
+    # Fill the cache up to its size, then use the first kernel so that it is the most recently used.
+    for i in range(58):
+        get_kernel(1e5 + i + 1, lmbda_nm, voxel_nm, grid_shape)
+    assert len(propagate._kernel_cache) == 64
+    assert get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape) is h
+    get_kernel(1e6, lmbda_nm, voxel_nm, grid_shape)
+    assert len(propagate._kernel_cache) == 64
+    # h_dist was the least recently used entry and is evicted; h is kept.
+    assert get_kernel(1e5, lmbda_nm, voxel_nm, grid_shape) is h
+    assert get_kernel(2e5, lmbda_nm, voxel_nm, grid_shape) is not h_dist
+    assert len(propagate._kernel_cache) == 64
+
+    set_kernel_cache_size(2)
+    assert len(propagate._kernel_cache) == 2
+    clear_kernel_cache()
+    set_kernel_cache_size(64)
+    print('Kernel cache hits, misses and evictions are as expected.')
+
+
+if __name__ == '__main__':
+    run()
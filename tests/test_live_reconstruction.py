@@ -0,0 +1,121 @@
+from adorym.ptychography import reconstruct_ptychography
+from adorym.simulation import create_ptychography_data_batch_numpy
+from multiprocessing import Process
+from scipy.ndimage import gaussian_filter
+import numpy as np
+import h5py
+import glob
+import time
+import shutil
+import re
+import os
+
+# Reconstruct while a separate process writes simulated data into a new file in SWMR mode, as a detector would,
+# and check that the reconstruction finishes and uses all patterns once acquisition is complete.
+
+save_path = 'data_live'
+src_fname = 'data_live_src.h5'
+live_fname = 'data_live.h5'
+output_folder = 'recon_live'
+n_spots_per_write = 16
+write_interval = 0.5
+n_epochs = 2
+probe_pos = [(y, x) for y in np.arange(0, 33, 4) for x in np.arange(0, 33, 4)]
+
+
+def simulate_data():
+    np.random.seed(0)
+    grid_delta = gaussian_filter(np.random.rand(64, 64, 1), (3, 3, 0)) * 1e-5
+    grid_beta = grid_delta * 0.1
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    np.save(os.path.join(save_path, 'grid_delta.npy'), grid_delta)
+    np.save(os.path.join(save_path, 'grid_beta.npy'), grid_beta)
+    if os.path.exists(os.path.join(save_path, src_fname)):
+        os.remove(os.path.join(save_path, src_fname))
+    create_ptychography_data_batch_numpy(energy_ev=5000, psize_cm=1.e-7, n_theta=1, phantom_path=save_path,
+                                         save_path=save_path, fname=src_fname, probe_pos=probe_pos,
+                                         probe_type='gaussian', probe_size=(32, 32), theta_st=0, theta_end=0,
+                                         minibatch_size=len(probe_pos), probe_mag_sigma=6, probe_phase_sigma=6,
+                                         probe_phase_max=0.5)
+
+
+def write_data():
+    with h5py.File(os.path.join(save_path, src_fname), 'r') as f_src:
+        src = f_src['exchange/data']
+        with h5py.File(os.path.join(save_path, live_fname), 'w', libver='latest') as f:
+            dset = f.create_dataset('exchange/data', shape=src.shape, dtype=src.dtype,
+                                    chunks=(1, n_spots_per_write, *src.shape[2:]))
+            n_acquired = f.create_dataset('exchange/n_acquired', data=np.zeros(src.shape[0], dtype=int))
+            f.swmr_mode = True
+            for i_theta in range(src.shape[0]):
+                for i_spot in range(0, src.shape[1], n_spots_per_write):
+                    i_end = min(i_spot + n_spots_per_write, src.shape[1])
+                    dset[i_theta, i_spot:i_end] = src[i_theta, i_spot:i_end]
+                    dset.flush()
+                    n_acquired[i_theta] = i_end
+                    n_acquired.flush()
+                    time.sleep(write_interval)
+
+
+params = {'fname': live_fname,
+          'theta_st': 0,
+          'theta_end': 0,
+          'n_epochs': n_epochs,
+          'obj_size': (64, 64, 1),
+          'two_d_mode': True,
+          'energy_ev': 5000,
+          'psize_cm': 1.e-7,
+          'minibatch_size': 16,
+          'output_folder': output_folder,
+          'cpu_only': True,
+          'save_path': save_path,
+          'use_checkpoint': False,
+          'n_epoch_final_pass': None,
+          'save_intermediate': False,
+          'save_stdout': True,
+          'initial_guess': None,
+          'random_guess_means_sigmas': (1., 0., 0.001, 0.002),
+          'n_dp_batch': 16,
+          # Data statistics are not available before acquisition is complete, so the probe is not initialized
+          # from data.
+          'probe_type': 'gaussian',
+          'probe_mag_sigma': 6,
+          'probe_phase_sigma': 6,
+          'probe_phase_max': 0.5,
+          'learning_rate': 4e-3,
+          'gamma': 0,
+          'probe_pos': probe_pos,
+          'finite_support_mask': None,
+          'forward_algorithm': 'fresnel',
+          'object_type': 'phase_only',
+          'free_prop_cm': 'inf',
+          'optimizer': 'adam',
+          'backend': 'autograd',
+          'live_mode': True,
+          'live_poll_interval': 0.5,
+          }
+
+if __name__ == '__main__':
+    simulate_data()
+    writer = Process(target=write_data)
+    writer.start()
+    # Wait for the writer to create the file and switch to SWMR mode.
+    time.sleep(2 * write_interval)
+    reconstruct_ptychography(**params)
+    writer.join()
+
+    with open(sorted(glob.glob(os.path.join(save_path, output_folder, 'stdout_*.txt')))[-1]) as f:
+        log = f.read()
+    schedule_ls = [[int(x) for x in m] for m in
+                   re.findall(r'(\d+) of (\d+) patterns acquired; (\d+) distinct patterns scheduled', log)]
+    n_pos = len(probe_pos)
+    # Acquisition is seen to progress, and all patterns are used in every epoch after it is complete.
+    assert schedule_ls[0][0] < n_pos
+    assert [x[0] for x in schedule_ls] == sorted(x[0] for x in schedule_ls)
+    complete_ls = [x for x in schedule_ls if x[0] == n_pos]
+    assert len(complete_ls) == n_epochs
+    assert all(x[2] == n_pos for x in complete_ls)
+    assert 'Time to first image' in log
+    print('Live reconstruction finished; epochs: {}.'.format(schedule_ls))
+    shutil.rmtree(save_path)
@@ -0,0 +1,50 @@
+from adorym.propagate import multislice_propagate_batch
+import adorym.global_settings as global_settings
+import autograd.numpy as anp
+import autograd as ag
+import numpy as np
+
+# Check that multislice propagation with a native complex wavefield gives the same exit waves and the same gradients
+# with regard to the object and the probe as the path carrying real and imaginary parts separately, for near-field
+# and far-field propagation, both sign conventions and both refractive index parameterizations.
+
+global_settings.backend = 'autograd'
+
+
+def get_intensity(grid, probe_real, probe_imag, use_native_complex, **kwargs):
+    ex_real, ex_imag = multislice_propagate_batch(grid, probe_real, probe_imag, 5000, 1e-7,
+                                                  obj_batch_shape=grid.shape[:-1],
+                                                  use_native_complex=use_native_complex, **kwargs)
+    return ex_real ** 2 + ex_imag ** 2
+
+
+def run():
+    np.random.seed(0)
+    grid_delta_beta = np.stack([np.random.rand(2, 32, 32, 4) * 1e-5, np.random.rand(2, 32, 32, 4) * 1e-6], axis=-1)
+    grid_real_imag = np.stack([1 - grid_delta_beta[..., 0], grid_delta_beta[..., 1]], axis=-1)
+    probe_real = np.random.rand(32, 32)
+    probe_imag = np.random.rand(32, 32)
+    weight = np.random.rand(2, 32, 32)
+
+    for unknown_type, grid in [('delta_beta', grid_delta_beta), ('real_imag', grid_real_imag)]:
+        for free_prop_cm in [None, 1e-4, 'inf']:
+            for sign_convention in [1, -1]:
+                kwargs = {'free_prop_cm': free_prop_cm, 'sign_convention': sign_convention, 'type': unknown_type}
+                res = []
+                for use_native_complex in [False, True]:
+                    def loss(grid, probe_real, probe_imag):
+                        return anp.sum(weight * get_intensity(grid, probe_real, probe_imag, use_native_complex,
+                                                              **kwargs))
+                    intensity = get_intensity(grid, probe_real, probe_imag, use_native_complex, **kwargs)
+                    grads = ag.grad(loss, [0, 1, 2])(grid, probe_real, probe_imag)
+                    res.append([intensity, *grads])
+                for val_split, val_native, name in zip(*res, ['intensity', 'object gradient', 'probe real gradient',
+                                                              'probe imaginary gradient']):
+                    err = np.max(np.abs(val_native - val_split)) / np.max(np.abs(val_split))
+                    print('{}, free_prop_cm = {}, sign_convention = {}: relative difference of {} = {}.'.format(
+                          unknown_type, free_prop_cm, sign_convention, name, err))
+                    assert err < 1e-10
+
+
+if __name__ == '__main__':
+    run()
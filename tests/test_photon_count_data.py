@@ -0,0 +1,58 @@
+from adorym.conversion import convert_to_photon_counts
+from adorym.data_loader import open_data_store, is_photon_count_data, get_compression_kwargs
+import numpy as np
+import warnings
+import h5py
+import os
+
+# Check that data converted to integer photon counts with each compression filter read back through
+# open_data_store as the rounded intensities, with metadata copied, and that counts beyond the integer range are
+# clipped with a warning.
+
+src_fname = 'test_photon_count_data_src.h5'
+dest_fname = 'test_photon_count_data.h5'
+
+
+def run():
+    np.random.seed(0)
+    mag = np.sqrt(np.random.exponential(20, size=(2, 10, 16, 16)))
+    probe_pos = np.random.rand(10, 2)
+    with h5py.File(src_fname, 'w') as f:
+        f.create_dataset('exchange/data', data=mag.astype('complex64'))
+        f.create_dataset('metadata/probe_pos_px', data=probe_pos)
+    for compression in [None, 'gzip', 'lzf', 'bitshuffle']:
+        for dtype, count_scale in [('uint16', 1.), ('uint32', 3.)]:
+            with warnings.catch_warnings():
+                # Bitshuffle falls back to gzip with a warning if hdf5plugin is not installed.
+                warnings.simplefilter('ignore')
+                filter_kwargs = get_compression_kwargs(compression)
+            convert_to_photon_counts(src_fname, dest_fname, raw_data_type='magnitude', dtype=dtype,
+                                     count_scale=count_scale, compression=compression, chunk_size=4, n_workers=2)
+            store = open_data_store(dest_fname)
+            assert store.data.dtype == np.dtype(dtype)
+            assert is_photon_count_data(store.data)
+            counts = np.round(np.abs(mag.astype('complex64')) ** 2 * count_scale)
+            assert np.array_equal(store.data[1, np.array([2, 5, 6])], counts[1, [2, 5, 6]])
+            assert np.array_equal(store.data[:, :], counts)
+            assert np.allclose(store.get_metadata('probe_pos_px'), probe_pos)
+            if 'compression' in filter_kwargs:
+                assert store.data.compression == filter_kwargs['compression']
+            elif compression is None:
+                assert store.data.compression is None
+            store.close()
+            print('Compression {}, {}: counts match.'.format(compression, dtype))
+
+    with warnings.catch_warnings(record=True) as warning_ls:
+        warnings.simplefilter('always')
+        convert_to_photon_counts(src_fname, dest_fname, raw_data_type='intensity', count_scale=1e4,
+                                 compression=None)
+    assert any('clipped' in str(x.message) for x in warning_ls)
+    store = open_data_store(dest_fname)
+    assert store.data[:, :].max() == np.iinfo('uint16').max
+    store.close()
+    os.remove(src_fname)
+    os.remove(dest_fname)
+
+
+if __name__ == '__main__':
+    run()
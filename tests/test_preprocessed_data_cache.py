@@ -0,0 +1,120 @@
+from adorym.forward_model import PtychographyModel
+from adorym.data_loader import get_preprocessed_data_cache, DataPrefetcher
+from adorym.propagate import multislice_propagate_batch
+import adorym.global_settings as global_settings
+import numpy as np
+import h5py
+import shutil
+import os
+
+# Check that the mismatch loss is the same whether measured data are read from the raw file or from the
+# preprocessed data cache, for both raw data types and loss functions, and that the cache does not change
+# raw_data_type, on which predictions depend. Also check that a cache in FFT order matches far-field predictions
+# that are not fftshifted, and that photon counts converted by the prefetcher give the same loss as raw counts.
+
+fname = 'test_preprocessed_data_cache.h5'
+cache_folder = 'test_preprocessed_data_cache'
+common_vars = {'unknown_type': 'delta_beta', 'normalize_fft': False, 'sign_convention': 1,
+               'rotate_out_of_loop': False, 'scale_ri_by_k': True, 'is_minus_logged': False,
+               'forward_algorithm': 'fresnel', 'stdout_options': {}, 'poisson_multiplier': 1.,
+               'common_probe_pos': True, 'use_native_complex': False, 'checkpoint_slices': False}
+
+
+def get_loss(fm, prj, this_i_theta, this_ind_batch, pred):
+    this_prj_batch = fm.get_measured_batch(prj, this_i_theta, this_ind_batch)
+    return float(fm.get_mismatch_loss(pred, this_prj_batch))
+
+
+def run():
+    global_settings.backend = 'autograd'
+    np.random.seed(0)
+    ds_level = 2
+    this_i_theta = 1
+    this_ind_batch = np.array([0, 3, 4, 7])
+    pred = np.random.rand(len(this_ind_batch), 8, 8) + 0.5
+    for raw_data_type in ['magnitude', 'intensity']:
+        with h5py.File(fname, 'w') as f:
+            f.create_dataset('exchange/data', data=np.random.rand(2, 8, 16, 16) + 0.5)
+        f = h5py.File(fname, 'r')
+        prj = f['exchange/data']
+        for loss_function_type in ['lsq', 'poisson']:
+            fm = PtychographyModel(loss_function_type=loss_function_type, common_vars_dict=common_vars,
+                                   raw_data_type=raw_data_type)
+            fm.ds_level = ds_level
+            fm.theta_downsample = 1
+            loss_raw = get_loss(fm, prj, this_i_theta, this_ind_batch, pred)
+
+            cache_quantity = 'magnitude' if loss_function_type == 'lsq' else 'intensity'
+            fm.prj_cache = get_preprocessed_data_cache(prj, fname, cache_folder, ds_level=ds_level,
+                                                       raw_data_type=raw_data_type, quantity=cache_quantity,
+                                                       dtype='float64')
+            fm.prj_cache_quantity = cache_quantity
+            loss_cache = get_loss(fm, prj, this_i_theta, this_ind_batch, pred)
+            print('{}, {}: loss without cache {}, with cache {}.'.format(raw_data_type, loss_function_type,
+                                                                        loss_raw, loss_cache))
+            assert np.isclose(loss_raw, loss_cache)
+            assert fm.raw_data_type == raw_data_type
+        f.close()
+        os.remove(fname)
+        shutil.rmtree(cache_folder)
+
+
+def run_fft_order():
+    global_settings.backend = 'autograd'
+    np.random.seed(0)
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('exchange/data', data=np.random.rand(2, 8, 15, 16) + 0.5)
+    f = h5py.File(fname, 'r')
+    prj = f['exchange/data']
+    cache = get_preprocessed_data_cache(prj, fname, cache_folder, raw_data_type='intensity', dtype='float64')
+    cache_fft = get_preprocessed_data_cache(prj, fname, cache_folder, raw_data_type='intensity', dtype='float64',
+                                            fft_order=True)
+    assert np.allclose(cache_fft, np.fft.ifftshift(cache, axes=(-2, -1)))
+    f.close()
+    os.remove(fname)
+    shutil.rmtree(cache_folder)
+
+    grid = np.random.rand(2, 15, 16, 3, 2) * 1e-6
+    probe_real, probe_imag = np.random.rand(15, 16), np.random.rand(15, 16)
+    for sign_convention in [1, -1]:
+        for use_native_complex in [False, True]:
+            pred = [np.sqrt(np.sum(np.array(multislice_propagate_batch(
+                        grid, probe_real, probe_imag, 5000, 1e-7, free_prop_cm='inf', obj_batch_shape=grid.shape[:-1],
+                        sign_convention=sign_convention, use_native_complex=use_native_complex,
+                        shift_far_field=shift)) ** 2, axis=0)) for shift in [True, False]]
+            assert np.allclose(pred[1], np.fft.ifftshift(pred[0], axes=(-2, -1)))
+    print('FFT-ordered cache matches unshifted predictions.')
+
+
+def run_prefetcher_conversion():
+    global_settings.backend = 'autograd'
+    np.random.seed(0)
+    this_ind_batch = np.array([0, 3, 4, 7])
+    pred = np.random.rand(len(this_ind_batch), 16, 16) * 10
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('exchange/data', data=np.random.poisson(50, size=(2, 8, 16, 16)).astype('uint16'))
+    f = h5py.File(fname, 'r')
+    prj = f['exchange/data']
+    for loss_function_type in ['lsq', 'poisson']:
+        fm = PtychographyModel(loss_function_type=loss_function_type, common_vars_dict=common_vars,
+                               raw_data_type='intensity')
+        fm.ds_level = 1
+        fm.theta_downsample = 1
+        loss_raw = get_loss(fm, prj, 1, this_ind_batch, pred)
+        quantity = 'magnitude' if loss_function_type == 'lsq' else 'intensity'
+        fm.prefetcher = DataPrefetcher(prj, raw_data_type='intensity', quantity=quantity)
+        fm.prefetcher.start([(1, this_ind_batch)])
+        loss_prefetched = get_loss(fm, prj, 1, this_ind_batch, pred)
+        fm.prefetcher.stop()
+        print('Photon counts, {}: loss without prefetcher {}, with prefetcher {}.'.format(loss_function_type,
+                                                                                         loss_raw, loss_prefetched))
+        assert fm.prefetcher.n_misses == 0
+        assert np.isclose(loss_raw, loss_prefetched)
+    f.close()
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    run()
+    run_fft_order()
+    run_prefetcher_conversion()
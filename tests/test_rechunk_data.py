@@ -0,0 +1,54 @@
+from adorym.conversion import rechunk_data
+from adorym.data_loader import open_data_store, get_recommended_chunk_cache
+import numpy as np
+import h5py
+import os
+
+# Check that rechunk_data keeps data and metadata, writes chunks of one minibatch of spots, and saves a chunk cache
+# size that is used when the file is opened through open_data_store unless other cache settings are given.
+
+src_fname = 'test_rechunk_data_src.h5'
+dest_fname = 'test_rechunk_data.h5'
+
+
+def get_cache_settings(f):
+    # (rdcc_nslots, rdcc_nbytes) of the file access property list.
+    return tuple(f.id.get_access_plist().get_cache()[1:3])
+
+
+def run():
+    np.random.seed(0)
+    dat = np.random.rand(3, 50, 16, 16).astype('float32')
+    theta = np.linspace(0, np.pi, 3)
+    with h5py.File(src_fname, 'w') as f:
+        f.create_dataset('exchange/data', data=dat, chunks=(3, 1, 16, 16))
+        f.create_dataset('metadata/theta', data=theta)
+    for compression in [None, 'gzip']:
+        rechunk_data(src_fname, dest_fname, 16, compression=compression)
+        with h5py.File(dest_fname, 'r') as f:
+            dset = f['exchange/data']
+            assert dset.chunks == (1, 16, 16, 16)
+            assert np.array_equal(dset[...], dat)
+            assert np.allclose(f['metadata/theta'][...], theta)
+            # 4 chunks per angle, plus one.
+            assert dset.attrs['rdcc_nbytes'] == 5 * 16 * 16 * 16 * 4
+            assert dset.attrs['rdcc_nslots'] == 521
+
+        cache_kwargs = get_recommended_chunk_cache(dest_fname)
+        assert cache_kwargs == {'rdcc_nbytes': 5 * 16 * 16 * 16 * 4, 'rdcc_nslots': 521}
+        store = open_data_store(dest_fname)
+        assert get_cache_settings(store.f) == (521, 5 * 16 * 16 * 16 * 4)
+        assert np.array_equal(store.data[1, np.array([3, 20, 49])], dat[1, [3, 20, 49]])
+        store.close()
+        store = open_data_store(dest_fname, rdcc_nbytes=1024 ** 2)
+        assert get_cache_settings(store.f) == (521, 1024 ** 2)
+        store.close()
+        print('Compression {}: rechunked data and chunk cache settings are as expected.'.format(compression))
+
+    assert get_recommended_chunk_cache(src_fname) == {}
+    os.remove(src_fname)
+    os.remove(dest_fname)
+
+
+if __name__ == '__main__':
+    run()
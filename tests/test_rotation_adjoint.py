@@ -0,0 +1,37 @@
+from adorym.util import apply_rotation, apply_rotation_adjoint, apply_rotation_to_hdf5, revert_rotation_to_hdf5, \
+    get_cooridnates_stack_for_rotation, calculate_original_coordinates_for_rotation
+import numpy as np
+import h5py
+import os
+
+# Check that back-rotation is the exact transpose of forward rotation, i.e. <Rx, y> = <x, R^T y>, for arrays and
+# for HDF5 datasets.
+
+fname = 'test_rotation_adjoint.h5'
+
+
+def run():
+    s = [16, 48, 48]
+    coord_new = get_cooridnates_stack_for_rotation(s, axis=0)
+    np.random.seed(0)
+    x = np.random.rand(*s, 2)
+    y = np.random.rand(*s, 2)
+    for theta in [0.3, 1.7, -2.9]:
+        coord_old = calculate_original_coordinates_for_rotation(s, coord_new, theta, override_backend='autograd')
+        for interpolation in ['bilinear', 'nearest']:
+            rx = apply_rotation(x, coord_old, interpolation=interpolation, override_backend='autograd')
+            rty = apply_rotation_adjoint(y, coord_old, interpolation=interpolation, slice_chunk_size=3)
+            assert np.allclose(np.sum(rx * y), np.sum(x * rty))
+
+            with h5py.File(fname, 'w') as f:
+                dset_x = f.create_dataset('x', data=x)
+                dset_y = f.create_dataset('y', data=y)
+                apply_rotation_to_hdf5(dset_x, coord_old, 0, 1, interpolation=interpolation, n_slices_per_read=5)
+                revert_rotation_to_hdf5(dset_y, coord_old, 0, 1, interpolation=interpolation, n_slices_per_read=5)
+                assert np.allclose(dset_x[...], rx)
+                assert np.allclose(dset_y[...], rty)
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,51 @@
+from adorym.util import apply_rotation_primitive, get_cooridnates_stack_for_rotation, \
+    calculate_original_coordinates_for_rotation
+import adorym.global_settings as global_settings
+import autograd.numpy as anp
+import autograd as ag
+import numpy as np
+import time
+
+# Check the vectorized rotation of the Autograd backend against the per-slice loop it replaces, and check that its
+# gradient is the transposed rotation.
+
+global_settings.backend = 'autograd'
+
+
+def rotate_loop(obj, coord_old):
+    s = obj.shape
+    c1 = np.clip(coord_old[:, 0], 0, s[1] - 1)
+    c2 = np.clip(coord_old[:, 1], 0, s[2] - 1)
+    f1, f2 = np.floor(c1).astype(int), np.floor(c2).astype(int)
+    g1, g2 = np.minimum(f1 + 1, s[1] - 1), np.minimum(f2 + 1, s[2] - 1)
+    a1, a2 = (c1 - f1)[:, None], (c2 - f2)[:, None]
+    obj_rot = []
+    for i_slice in range(s[0]):
+        vals = obj[i_slice, f1, f2] * (1 - a1) * (1 - a2) + obj[i_slice, f1, g2] * (1 - a1) * a2 + \
+               obj[i_slice, g1, f2] * a1 * (1 - a2) + obj[i_slice, g1, g2] * a1 * a2
+        obj_rot.append(np.reshape(vals, s[1:]))
+    return np.stack(obj_rot)
+
+
+def run():
+    s = [64, 64, 64]
+    coord_new = get_cooridnates_stack_for_rotation(s, axis=0)
+    coord_old = calculate_original_coordinates_for_rotation(s, coord_new, 0.6, override_backend='autograd')
+    obj = np.random.rand(*s, 2)
+
+    t0 = time.time()
+    obj_rot_ref = rotate_loop(obj, coord_old)
+    t_loop = time.time() - t0
+    t0 = time.time()
+    obj_rot = apply_rotation_primitive(obj, coord_old)
+    t_vec = time.time() - t0
+    print('Loop: {} s; vectorized: {} s.'.format(t_loop, t_vec))
+    assert np.allclose(obj_rot, obj_rot_ref)
+
+    y = np.random.rand(*s, 2)
+    grad = ag.grad(lambda x: anp.sum(apply_rotation_primitive(x, coord_old) * y))(obj)
+    assert np.allclose(np.sum(obj_rot * y), np.sum(obj * grad))
+
+
+if __name__ == '__main__':
+    run()
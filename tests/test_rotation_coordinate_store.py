@@ -0,0 +1,60 @@
+from adorym.rotation import RotationCoordinateStore
+from adorym.util import get_cooridnates_stack_for_rotation, calculate_original_coordinates_for_rotation, \
+    get_interpolation_matrix
+import numpy as np
+import shutil
+import os
+
+# Check that coordinates and interpolation matrices from RotationCoordinateStore match those calculated directly
+# within the quantization of the fractional parts, that a private file is deleted by close(), and that a file
+# kept in a folder persists and is reused.
+
+array_size = [4, 30, 30]
+folder = 'test_rotation_coordinate_store'
+
+
+def get_coords_direct(theta):
+    coord_new = get_cooridnates_stack_for_rotation(array_size, axis=0)
+    coord_old = calculate_original_coordinates_for_rotation(array_size, coord_new, theta, override_backend='autograd')
+    return np.stack([np.clip(coord_old[:, 0], 0, array_size[1] - 1),
+                     np.clip(coord_old[:, 1], 0, array_size[2] - 1)], axis=1)
+
+
+def run():
+    theta_ls = np.linspace(0, np.pi, 7)
+    store = RotationCoordinateStore(array_size, theta_ls)
+    if os.path.isdir('/dev/shm'):
+        assert os.path.dirname(store.fname) == '/dev/shm'
+    assert os.path.exists(store.fname)
+    # Coordinates are stored as float32 after decoding, which adds a rounding error to the quantization error.
+    tol = 0.5 / store.frac_scale + 1e-5
+    for i_theta in [3, 0, 6]:
+        coords_direct = get_coords_direct(theta_ls[i_theta])
+        coords = store.get_coords(i_theta)
+        assert np.max(np.abs(coords - coords_direct)) < tol
+        matrix_direct = get_interpolation_matrix(coords_direct, array_size[1:3]).toarray()
+        matrix = store.get_interpolation_matrix(i_theta)
+        # Each interpolation weight is a product of two fractional parts.
+        assert np.max(np.abs(matrix.toarray() - matrix_direct)) < 2 * tol
+        assert np.allclose(store.get_interpolation_matrix(i_theta, transpose=True).toarray(), matrix.toarray().T)
+    assert np.array_equal(store.table['computed'], [1, 0, 0, 1, 0, 0, 1])
+    fname = store.fname
+    store.close()
+    assert not os.path.exists(fname)
+
+    store = RotationCoordinateStore(array_size, theta_ls, folder=folder)
+    coords = store.get_coords(2)
+    fname = store.fname
+    store.close()
+    assert os.path.exists(fname)
+    store = RotationCoordinateStore(array_size, theta_ls, folder=folder)
+    assert store.fname == fname
+    assert np.array_equal(store.table['computed'], [0, 0, 1, 0, 0, 0, 0])
+    assert np.array_equal(store.get_coords(2), coords)
+    store.close()
+    shutil.rmtree(folder)
+    print('Rotation coordinate store matches direct calculation.')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,59 @@
+from adorym.forward_model import PtychographyModel
+from adorym.rotation import RotationCoordinateStore
+from adorym.util import extract_patches
+import adorym.global_settings as global_settings
+import numpy as np
+
+# Check that object patches of a batch of spots are the same whether they are extracted from the fully rotated
+# object or from the region of interest of the batch rotated alone, for all rotation methods, with batches that
+# cover part of the object and patches that extend beyond it.
+
+global_settings.backend = 'autograd'
+common_vars = {'unknown_type': 'delta_beta', 'normalize_fft': False, 'sign_convention': 1,
+               'rotate_out_of_loop': False, 'scale_ri_by_k': True, 'is_minus_logged': False,
+               'forward_algorithm': 'fresnel', 'stdout_options': {}, 'poisson_multiplier': 1.,
+               'common_probe_pos': True, 'use_native_complex': False, 'checkpoint_slices': False}
+obj_size = [40, 32, 32]
+probe_size = [12, 10]
+
+
+def run():
+    np.random.seed(0)
+    obj = np.random.rand(*obj_size, 2)
+    theta_ls = np.array([0.3, 1.2, -2.])
+    probe_pos = np.array([[y, x] for y in range(-4, 36, 6) for x in range(-3, 30, 5)])
+    store = RotationCoordinateStore(obj_size, theta_ls)
+
+    fm = PtychographyModel(common_vars_dict=common_vars)
+    fm.device_obj = None
+    fm.theta_ls = theta_ls
+    fm.this_obj_size = obj_size
+    fm.probe_size = probe_size
+    fm.probe_pos_int = probe_pos
+    fm.rotation_coord_store = store
+    fm.pin_rotation_coords = False
+    for rotation_method, precalculate_rotation_coords in [('bilinear', True), ('bilinear', False),
+                                                          ('fft_shear', False)]:
+        fm.rotation_method = rotation_method
+        fm.precalculate_rotation_coords = precalculate_rotation_coords
+        for this_i_theta in range(len(theta_ls)):
+            obj_rot = fm.rotate_object(obj, this_i_theta)
+            for this_ind_batch in [np.array([0, 1, 7]), np.array([20, 26, 27, 33]), np.array([5, 40, 41, 47])]:
+                pos_batch = probe_pos[this_ind_batch]
+                indices = fm.get_patch_indices(this_i_theta, this_ind_batch)
+                patches = extract_patches(obj_rot, pos_batch, probe_size, indices=indices)
+
+                roi = fm.get_rotation_roi(this_i_theta, this_ind_batch)
+                assert roi is not None
+                obj_rot_roi = fm.rotate_object(obj, this_i_theta, roi=roi)
+                assert obj_rot_roi.shape[:2] == (roi[1] - roi[0], roi[3] - roi[2])
+                indices = (indices[0] - roi[0], indices[1] - roi[2], indices[2])
+                patches_roi = extract_patches(obj_rot_roi, pos_batch, probe_size, indices=indices)
+                assert np.allclose(patches_roi, patches)
+        print('{}, precalculated coordinates = {}: ROI rotation matches full rotation.'.format(
+              rotation_method, precalculate_rotation_coords))
+    store.close()
+
+
+if __name__ == '__main__':
+    run()
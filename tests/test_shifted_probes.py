@@ -0,0 +1,64 @@
+from adorym.forward_model import PtychographyModel
+from adorym.util import shift_images_fourier_batch, realign_image_fourier
+import adorym.global_settings as global_settings
+import numpy as np
+
+# Check that shifting probe modes by a batch of sub-pixel position corrections in one call gives the same result as
+# shifting each mode by each correction with realign_image_fourier, and that get_shifted_probes returns the same
+# probes whether or not they are taken from the bank of shifted probes.
+
+global_settings.backend = 'autograd'
+common_vars = {'unknown_type': 'delta_beta', 'normalize_fft': False, 'sign_convention': 1,
+               'rotate_out_of_loop': False, 'scale_ri_by_k': True, 'is_minus_logged': False,
+               'forward_algorithm': 'fresnel', 'stdout_options': {}, 'poisson_multiplier': 1.,
+               'common_probe_pos': True, 'use_native_complex': False, 'checkpoint_slices': False}
+
+
+def shift_loop(probe_real, probe_imag, shifts):
+    res_real, res_imag = [], []
+    for shift in shifts:
+        mode_real, mode_imag = [], []
+        for i_mode in range(probe_real.shape[0]):
+            a_real, a_imag = realign_image_fourier(probe_real[i_mode], probe_imag[i_mode], shift, axes=(0, 1))
+            mode_real.append(a_real)
+            mode_imag.append(a_imag)
+        res_real.append(np.stack(mode_real))
+        res_imag.append(np.stack(mode_imag))
+    return np.stack(res_real), np.stack(res_imag)
+
+
+def run():
+    np.random.seed(0)
+    probe_real = np.random.rand(2, 32, 24)
+    probe_imag = np.random.rand(2, 32, 24)
+    probe_pos_correction = np.random.uniform(-2, 2, size=(3, 10, 2))
+    this_i_theta = 1
+    this_ind_batch = np.array([0, 4, 5, 9])
+
+    ref_real, ref_imag = shift_loop(probe_real, probe_imag, probe_pos_correction[this_i_theta, this_ind_batch])
+    shifted_real, shifted_imag = shift_images_fourier_batch(probe_real, probe_imag,
+                                                            probe_pos_correction[this_i_theta, this_ind_batch])
+    assert shifted_real.shape == (len(this_ind_batch), 2, 32, 24)
+    assert np.allclose(shifted_real, ref_real) and np.allclose(shifted_imag, ref_imag)
+
+    fm = PtychographyModel(common_vars_dict=common_vars)
+    fm.device_obj = None
+    fm.optimize_all_probe_pos = False
+    fm.optimize_probe = False
+    fm.optimize_probe_defocusing = False
+    fm.optimize_probe_pos_offset = False
+    for cache_shifted_probes in [False, True]:
+        fm.cache_shifted_probes = cache_shifted_probes
+        fm.shifted_probe_bank = {}
+        # The second batch overlaps the first, so with the bank part of it is taken from earlier results.
+        for ind_batch in [this_ind_batch, np.array([9, 2, 4])]:
+            ref_real, ref_imag = shift_loop(probe_real, probe_imag, probe_pos_correction[this_i_theta, ind_batch])
+            shifted_real, shifted_imag = fm.get_shifted_probes(probe_real, probe_imag, probe_pos_correction,
+                                                               this_i_theta, ind_batch)
+            assert np.allclose(shifted_real, ref_real) and np.allclose(shifted_imag, ref_imag)
+        assert len(fm.shifted_probe_bank) == (5 if cache_shifted_probes else 0)
+    print('Batched probe shifts match realign_image_fourier.')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,72 @@
+from adorym.conversion import stream_copy, copy_groups_except
+import numpy as np
+import h5py
+import os
+
+# Stream a small HDF5 file into a new one, with and without a transform and with chunk sizes that don't divide the
+# number of spots, and check that copied datasets and their attributes are identical to the source, and that
+# copy_groups_except leaves out only the excluded groups.
+
+src_fname = 'test_stream_copy_src.h5'
+dest_fname = 'test_stream_copy.h5'
+
+
+def write_src(dat):
+    with h5py.File(src_fname, 'w') as f:
+        f.create_dataset('exchange/data', data=dat)
+        grp = f.create_group('metadata')
+        grp.attrs['energy_ev'] = 8000.
+        grp.create_dataset('theta', data=np.linspace(0, np.pi, dat.shape[0]))
+        dset = grp.create_dataset('probe_pos_px', data=np.random.rand(dat.shape[1], 2))
+        dset.attrs['unit'] = 'pixel'
+        f.create_dataset('statistics/mean_intensity', data=np.mean(dat, axis=(0, 1)))
+        f.create_dataset('note', data=np.arange(5))
+
+
+def assert_items_equal(obj_src, obj_dest):
+    assert dict(obj_src.attrs) == dict(obj_dest.attrs)
+    if isinstance(obj_src, h5py.Dataset):
+        assert isinstance(obj_dest, h5py.Dataset)
+        assert obj_src.dtype == obj_dest.dtype
+        assert np.array_equal(obj_src[...], obj_dest[...])
+    else:
+        assert set(obj_src.keys()) == set(obj_dest.keys())
+        for key in obj_src.keys():
+            assert_items_equal(obj_src[key], obj_dest[key])
+
+
+def run():
+    np.random.seed(0)
+    dat = np.random.rand(3, 10, 8, 8).astype('float32')
+    write_src(dat)
+
+    for exclude in [('exchange',), ('exchange', 'statistics', 'note')]:
+        for transform, chunk_size, n_workers in [(None, 3, 1), (None, 16, 4), (lambda x: x * 2, 4, 2)]:
+            with h5py.File(src_fname, 'r') as f_src, h5py.File(dest_fname, 'w') as f_dest:
+                copy_groups_except(f_src, f_dest, exclude=exclude)
+                dset_src = f_src['exchange/data']
+                dset_dest = f_dest.create_dataset('exchange/data', shape=dset_src.shape, dtype=dset_src.dtype)
+                throughput = stream_copy(dset_src, dset_dest, transform=transform, chunk_size=chunk_size,
+                                         n_workers=n_workers, verbose=False)
+                assert throughput >= 0
+                assert set(f_dest.keys()) == set(f_src.keys()) - set(exclude) | {'exchange'}
+                for key in f_src.keys():
+                    if key not in exclude:
+                        assert_items_equal(f_src[key], f_dest[key])
+                assert np.array_equal(dset_dest[...], dat if transform is None else dat * 2)
+        print('Excluding {}: copied datasets and attributes are identical.'.format(exclude))
+
+    # Write into a larger dataset at an offset given by dest_key_func.
+    with h5py.File(src_fname, 'r') as f_src, h5py.File(dest_fname, 'w') as f_dest:
+        dset_dest = f_dest.create_dataset('data', shape=(3, 15, 8, 8), dtype='float32')
+        stream_copy(f_src['exchange/data'], dset_dest, chunk_size=4, verbose=False,
+                    dest_key_func=lambda key: (key[0], slice(key[1].start + 5, key[1].stop + 5)))
+        assert np.array_equal(dset_dest[:, 5:], dat)
+        assert np.all(dset_dest[:, :5] == 0)
+    print('dest_key_func places chunks as expected.')
+    os.remove(src_fname)
+    os.remove(dest_fname)
+
+
+if __name__ == '__main__':
+    run()
@@ -2,12 +2,16 @@ import argparse
 import numpy as np
 import dxchange
 import h5py
+from adorym.conversion import stream_copy
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--filename', default='None')
 parser.add_argument('--output', default='data.h5')
 parser.add_argument('--free_prop_cm', default='175.')
 parser.add_argument('--detector_psize_cm', default='75e-4')
+parser.add_argument('--chunk_size', default='256')
+parser.add_argument('--n_workers', default='4')
+parser.add_argument('--n_preview', default='1', help='Number of patterns saved to diffraction_dat.tiff.')
 args = parser.parse_args()
 
 fname = args.filename
@@ -28,10 +32,10 @@ dset_new = grp_new.create_dataset('data', shape=[1, n_pos, probe_size[0], probe_
 print('Old dataset shape: ', dset_old.shape)
 print('New dataset shape: ', dset_new.shape)
 print('Data type: ', dset_old.dtype)
-dp = dset_old[...]
-dset_new[0, :, :, :] = dp
+stream_copy(dset_old, dset_new, chunk_size=int(args.chunk_size), n_workers=int(args.n_workers),
+            dest_key_func=lambda key: (0, *key))
 
-dxchange.write_tiff(dp, 'diffraction_dat.tiff', dtype='float32', overwrite=True)
+dxchange.write_tiff(dset_old[:int(args.n_preview)], 'diffraction_dat.tiff', dtype='float32', overwrite=True)
 
 grp_meta_new = f_new.create_group('metadata')
 
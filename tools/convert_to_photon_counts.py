@@ -0,0 +1,15 @@
+import argparse
+from adorym.conversion import convert_to_photon_counts
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--filename', default='data.h5')
+parser.add_argument('--output', default='data_counts.h5')
+parser.add_argument('--raw_data_type', default='magnitude')
+parser.add_argument('--dtype', default='uint16')
+parser.add_argument('--count_scale', default='1.')
+parser.add_argument('--compression', default='gzip')
+args = parser.parse_args()
+
+compression = None if args.compression == 'None' else args.compression
+convert_to_photon_counts(args.filename, args.output, raw_data_type=args.raw_data_type, dtype=args.dtype,
+                         count_scale=float(args.count_scale), compression=compression)
@@ -0,0 +1,24 @@
+import argparse
+from adorym.data_loader import get_recommended_chunk_cache, benchmark_data_reads
+from adorym.conversion import rechunk_data
+
+# Rewrite exchange/data with chunks suited for minibatch reads, and optionally compare read speed of the layouts.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--filename', default='data.h5')
+parser.add_argument('--output', default='data_rechunked.h5')
+parser.add_argument('--minibatch_size', default='35')
+parser.add_argument('--compression', default='None')
+parser.add_argument('--benchmark', action='store_true')
+args = parser.parse_args()
+
+minibatch_size = int(args.minibatch_size)
+compression = None if args.compression == 'None' else args.compression
+rechunk_data(args.filename, args.output, minibatch_size, compression=compression)
+file_kwargs = get_recommended_chunk_cache(args.output)
+print('Recommended chunk cache: {}'.format(file_kwargs))
+
+if args.benchmark:
+    t_old = benchmark_data_reads(args.filename, minibatch_size)
+    t_new = benchmark_data_reads(args.output, minibatch_size, **file_kwargs)
+    print('Time per minibatch: {} s (original layout), {} s (new layout).'.format(t_old, t_new))